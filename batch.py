@@ -0,0 +1,290 @@
+'''Command line batch processing without the GUI.
+
+   Example:
+       python batch.py photos/ out/ --crop 0 0 800 600 --rotate 1 \\
+           --kernel "0,-1,0;-1,5,-1;0,-1,0" --remove-background
+
+   A pipeline can also be declared in a JSON file (see
+   operations.Pipeline.fromSpec) and passed with --pipeline.'''
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import convolution
+import export
+import matting
+import metrics
+import operations
+import sessions
+import tiles
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def findImages(paths):
+    '''Returns (filename, root) for every image in paths, root being the
+       directory given that it was found in, or None for files given
+       directly.'''
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        images.append((os.path.join(dirpath, filename), path))
+        elif os.path.isfile(path):
+            images.append((path, None))
+    return images
+
+
+def findCollisions(pipeline, images):
+    '''Returns the output paths that more than one input would be written
+       to, with those inputs.'''
+    inputs = {}
+    for filename, root in images:
+        output = os.path.normcase(os.path.abspath(pipeline.outputPath(filename, root)))
+        inputs.setdefault(output, []).append(filename)
+    return dict((output, names) for output, names in inputs.items() if len(names) > 1)
+
+
+def parseKernel(text):
+    return [[float(x) for x in row.split(',')] for row in text.split(';')]
+
+
+def buildPipeline(args):
+    if args.pipeline:
+        with open(args.pipeline, 'r') as f:
+            spec = json.load(f)
+    else:
+        spec = {'rotate': args.rotate, 'remove': args.remove_background,
+                'model': args.model, 'matting': args.matting}
+        if args.crop:
+            spec['crop'] = args.crop
+        if args.kernel:
+            spec['convolve'] = {'matrix': parseKernel(args.kernel),
+                                'multiplier': args.multiplier,
+                                'strategy': args.strategy}
+    spec.setdefault('save', {})
+    spec['save'].setdefault('dir', args.output)
+    if args.extension:
+        spec['save']['extension'] = args.extension
+    for key in ('quality', 'compression', 'thumbnails'):
+        if getattr(args, key) is not None:
+            spec['save'][key] = getattr(args, key)
+    if args.lossless:
+        spec['save']['lossless'] = True
+    pipeline = operations.Pipeline.fromSpec(spec)
+    if args.tile_budget:
+        pipeline.tileBudget = int(args.tile_budget * 1024 * 1024)
+    pipeline.maskCache = args.mask_cache
+    return pipeline
+
+
+_pipeline = None
+
+
+def _initWorker(pipeline):
+    global _pipeline
+    _pipeline = pipeline
+    # Every core already has its own process, so keep OpenCV, the
+    # convolution engine and the encoders single threaded
+    cv2.setNumThreads(1)
+    convolution.WORKERS = 1
+    export.WORKERS = 1
+    if pipeline.tileBudget:
+        tiles.TILE_BUDGET = pipeline.tileBudget
+    if pipeline.remove:
+        # Unlike the GUI, batch runs don't write masks to the disk unless asked
+        sessions.setDefaultCache(sessions.MaskCache(pipeline.maskCache))
+        sessions.defaultPool().preload(pipeline.model, background=False)
+    metrics.startSampling()
+
+
+def _processFile(image):
+    # Every result carries the metrics of its own file, which the parent
+    # process adds up
+    filename, root = image
+    metrics.REGISTRY.reset()
+    try:
+        result = _pipeline.process(filename, root)
+    except Exception as e:
+        result = {'input': filename, 'error': str(e)}
+    metrics.gauge('rss_bytes', metrics.residentBytes())
+    result['metrics'] = metrics.snapshot()
+    return result
+
+
+class ThroughputReport(object):
+    '''Accumulates the per-stage timings returned by the workers.'''
+
+    def __init__(self):
+        self.images = 0
+        self.pixels = 0
+        self.failed = []
+        self.stageSeconds = {}
+        self.stageImages = {}
+
+    def add(self, result):
+        if 'error' in result:
+            self.failed.append(result)
+            return
+        self.images += 1
+        self.pixels += result['pixels']
+        for stage, seconds in result['timings'].items():
+            self.stageSeconds[stage] = self.stageSeconds.get(stage, 0.0) + seconds
+            self.stageImages[stage] = self.stageImages.get(stage, 0) + 1
+
+    def format(self, wallSeconds, workers):
+        lines = ['Processed %d images (%d failed) in %.2fs with %d workers'
+                 % (self.images, len(self.failed), wallSeconds, workers)]
+        if wallSeconds > 0:
+            lines.append('Overall: %.1f images/s, %.0f images/hour, %.1f MP/s'
+                         % (self.images / wallSeconds,
+                            3600 * self.images / wallSeconds,
+                            self.pixels / 1e6 / wallSeconds))
+        for stage in ['load'] + operations.STAGES:
+            if stage not in self.stageSeconds:
+                continue
+            seconds = self.stageSeconds[stage]
+            count = self.stageImages[stage]
+            perImage = seconds / count
+            lines.append('  %-8s %8.1f ms/image %8.1f images/s per worker'
+                         % (stage, 1000 * perImage,
+                            1 / perImage if perImage > 0 else float('inf')))
+        for result in self.failed:
+            lines.append('  failed: %s (%s)' % (result['input'], result['error']))
+        return '\n'.join(lines)
+
+
+class MetricsExport(object):
+    '''Writes the metrics of a run as JSON lines, one per image and a final
+       summary, and/or as a Prometheus text file that is rewritten every
+       PROMETHEUS_INTERVAL images.'''
+
+    PROMETHEUS_INTERVAL = 50
+
+    def __init__(self, jsonLines=None, prometheus=None):
+        self.jsonLines = jsonLines
+        self.prometheus = prometheus
+        self.images = 0
+
+    def add(self, result):
+        metrics.REGISTRY.merge(result.get('metrics', {}))
+        metrics.increment('images_failed' if 'error' in result else 'images_processed')
+        self.images += 1
+        if self.jsonLines:
+            fields = dict((key, value) for key, value in result.items()
+                          if key != 'metrics')
+            metrics.writeJSONLines(self.jsonLines, result.get('metrics', {}),
+                                   event='image', **fields)
+        if self.prometheus and self.images % self.PROMETHEUS_INTERVAL == 0:
+            metrics.writePrometheus(self.prometheus)
+
+    def finish(self, wallSeconds):
+        metrics.gauge('wall_seconds', wallSeconds)
+        if self.jsonLines:
+            metrics.writeJSONLines(self.jsonLines, event='summary')
+        if self.prometheus:
+            metrics.writePrometheus(self.prometheus)
+
+
+def run(pipeline, images, workers=None, progress=None, onResult=None):
+    '''Processes every (filename, root) of images, see findImages.'''
+    workers = workers or os.cpu_count() or 1
+    report = ThroughputReport()
+    chunksize = max(1, min(16, len(images) // (workers * 4)))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker,
+                             initargs=(pipeline,)) as executor:
+        for result in executor.map(_processFile, images, chunksize=chunksize):
+            report.add(result)
+            if onResult is not None:
+                onResult(result)
+            if progress is not None:
+                progress(report)
+    return report, time.perf_counter() - start, workers
+
+
+def addPipelineArguments(parser):
+    '''Adds the options declaring the pipeline, read by buildPipeline, and
+       those of the worker processes and metrics.'''
+    parser.add_argument('--pipeline', help='JSON file declaring the pipeline')
+    parser.add_argument('--crop', nargs=4, type=int,
+                        metavar=('X0', 'Y0', 'X1', 'Y1'))
+    parser.add_argument('--rotate', type=int, default=0,
+                        help='number of clockwise quarter turns')
+    parser.add_argument('--kernel', help='convolution matrix, rows separated '
+                        'by ";" and entries by ","')
+    parser.add_argument('--multiplier', type=float, default=1.0)
+    parser.add_argument('--strategy', default=convolution.AUTO,
+                        choices=[convolution.AUTO] + convolution.STRATEGIES,
+                        help='how to compute the convolution')
+    parser.add_argument('--remove-background', action='store_true')
+    parser.add_argument('--model', default=sessions.DEFAULT_MODEL,
+                        choices=sessions.MODELS,
+                        help='rembg model used to remove the background')
+    parser.add_argument('--matting', default=matting.DEFAULT_QUALITY,
+                        choices=matting.QUALITY_NAMES,
+                        help='resolution the background is removed at: fast and '
+                        'balanced run the model on a smaller copy and refine the '
+                        'mask at full resolution')
+    parser.add_argument('--mask-cache', metavar='DIR', default=None,
+                        help='keep the background masks in DIR to reuse them in later '
+                        'runs (default: only in memory; the GUI uses %s)'
+                        % sessions.DEFAULT_CACHE_DIR.replace('%', '%%'))
+    parser.add_argument('--extension', help='output extension, e.g. .png or .webp')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='JPEG and WebP quality, 0-100')
+    parser.add_argument('--compression', type=int, default=None,
+                        help='PNG compression level, 0-9 (default %d)'
+                        % export.PNG_COMPRESSION)
+    parser.add_argument('--lossless', action='store_true', help='lossless WebP')
+    parser.add_argument('--thumbnails', type=int, nargs='+', metavar='SIDE',
+                        help='also write thumbnails with these longest sides')
+    parser.add_argument('--tile-budget', type=float, default=None,
+                        help='memory per tile in MB when processing images '
+                        'too large for memory')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--metrics-jsonl', metavar='PATH',
+                        help='append per-image metrics and a summary as JSON lines')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='write metrics in the Prometheus text format')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply an editing pipeline to '
+                                     'whole directories of images.')
+    parser.add_argument('input', nargs='+', help='image files or directories')
+    parser.add_argument('output', help='directory to write the results to')
+    addPipelineArguments(parser)
+    args = parser.parse_args(argv)
+
+    images = findImages(args.input)
+    if not images:
+        parser.error('no images found')
+    try:
+        pipeline = buildPipeline(args)
+    except ValueError as e:
+        parser.error(str(e))
+    collisions = findCollisions(pipeline, images)
+    if collisions:
+        output, inputs = sorted(collisions.items())[0]
+        parser.error('%d outputs would be written more than once, e.g. %s from %s'
+                     % (len(collisions), output, ', '.join(inputs)))
+    os.makedirs(args.output, exist_ok=True)
+
+    metricsExport = MetricsExport(args.metrics_jsonl, args.metrics_prom)
+    report, wallSeconds, workers = run(pipeline, images, args.jobs,
+                                       onResult=metricsExport.add)
+    metricsExport.finish(wallSeconds)
+    print(report.format(wallSeconds, workers))
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+'''Compares the convolution strategies by kernel and image size, and checks
+   every result against cv2.filter2D.
+
+   Example:
+       python benchmarks/bench_convolution.py --sizes 512 2048 --kernels 3 9 25
+
+   Every strategy must match filter2D to within one level (the direct one
+   exactly, for kernels up to 9x9). The exit status is 1 if any result does
+   not, so the script can also be run as a correctness check.'''
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import convolution
+
+EXACT_SIZE = 9
+
+
+def makeKernels(size, rng):
+    '''Returns kernels of about size x size that take every path of the
+       strategies: a dense one, which is not separable, and a Gaussian one,
+       which is; signed ones (sharpening and a Sobel derivative) whose
+       results saturate; one of even size and one without any symmetry.'''
+    dense = rng.random((size, size))
+    dense /= dense.sum()
+    gaussian = cv2.getGaussianKernel(size, size / 5.0)
+    # The identity plus a multiple of the identity minus a box blur
+    sharpen = -np.full((size, size), 1.0 / (size * size))
+    sharpen[size // 2, size // 2] += 2.0
+    if size % 2 and size <= 31:
+        derivative, smoothing = cv2.getDerivKernels(1, 0, size)
+    else:
+        # getDerivKernels only takes odd sizes up to 31, a Gaussian
+        # derivative is the same idea
+        derivative, smoothing = np.linspace(-1, 1, size)[:, None], gaussian
+    sobel = smoothing.dot(derivative.T)
+    sobel /= np.abs(sobel).sum() / 4
+    even = rng.random((size + size % 2, size + size % 2))
+    even /= even.sum()
+    asymmetric = rng.normal(size=(size, size + 2))
+    asymmetric[size // 2, 0] += 4.0
+    asymmetric /= asymmetric.sum()
+    return [('dense', dense), ('gaussian', gaussian.dot(gaussian.T)),
+            ('sharpen', sharpen), ('sobel', sobel), ('even', even),
+            ('asymmetric', asymmetric)]
+
+
+def timeStrategy(image, kernel, strategy, workers, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = convolution.convolve(image, kernel, strategy, workers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 2048],
+                        help='side of the square test images')
+    parser.add_argument('--kernels', type=int, nargs='+', default=[3, 5, 9, 15, 25, 41])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    failures = 0
+    print('%-6s %-7s %-10s %-10s %10s %8s  %s' % ('image', 'kernel', 'type', 'strategy',
+                                                  'ms', 'max diff', 'auto'))
+    for side in args.sizes:
+        image = rng.integers(0, 256, (side, side, 3), dtype=np.uint8)
+        for size in args.kernels:
+            for name, kernel in makeKernels(size, rng):
+                reference = cv2.filter2D(image, -1, kernel)
+                chosen = convolution.chooseStrategy(kernel)
+                for strategy in convolution.STRATEGIES:
+                    if strategy == convolution.SEPARABLE and \
+                       convolution.separate(kernel) is None:
+                        continue
+                    result, elapsed = timeStrategy(image, kernel, strategy,
+                                                   args.workers, args.repeat)
+                    diff = int(np.abs(result.astype(np.int16) - reference).max())
+                    tolerance = 0 if strategy == convolution.DIRECT and \
+                        size <= EXACT_SIZE else 1
+                    ok = diff <= tolerance
+                    failures += not ok
+                    print('%-6d %-7s %-10s %-10s %10.1f %8d  %s%s' % (
+                        side, '%dx%d' % kernel.shape, name, strategy, elapsed * 1000,
+                        diff, '*' if strategy == chosen else '',
+                        '' if ok else '  FAILED'))
+    if failures:
+        print('%d result(s) differ from filter2D' % failures)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+'''Times image generation through the HTTP client against the local
+   stand-in server: one request per prompt, the batching client, and the
+   same prompts answered from the prompt cache.
+
+   Examples:
+       python benchmarks/bench_generation.py
+       python benchmarks/bench_generation.py --prompts 32 --size 256
+       python benchmarks/bench_generation.py --url http://gpu-box:8765
+
+   Without --url a procedural server is started on a free local port.'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generation
+
+
+def timeIt(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='generation server to use instead of a local one')
+    parser.add_argument('--prompts', type=int, default=16)
+    parser.add_argument('--size', type=int, default=512)
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = generation.serve(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://%s:%d' % server.server_address[:2]
+
+    prompts = ['a %s circle number %d' % (colour, i)
+               for i, colour in zip(range(args.prompts), list(generation.COLOURS) * args.prompts)]
+    params = {'width': args.size, 'height': args.size}
+    directory = tempfile.mkdtemp(prefix='bench_generation')
+    try:
+        backend = generation.HTTPBackend(url)
+        single = timeIt(lambda: [backend.generate([(prompt, params)]) for prompt in prompts])
+
+        client = generation.GenerationClient(backend, generation.PromptCache(directory))
+
+        def generateAll():
+            futures = [client.submit(prompt, seed=1, **params) for prompt in prompts]
+            return [future.result() for future in futures]
+
+        batched = timeIt(generateAll)
+        cached = timeIt(generateAll)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if server is not None:
+            server.shutdown()
+
+    print('%-20s %10s %12s' % ('mode', 'ms', 'images/s'))
+    for name, seconds in [('one per request', single), ('batched client', batched),
+                          ('prompt cache', cached)]:
+        print('%-20s %10.1f %12.1f' % (name, seconds * 1000, len(prompts) / seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+'''Compares background removal at the matting qualities with removal on
+   the full resolution image: time, speedup and how well the masks agree.
+
+   Examples:
+       python benchmarks/bench_matting.py photos/portrait.jpg photos/product.png
+       python benchmarks/bench_matting.py --sizes 4 16 --model u2netp
+
+   Without image files, synthetic images of --sizes megapixels (an object on
+   a textured background) are used; real photos give more meaningful
+   numbers. The agreement is the intersection over union of the masks
+   thresholded at 128, with the full resolution mask as the reference. The
+   exit status is 1 if any quality agrees less than --min-iou.
+
+   Needs rembg; the model is loaded before anything is timed.'''
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import matting
+import operations
+import sessions
+
+
+def syntheticImage(megapixels, seed=0):
+    '''An ellipse with some texture on a gradient background, 4:3.'''
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3.0)))
+    height = int(round(megapixels * 1e6 / width))
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, 3), np.uint8)
+    image[:, :, 0] = x[np.newaxis, :]
+    image[:, :, 1] = y[:, np.newaxis]
+    image[:, :, 2] = 120
+    cv2.ellipse(image, (width // 2, height // 2), (width // 4, height // 3), 0, 0, 360,
+                (40, 90, 200), -1, cv2.LINE_AA)
+    return cv2.add(image, rng.integers(0, 24, image.shape, dtype=np.uint8))
+
+
+def timeMask(image, model, quality, repeat):
+    '''Best time of repeat runs, without the mask cache.'''
+    best = None
+    for _ in range(repeat):
+        cache = sessions.MaskCache(directory=None)
+        start = time.perf_counter()
+        mask = sessions.computeMask(image, model, cache=cache, quality=quality)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return mask, best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('images', nargs='*', help='image files to remove the background of')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[4, 16],
+                        help='sizes of the synthetic images in megapixels')
+    parser.add_argument('--model', default=sessions.DEFAULT_MODEL, choices=sessions.MODELS)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--min-iou', type=float, default=0.95)
+    args = parser.parse_args(argv)
+
+    try:
+        sessions.defaultPool().get(args.model)
+    except ImportError:
+        print('rembg is not installed')
+        return 2
+
+    if args.images:
+        inputs = [(os.path.basename(name), operations.loadImage(name))
+                  for name in args.images]
+    else:
+        inputs = [('synthetic %gMP' % size, syntheticImage(size)) for size in args.sizes]
+
+    failures = 0
+    print('%-24s %-9s %10s %8s %7s' % ('image', 'quality', 'ms', 'speedup', 'IoU'))
+    for name, image in inputs:
+        reference, referenceTime = timeMask(image, args.model, matting.FULL, args.repeat)
+        print('%-24s %-9s %10.1f %8s %7s' % (name, matting.FULL, referenceTime * 1000,
+                                             '1.0x', '1.0000'))
+        for quality in matting.QUALITY_NAMES:
+            if quality == matting.FULL:
+                continue
+            mask, elapsed = timeMask(image, args.model, quality, args.repeat)
+            agreement = matting.iou(mask, reference)
+            ok = agreement >= args.min_iou
+            failures += not ok
+            print('%-24s %-9s %10.1f %7.1fx %7.4f%s' % (
+                name, quality, elapsed * 1000, referenceTime / elapsed, agreement,
+                '' if ok else '  BELOW --min-iou'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+'''Headless benchmark of every image operation and of the display path, on
+   synthetic images of several sizes and channel layouts.
+
+   Examples:
+       python benchmarks/bench_operations.py --save baseline.json
+       python benchmarks/bench_operations.py --compare baseline.json
+       python benchmarks/bench_operations.py --sizes 1 100 --layouts bgr \\
+           --operations load convolve
+
+   For every operation, size and layout the best wall time of --repeat
+   runs is reported, together with the throughput in megapixels per second
+   and the peak memory the operation added to the process. Memory is
+   measured in a separate, untimed run, as the larger of what numpy
+   allocated (tracemalloc) and the growth of the resident set size, which
+   also covers OpenCV's own buffers.
+
+   --save writes the results to a JSON baseline and --compare checks them
+   against one: anything slower or using more memory than the baseline by
+   more than --threshold is flagged, and the exit status is 1.'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import display
+import export
+import graph
+import metrics
+import operations
+
+LAYOUTS = {'gray': 1, 'bgr': 3, 'bgra': 4}
+# Size of the canvas the display operations draw for
+CANVAS = (1920, 1080)
+SHARPEN = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], dtype=np.float64)
+SAMPLE_INTERVAL = 0.002
+
+
+def syntheticImage(megapixels, channels, seed=0):
+    '''A smooth gradient with some noise, so it compresses like a photo
+       rather than like pure noise or a flat colour. The aspect ratio is
+       4:3.'''
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3.0)))
+    height = int(round(megapixels * 1e6 / width))
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, channels), np.uint8)
+    for c in range(channels):
+        base = (x[np.newaxis, :] * (c + 1) / channels + y[:, np.newaxis] / (c + 1)) % 256
+        noise = rng.integers(0, 16, (height, width), dtype=np.uint8)
+        image[:, :, c] = base.astype(np.uint8) + noise
+    return image[:, :, 0] if channels == 1 else image
+
+
+class PeakMemory(object):
+    '''Samples the resident set size on a thread while the block runs.'''
+
+    def __enter__(self):
+        self.baseline = metrics.residentBytes()
+        self.peak = self.baseline
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, metrics.residentBytes())
+            time.sleep(SAMPLE_INTERVAL)
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, metrics.residentBytes())
+
+    @property
+    def added(self):
+        return self.peak - self.baseline
+
+
+def toRGB(image):
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def fitToCanvas(image):
+    height, width = image.shape[:2]
+    size = display.fitSize(width, height, *CANVAS)
+    return display.ImagePyramid(image).resize(size[0], size[1])
+
+
+def prepare(operation, image, directory):
+    '''Does the untimed setup of an operation and returns the timed part.'''
+    if operation == 'load':
+        filename = os.path.join(directory, 'load.png')
+        operations.writeImage(filename, image)
+        return lambda: operations.loadImage(filename)
+    if operation == 'write':
+        filename = os.path.join(directory, 'write.png')
+        return lambda: operations.writeImage(filename, image)
+    if operation == 'export':
+        # A JPEG with two thumbnails, encoded in parallel
+        filename = os.path.join(directory, 'export.jpg')
+        settings = export.ExportSettings(thumbnails=[1024, 256])
+        return lambda: export.exportImage(filename, image, settings)
+    if operation == 'display':
+        # ImageWidget.fitImageToCanvas on a newly loaded image
+        return lambda: fitToCanvas(image)
+    if operation == 'convert':
+        # ImageWidget.convertCVToTk without the Tk PhotoImage, which needs
+        # a display
+        small = fitToCanvas(image)
+        return lambda: Image.fromarray(toRGB(small))
+    if operation == 'convolve':
+        return lambda: operations.convolveImage(image, SHARPEN)
+    if operation == 'rotate':
+        return lambda: operations.rotateImage(image, 1)
+    if operation == 'preview':
+        def preview():
+            edits = graph.EditGraph(image.copy())
+            height, width = image.shape[:2]
+            edits.push(graph.Crop(width // 8, height // 8, width - width // 8,
+                                  height - height // 8))
+            edits.push(graph.Rotate(1))
+            edits.push(graph.Convolve(SHARPEN))
+            return edits.preview(*CANVAS)
+        return preview
+    if operation == 'remove':
+        if image.ndim != 3 or image.shape[2] != 3:
+            return None
+        try:
+            import rembg
+        except ImportError:
+            return None
+        return lambda: operations.computeMask(image)
+    raise ValueError('Unknown operation ' + operation)
+
+
+OPERATIONS = ['load', 'display', 'convert', 'convolve', 'rotate', 'preview',
+              'write', 'export', 'remove']
+
+
+def measure(function, repeat):
+    # The memory run also warms up caches and lazily loaded code
+    tracemalloc.start()
+    with PeakMemory() as memory:
+        result = function()
+    traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    peak = max(traced, memory.added)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+        del result
+    return min(times), float(np.median(times)), peak
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'opencv': cv2.__version__, 'machine': platform.machine(),
+            'system': platform.system(), 'cpus': os.cpu_count()}
+
+
+def run(sizes, layouts, names, repeat, out=sys.stdout):
+    results = {}
+    directory = tempfile.mkdtemp(prefix='image_editor_bench_')
+    try:
+        for megapixels in sizes:
+            for layout in layouts:
+                image = syntheticImage(megapixels, LAYOUTS[layout])
+                for name in names:
+                    function = prepare(name, image, directory)
+                    if function is None:
+                        continue
+                    best, median, peak = measure(function, repeat)
+                    key = '%s/%gMP/%s' % (name, megapixels, layout)
+                    results[key] = {'seconds': best, 'median': median,
+                                    'megapixelsPerSecond': megapixels / best,
+                                    'peakBytes': peak}
+                    out.write('%-28s %10.1f ms %10.1f MP/s %10.1f MB\n' % (
+                        key, best * 1000, megapixels / best, peak / 1e6))
+                    out.flush()
+                del image
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    '''Prints the change of every result against the baseline and returns
+       the keys that regressed.'''
+    regressions = []
+    old = baseline['results']
+    for key in sorted(results):
+        if key not in old:
+            continue
+        ratio = results[key]['seconds'] / old[key]['seconds']
+        memory = results[key]['peakBytes']
+        oldMemory = old[key]['peakBytes']
+        slower = ratio > 1 + threshold
+        # Small amounts of memory are mostly sampling noise
+        bigger = memory > oldMemory * (1 + threshold) and memory - oldMemory > 8e6
+        flag = ''
+        if slower or bigger:
+            regressions.append(key)
+            flag = '  REGRESSION' + (' (time)' if slower else '') + \
+                (' (memory)' if bigger else '')
+        out.write('%-28s %+7.1f%% time %+9.1f MB%s\n' % (
+            key, (ratio - 1) * 100, (memory - oldMemory) / 1e6, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4, 16],
+                        help='image sizes in megapixels, e.g. 1 4 16 100')
+    parser.add_argument('--layouts', nargs='+', default=sorted(LAYOUTS),
+                        choices=sorted(LAYOUTS))
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS,
+                        choices=OPERATIONS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare against this baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    # Keep the run reproducible
+    cv2.setRNGSeed(0)
+    results = run(args.sizes, args.layouts, args.operations, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('environment') != environment():
+            print('Warning: the baseline was recorded in a different environment')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d regression(s)' % len(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+'''Measures how long the editor takes to start and checks it against a
+   budget.
+
+   Examples:
+       python benchmarks/bench_startup.py
+       python benchmarks/bench_startup.py --budget 0.8 --repeat 10
+
+   Every run starts a fresh interpreter, so the times include Python itself
+   and no module is already imported. Two times are reported:
+   - import: until frames.py is imported,
+   - window: until the window is on screen with its first tab built (only
+     with a display; without one only the imports are measured).
+   The exit status is 1 if the median window time (or the import time
+   without a display) is over --budget seconds, or if a module that should
+   only be loaded on first use (rembg, onnxruntime, requests) was imported
+   during startup.'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds from starting the interpreter to the window being shown
+STARTUP_BUDGET = 1.0
+# Modules that must not be imported before they are needed
+DEFERRED_MODULES = ['rembg', 'onnxruntime', 'requests']
+
+CHILD = '''
+import json, os, sys, time
+sys.path.insert(0, %(root)r)
+result = {}
+import frames
+result['import'] = time.time()
+if os.environ.get('DISPLAY') or sys.platform in ('win32', 'darwin'):
+    root, app = frames.createWindow()
+    root.update()
+    root.wait_visibility(root)
+    result['window'] = time.time()
+    root.destroy()
+result['deferred'] = [name for name in %(deferred)r if name in sys.modules]
+print(json.dumps(result))
+'''
+
+
+def measure():
+    '''Starts the editor in a new interpreter and returns the seconds to
+       each step, and the deferred modules that were imported.'''
+    env = dict(os.environ, IMAGE_EDITOR_NO_WARMUP='1')
+    start = time.time()
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD % {'root': ROOT, 'deferred': DEFERRED_MODULES}],
+        env=env, cwd=ROOT)
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    times = {step: result[step] - start for step in ('import', 'window') if step in result}
+    return times, result['deferred']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                        help='seconds allowed until the window is shown')
+    args = parser.parse_args(argv)
+
+    runs = []
+    deferred = set()
+    for _ in range(args.repeat):
+        times, imported = measure()
+        runs.append(times)
+        deferred.update(imported)
+
+    print('%-8s %10s %10s %10s' % ('step', 'median ms', 'min ms', 'max ms'))
+    for step in ('import', 'window'):
+        values = [run[step] for run in runs if step in run]
+        if values:
+            print('%-8s %10.1f %10.1f %10.1f' % (step, statistics.median(values) * 1000,
+                                                min(values) * 1000, max(values) * 1000))
+    checked = 'window' if 'window' in runs[0] else 'import'
+    if checked == 'import':
+        print('No display, only the imports were measured')
+
+    failed = False
+    median = statistics.median(run[checked] for run in runs)
+    if median > args.budget:
+        print('Startup took %.0f ms, over the budget of %.0f ms'
+              % (median * 1000, args.budget * 1000))
+        failed = True
+    else:
+        print('Within the budget of %.0f ms' % (args.budget * 1000))
+    if deferred:
+        print('Imported during startup: ' + ', '.join(sorted(deferred)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+'''Saving and loading of feature data: numpy arrays, masks, and lists of
+   OpenCV keypoints and matches, nested in dictionaries and lists.
+
+   Files are written in a compact binary container: a small JSON header
+   describing the structure, followed by the raw buffers of the arrays.
+   Lists of cv2.KeyPoint and cv2.DMatch are packed into structured arrays.
+   Loading maps the buffers into memory instead of reading them, so large
+   arrays are only read from disk when they are used.
+
+   Layout:
+       MAGIC | header length (uint64, little endian) | JSON header | buffers
+
+   Every buffer starts at a multiple of ALIGNMENT bytes. The header is the
+   stored object with every array replaced by
+   {"__type__": "buffer", "dtype": ..., "shape": [...], "offset": ...}.
+
+   The JSON files written by earlier versions can still be loaded.'''
+import json
+import numpy as np
+import cv2
+
+MAGIC = b'IMGEDIT\x01'
+ALIGNMENT = 64
+
+KEYPOINT_DTYPE = np.dtype([('pt', '<f4', (2,)), ('size', '<f4'), ('angle', '<f4'),
+                           ('response', '<f4'), ('octave', '<i4'), ('class_id', '<i4')])
+DMATCH_DTYPE = np.dtype([('queryIdx', '<i4'), ('trainIdx', '<i4'), ('imgIdx', '<i4'),
+                         ('distance', '<f4')])
+
+
+class CustomJSONEncoder(json.JSONEncoder):
+    '''This class supports the serialization of JSON files containing
+       OpenCV's feature and match objects as well as Numpy arrays.'''
+
+    def __init__(self, indent=True):
+        super(CustomJSONEncoder, self).__init__(indent=indent)
+
+    def default(self, o):
+        if hasattr(o, 'pt') and hasattr(o, 'size') and hasattr(o, 'angle') and \
+           hasattr(o, 'response') and hasattr(o, 'octave') and \
+           hasattr(o, 'class_id'):
+            return {'__type__': 'cv2.KeyPoint',
+                    'point': o.pt,
+                    'size': o.size,
+                    'angle': o.angle,
+                    'response': o.response,
+                    'octave': o.octave,
+                    'class_id': o.class_id}
+
+        elif hasattr(o, 'distance') and hasattr(o, 'trainIdx') and \
+                hasattr(o, 'queryIdx') and hasattr(o, 'imgIdx'):
+            return {'__type__': 'cv2.DMatch',
+                    'distance': o.distance,
+                    'trainIdx': o.trainIdx,
+                    'queryIdx': o.queryIdx,
+                    'imgIdx': o.imgIdx}
+
+        elif isinstance(o, np.ndarray):
+            return {'__type__': 'numpy.ndarray',
+                    '__shape__': o.shape,
+                    '__array__': o.ravel().tolist()}
+        elif isinstance(o, np.generic):
+            return o.item()
+        else:
+            return json.JSONEncoder.default(self, o)
+
+
+def customLoader(d):
+    '''This function supports the deserialization of the custom types defined
+       above.'''
+    if '__type__' in d:
+        if d['__type__'] == 'cv2.KeyPoint':
+            k = cv2.KeyPoint()
+            k.pt = (float(d['point'][0]), float(d['point'][1]))
+            k.size = float(d['size'])
+            k.angle = float(d['angle'])
+            k.response = float(d['response'])
+            k.octave = int(d['octave'])
+            k.class_id = int(d['class_id'])
+            return k
+        elif d['__type__'] == 'cv2.DMatch':
+            dm = cv2.DMatch()
+            dm.distance = float(d['distance'])
+            dm.trainIdx = int(d['trainIdx'])
+            dm.queryIdx = int(d['queryIdx'])
+            dm.imgIdx = int(d['imgIdx'])
+            return dm
+        elif d['__type__'] == 'numpy.ndarray':
+            arr = np.array(d['__array__'], dtype=np.float64)
+            return arr.reshape(tuple([int(x) for x in d['__shape__']]))
+        else:
+            return d
+    else:
+        return d
+
+
+def packKeyPoints(keypoints):
+    packed = np.empty(len(keypoints), KEYPOINT_DTYPE)
+    packed['pt'] = [k.pt for k in keypoints]
+    packed['size'] = [k.size for k in keypoints]
+    packed['angle'] = [k.angle for k in keypoints]
+    packed['response'] = [k.response for k in keypoints]
+    packed['octave'] = [k.octave for k in keypoints]
+    packed['class_id'] = [k.class_id for k in keypoints]
+    return packed
+
+
+def unpackKeyPoints(packed):
+    return [cv2.KeyPoint(float(x), float(y), float(size), float(angle),
+                         float(response), int(octave), int(classId))
+            for (x, y), size, angle, response, octave, classId in packed.tolist()]
+
+
+def packMatches(matches):
+    packed = np.empty(len(matches), DMATCH_DTYPE)
+    packed['queryIdx'] = [m.queryIdx for m in matches]
+    packed['trainIdx'] = [m.trainIdx for m in matches]
+    packed['imgIdx'] = [m.imgIdx for m in matches]
+    packed['distance'] = [m.distance for m in matches]
+    return packed
+
+
+def unpackMatches(packed):
+    return [cv2.DMatch(int(queryIdx), int(trainIdx), int(imgIdx), float(distance))
+            for queryIdx, trainIdx, imgIdx, distance in packed.tolist()]
+
+
+def _listType(value):
+    if value and all(isinstance(v, cv2.KeyPoint) for v in value):
+        return 'cv2.KeyPoint[]'
+    if value and all(isinstance(v, cv2.DMatch) for v in value):
+        return 'cv2.DMatch[]'
+    return None
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class _Writer(object):
+    '''Replaces the arrays in an object by buffer references and collects
+       them with their offsets relative to the end of the header.'''
+
+    def __init__(self):
+        self.buffers = []
+        self.size = 0
+
+    def buffer(self, array):
+        array = np.ascontiguousarray(array)
+        offset = _align(self.size)
+        self.buffers.append((offset, array))
+        self.size = offset + array.nbytes
+        return {'__type__': 'buffer',
+                'dtype': np.lib.format.dtype_to_descr(array.dtype),
+                'shape': list(array.shape),
+                'offset': offset}
+
+    def convert(self, value):
+        if isinstance(value, np.ndarray):
+            return self.buffer(value)
+        if isinstance(value, dict):
+            return {key: self.convert(v) for key, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            listType = _listType(value)
+            if listType == 'cv2.KeyPoint[]':
+                return {'__type__': listType, 'data': self.buffer(packKeyPoints(value))}
+            if listType == 'cv2.DMatch[]':
+                return {'__type__': listType, 'data': self.buffer(packMatches(value))}
+            return [self.convert(v) for v in value]
+        return value
+
+
+def dump(filepath, obj):
+    '''Writes obj to filepath in the binary container format, or as JSON
+       like earlier versions if the file name ends in .json.'''
+    if filepath.lower().endswith('.json'):
+        with open(filepath, 'w') as f:
+            f.write(CustomJSONEncoder().encode(obj))
+        return
+    writer = _Writer()
+    header = CustomJSONEncoder(indent=None).encode(writer.convert(obj)).encode('utf-8')
+    # Buffers are aligned in the file, not just relative to each other
+    start = _align(len(MAGIC) + 8 + len(header))
+    header += b' ' * (start - len(MAGIC) - 8 - len(header))
+    with open(filepath, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).astype('<u8').tobytes())
+        f.write(header)
+        for offset, array in writer.buffers:
+            f.write(b'\0' * (start + offset - f.tell()))
+            f.write(memoryview(array.reshape(-1).view(np.uint8)))
+
+
+def _readArray(filepath, reference, start, mmap):
+    dtype = np.lib.format.descr_to_dtype(reference['dtype'])
+    shape = tuple(reference['shape'])
+    offset = start + reference['offset']
+    count = int(np.prod(shape))
+    if mmap and count:
+        return np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=shape)
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        return np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+
+def _restore(value, filepath, start, mmap, raw):
+    if isinstance(value, list):
+        return [_restore(v, filepath, start, mmap, raw) for v in value]
+    if not isinstance(value, dict):
+        return value
+    kind = value.get('__type__')
+    if kind == 'buffer':
+        return _readArray(filepath, value, start, mmap)
+    if kind in ('cv2.KeyPoint[]', 'cv2.DMatch[]'):
+        packed = _readArray(filepath, value['data'], start, mmap)
+        if raw:
+            return packed
+        if kind == 'cv2.KeyPoint[]':
+            return unpackKeyPoints(packed)
+        return unpackMatches(packed)
+    return customLoader({key: _restore(v, filepath, start, mmap, raw)
+                         for key, v in value.items()})
+
+
+def load(filepath, mmap=True, raw=False):
+    '''Loads a file written by dump, or a JSON file written by earlier
+       versions.
+
+       With mmap, arrays are read-only memory maps of the file. With raw,
+       lists of keypoints and matches are returned as the structured arrays
+       they are stored as (see KEYPOINT_DTYPE and DMATCH_DTYPE) instead of
+       being converted back to OpenCV objects.'''
+    with open(filepath, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            f.seek(0)
+            return json.loads(f.read().decode('utf-8'), object_hook=customLoader)
+        length = int(np.frombuffer(f.read(8), '<u8')[0])
+        header = json.loads(f.read(length).decode('utf-8'))
+    start = len(MAGIC) + 8 + length
+    return _restore(header, filepath, start, mmap, raw)
@@ -0,0 +1,178 @@
+'''Convolution engine used for every filter the editor applies.
+
+   convolve() computes the same thing as cv2.filter2D(image, -1, kernel) for
+   kernels of any size, choosing between three strategies:
+   - direct: cv2.filter2D itself, fastest for small kernels,
+   - separable: kernels of rank one (box, Gaussian, Sobel, ...) are split
+     into a column and a row vector with a singular value decomposition and
+     applied as two 1-D passes, which costs h + w instead of h * w
+     multiplications per pixel,
+   - fft: large kernels that are not separable are multiplied in the
+     frequency domain, whose cost does not depend on the kernel size.
+
+   The image is split into bands of rows that are filtered on a thread pool
+   (OpenCV releases the GIL). Every band is read with a halo as
+   tall as the kernel, so the bands join without seams.
+
+   The direct strategy gives exactly the result of filter2D for kernels up
+   to about 9x9 (above that filter2D's own DFT depends on the block it is
+   given); the other strategies round their floating point sums differently
+   and can differ from it by one level.'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+DIRECT = 'direct'
+SEPARABLE = 'separable'
+FFT = 'fft'
+AUTO = 'auto'
+STRATEGIES = [DIRECT, SEPARABLE, FFT]
+
+# Non-separable kernels with a side at least this long use the FFT. (For
+# somewhat smaller ones filter2D already switches to a DFT internally, but
+# only on the whole image at once.)
+FFT_SIZE = 25
+# Smallest side of the tiles the FFT transforms
+MIN_DFT_SIZE = 128
+# Separable kernels with more elements than this are run as two passes
+SEPARABLE_SIZE = 9
+# Bands are never shorter than this, so small images are filtered in one go
+MIN_BAND_ROWS = 128
+# Threads filtering bands in parallel, None for one per core
+WORKERS = None
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(os.cpu_count() or 1,
+                                       thread_name_prefix='convolution')
+        return _pool
+
+
+def separate(kernel, tolerance=1e-6):
+    '''Returns (column, row) with np.outer(column, row) == kernel, or None if
+       the kernel is not separable.'''
+    u, s, vt = np.linalg.svd(kernel)
+    if s[0] == 0:
+        return np.zeros(kernel.shape[0]), np.zeros(kernel.shape[1])
+    if s[1:].sum() > tolerance * s[0]:
+        return None
+    scale = np.sqrt(s[0])
+    return u[:, 0] * scale, vt[0] * scale
+
+
+def chooseStrategy(kernel):
+    height, width = kernel.shape
+    if height * width > SEPARABLE_SIZE and separate(kernel) is not None:
+        return SEPARABLE
+    if max(height, width) >= FFT_SIZE:
+        return FFT
+    return DIRECT
+
+
+def _direct(block, kernel):
+    return cv2.filter2D(block, -1, kernel)
+
+
+def _separable(block, kernel):
+    column, row = separate(kernel)
+    return cv2.sepFilter2D(block, -1, row, column)
+
+
+def _fft(block, kernel):
+    '''Correlates block with kernel in the frequency domain, with the same
+       anchor and border handling as cv2.filter2D.
+
+       The image is cut into tiles a few times the size of the kernel that
+       are transformed separately (overlap-save), which is much faster than
+       one transform of the whole image.'''
+    kernelHeight, kernelWidth = kernel.shape
+    top, left = kernelHeight // 2, kernelWidth // 2
+    padded = cv2.copyMakeBorder(block, top, kernelHeight - 1 - top,
+                                left, kernelWidth - 1 - left, cv2.BORDER_REFLECT_101)
+    height, width = block.shape[:2]
+    size = (min(cv2.getOptimalDFTSize(max(MIN_DFT_SIZE, 4 * kernelHeight)),
+                cv2.getOptimalDFTSize(padded.shape[0])),
+            min(cv2.getOptimalDFTSize(max(MIN_DFT_SIZE, 4 * kernelWidth)),
+                cv2.getOptimalDFTSize(padded.shape[1])))
+    # Output pixels each tile yields. The circular wrap of the transform
+    # only reaches the first kernel size - 1 rows and columns, which are
+    # cut away.
+    tileHeight = size[0] - kernelHeight + 1
+    tileWidth = size[1] - kernelWidth + 1
+
+    flipped = np.zeros(size, np.float32)
+    flipped[:kernelHeight, :kernelWidth] = kernel[::-1, ::-1]
+    spectrum = cv2.dft(flipped, nonzeroRows=kernelHeight)
+    channels = cv2.split(padded)
+    out = np.empty((len(channels), height, width), np.float32)
+    signal = np.empty(size, np.float32)
+    for y0 in range(0, height, tileHeight):
+        y1 = min(y0 + tileHeight, height)
+        for x0 in range(0, width, tileWidth):
+            x1 = min(x0 + tileWidth, width)
+            for c, channel in enumerate(channels):
+                tile = channel[y0:y1 + kernelHeight - 1, x0:x1 + kernelWidth - 1]
+                signal.fill(0)
+                signal[:tile.shape[0], :tile.shape[1]] = tile
+                product = cv2.mulSpectrums(cv2.dft(signal, nonzeroRows=tile.shape[0]),
+                                           spectrum, 0)
+                result = cv2.idft(product, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+                out[c, y0:y1, x0:x1] = result[kernelHeight - 1:kernelHeight - 1 + y1 - y0,
+                                              kernelWidth - 1:kernelWidth - 1 + x1 - x0]
+    result = out[0] if block.ndim == 2 else cv2.merge(list(out))
+    if np.issubdtype(block.dtype, np.integer):
+        info = np.iinfo(block.dtype)
+        result = np.clip(np.rint(result), info.min, info.max)
+    return result.astype(block.dtype)
+
+
+FILTERS = {DIRECT: _direct, SEPARABLE: _separable, FFT: _fft}
+
+
+def convolve(image, kernel, strategy=AUTO, workers=None, job=None):
+    '''cv2.filter2D(image, -1, kernel) using the given strategy, split into
+       bands of rows filtered by up to workers threads. With a job (see
+       jobs.py) the progress is reported after every band and the
+       remaining bands are dropped when it is cancelled.'''
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if strategy == AUTO:
+        strategy = chooseStrategy(kernel)
+    if strategy == SEPARABLE and separate(kernel) is None:
+        raise ValueError('The kernel is not separable')
+    filterBlock = FILTERS[strategy]
+
+    height = image.shape[0]
+    workers = workers or WORKERS or os.cpu_count() or 1
+    # Keep bands tall compared to the kernel so the halos stay cheap
+    bandRows = max(MIN_BAND_ROWS, 4 * kernel.shape[0])
+    bands = max(1, min(workers, height // bandRows))
+    if bands == 1:
+        if job is not None:
+            job.checkCancelled()
+        return filterBlock(image, kernel)
+
+    top = kernel.shape[0] // 2
+    bottom = kernel.shape[0] - 1 - top
+    out = np.empty(image.shape, image.dtype)
+
+    def filterBand(rows):
+        y0, y1 = rows
+        # Where the halo is clipped the band edge is the image edge, so the
+        # border is handled the same as for the whole image
+        by0, by1 = max(0, y0 - top), min(height, y1 + bottom)
+        out[y0:y1] = filterBlock(image[by0:by1], kernel)[y0 - by0:y1 - by0]
+
+    edges = np.linspace(0, height, bands + 1).astype(int)
+    # Leaving the loop early cancels the bands that haven't started
+    for done, _ in enumerate(_executor().map(filterBand, zip(edges[:-1], edges[1:]))):
+        if job is not None:
+            job.progress((done + 1) / float(bands))
+    return out
@@ -0,0 +1,139 @@
+'''Helpers for drawing large images on a canvas quickly.
+
+   ImagePyramid keeps successively halved copies of an image (mipmaps), so a
+   display-sized version can be produced by resizing the smallest level that
+   is still at least as big as the target instead of the full resolution
+   original.'''
+import time
+from collections import OrderedDict
+import cv2
+import metrics
+import tiles
+
+FAST = 'fast'
+QUALITY = 'quality'
+
+INTERPOLATION = {FAST: cv2.INTER_LINEAR, QUALITY: cv2.INTER_LANCZOS4}
+
+# Don't build levels smaller than this, the canvas is never that small
+MIN_LEVEL_SIZE = 64
+
+# Time a live preview may take, in seconds, so it keeps up with typing
+LIVE_BUDGET = 0.016
+
+
+def fitSize(width, height, maxWidth, maxHeight):
+    '''Returns the size the image should be drawn at to fit in the given
+       space. Images are only ever shrunk, never enlarged.'''
+    if height == 0 or width == 0:
+        return width, height
+    ratio = width / float(height)
+    if maxHeight < height:
+        height = maxHeight
+        width = int(ratio * height)
+    if maxWidth < width:
+        width = maxWidth
+        height = int(width / ratio)
+    return max(width, 1), max(height, 1)
+
+
+class ImagePyramid(object):
+    '''Lazily built mipmaps of an image. Level 0 is the image itself and
+       every following level is half the size of the previous one.'''
+
+    def __init__(self, image):
+        self.levels = [image]
+
+    @property
+    def image(self):
+        return self.levels[0]
+
+    def level(self, index):
+        while len(self.levels) <= index:
+            previous = self.levels[-1]
+            height, width = previous.shape[:2]
+            if min(width, height) // 2 < MIN_LEVEL_SIZE:
+                return previous
+            if tiles.isTiled(previous):
+                # Jump straight to an in-memory proxy of memory-mapped images
+                self.levels.append(tiles.proxy(previous)[0])
+                continue
+            self.levels.append(cv2.resize(previous, (width // 2, height // 2),
+                                          interpolation=cv2.INTER_AREA))
+        return self.levels[index]
+
+    def levelFor(self, width, height):
+        '''Returns the smallest level that is at least width x height.'''
+        index = 0
+        best = self.levels[0]
+        while True:
+            candidate = self.level(index + 1)
+            if candidate is best or candidate.shape[1] < width or \
+               candidate.shape[0] < height:
+                return best
+            best = candidate
+            index += 1
+
+    @metrics.timed('display_resize')
+    def resize(self, width, height, quality=QUALITY):
+        source = self.levelFor(width, height)
+        if source.shape[1] == width and source.shape[0] == height:
+            return source
+        return cv2.resize(source, (width, height),
+                          interpolation=INTERPOLATION[quality])
+
+
+class DisplayCache(object):
+    '''A small least recently used cache of rendered images keyed on the
+       target size and quality.'''
+
+    def __init__(self, size=8, name='display'):
+        self.size = size
+        self.name = name
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            metrics.increment(self.name + '_cache_hits')
+        else:
+            metrics.increment(self.name + '_cache_misses')
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class LivePreview(object):
+    '''Applies a filter to a display sized image fast enough to follow
+       typing. Whenever filtering takes longer than the budget, the next
+       preview is filtered at half the resolution and scaled back up, and
+       when it is much faster the resolution goes back up again.'''
+
+    def __init__(self, budget=LIVE_BUDGET):
+        self.budget = budget
+        self.pyramid = None
+        self.index = 0
+
+    def render(self, image, function):
+        if self.pyramid is None or self.pyramid.image is not image:
+            self.pyramid = ImagePyramid(image)
+        start = time.perf_counter()
+        level = self.pyramid.level(self.index)
+        result = function(level)
+        if level is not image:
+            result = cv2.resize(result, (image.shape[1], image.shape[0]),
+                                interpolation=cv2.INTER_LINEAR)
+        elapsed = time.perf_counter() - start
+        if elapsed > self.budget and self.pyramid.level(self.index + 1) is not level:
+            self.index += 1
+        elif elapsed < self.budget / 4 and self.index > 0:
+            self.index -= 1
+        return result
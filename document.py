@@ -0,0 +1,109 @@
+'''The image being edited, shared by every tab of the editor.
+
+   A Document holds one graph.EditGraph and its history. The source pixels
+   are decoded once and are read-only; every edit only adds an operation, so
+   a new version of the document shares the pixels and the operations of
+   the previous one instead of copying them. The arrays are freed by
+   reference counting once neither the document nor a snapshot taken from
+   it refers to them any more.
+
+   Tabs register an observer and are told when the document is opened,
+   edited or closed, so switching tabs shows the current version without
+   loading or copying anything. Nothing here touches Tk.'''
+import graph
+import history
+
+
+class Snapshot(object):
+    '''A version of the document that later edits don't change, for work
+       done on a worker thread (rendering at full resolution, saving, the
+       background removal model).'''
+
+    def __init__(self, edits, version):
+        self.graph = edits
+        self.ops = list(edits.ops)
+        self.version = version
+
+    def render(self, job=None):
+        return self.graph.render(self.ops, job)
+
+    def plan(self):
+        return self.graph.plan(self.ops)
+
+    def shape(self):
+        return self.graph.shape(self.ops)
+
+    def sourceKey(self):
+        return self.graph.sourceKey()
+
+
+class Document(object):
+    '''The shared image, its edits and their history.
+
+       Observers are called as observer(event, document) with event one of
+       'opened', 'closed', 'edited', 'undone', 'redone', or 'status' with
+       the status text as document.statusText.'''
+
+    def __init__(self, memoryBudget=history.MEMORY_BUDGET):
+        self.graph = None
+        self.filename = None
+        self.history = history.History(memoryBudget)
+        self.version = 0
+        self.statusText = ''
+        self.observers = []
+
+    def observe(self, observer):
+        self.observers.append(observer)
+
+    def unobserve(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def notify(self, event):
+        if event != 'status':
+            self.version += 1
+        for observer in list(self.observers):
+            observer(event, self)
+
+    def report(self, text):
+        '''Shows a status message in every tab.'''
+        self.statusText = text
+        self.notify('status')
+
+    def open(self, image, filename=None):
+        '''Replaces the document by a newly loaded image.'''
+        self.history.clear()
+        self.graph = graph.EditGraph(image)
+        self.filename = filename
+        self.notify('opened')
+
+    def close(self):
+        self.history.clear()
+        self.graph = None
+        self.filename = None
+        self.notify('closed')
+
+    def push(self, op):
+        self.graph.push(op)
+        self.history.push(history.Edit(op))
+        self.notify('edited')
+
+    def undo(self):
+        if self.graph is not None and self.history.canUndo():
+            self.history.undo(self.graph)
+            self.notify('undone')
+
+    def redo(self):
+        if self.graph is not None and self.history.canRedo():
+            self.history.redo(self.graph)
+            self.notify('redone')
+
+    def snapshot(self):
+        return Snapshot(self.graph, self.version)
+
+
+def documentFor(root):
+    '''Returns the document shared by every frame of the window.'''
+    if getattr(root, 'imageDocument', None) is None:
+        root.imageDocument = Document()
+    return root.imageDocument
@@ -0,0 +1,228 @@
+'''Encoding and saving of finished images.
+
+   exportImage() writes the full size result and, optionally, thumbnails of
+   it (e.g. 1024 and 256 pixels on the longest side). The thumbnails are
+   shrunk from the image that was already rendered, each one from the next
+   larger size, so nothing is decoded or rendered twice. The sizes are
+   encoded in parallel on a thread pool (OpenCV releases the GIL while
+   encoding).
+
+   Every file is encoded in memory and written to a temporary file next to
+   its destination, which is then renamed over it, so a crash or a reader
+   never sees a partial file.
+
+   ExportSettings holds the encoder settings: the quality of JPEG and WebP,
+   the compression level of PNG and lossless WebP. For images with an alpha
+   channel (a removed background) PNG at a low compression level is the
+   fast lossless format; lossless WebP is smaller but slower to encode.'''
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import cv2
+import metrics
+import tiles
+
+JPEG_QUALITY = 95
+WEBP_QUALITY = 90
+# 0 (none) to 9 (smallest, slowest). 1 is OpenCV's default, and much faster
+# than the higher levels for little difference in size
+PNG_COMPRESSION = 1
+# Thumbnails are named <name>_<side><extension>
+THUMBNAIL_NAME = '%s_%d%s'
+# Threads encoding in parallel, None for one per core
+WORKERS = None
+
+# extension -> whether the format keeps an alpha channel
+ALPHA = {'.jpg': False, '.jpeg': False, '.png': True, '.webp': True,
+         '.ppm': False, '.bmp': False, '.tif': True, '.tiff': True}
+
+_pool = None
+_poolLock = threading.Lock()
+_umask = None
+_umaskLock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(os.cpu_count() or 1, thread_name_prefix='export')
+        return _pool
+
+
+def _currentUmask():
+    '''The process umask, read once. Linux reports it in /proc; elsewhere
+       it can only be read by setting it, which is done under the lock and
+       undone at once.'''
+    global _umask
+    with _umaskLock:
+        if _umask is None:
+            try:
+                with open('/proc/self/status') as f:
+                    for line in f:
+                        if line.startswith('Umask:'):
+                            _umask = int(line.split()[1], 8)
+            except (OSError, ValueError):
+                pass
+            if _umask is None:
+                _umask = os.umask(0)
+                os.umask(_umask)
+        return _umask
+
+
+class ExportSettings(object):
+    '''Encoder settings for every format. quality (0-100) is used by JPEG and
+       WebP, None meaning the default of the format; compression (0-9) by
+       PNG. With lossless, WebP keeps the exact pixels. thumbnails lists the
+       longest sides of the thumbnails written next to the image.
+
+       Only holds plain values, so it can be sent to worker processes.'''
+
+    def __init__(self, quality=None, compression=PNG_COMPRESSION, lossless=False,
+                 thumbnails=()):
+        self.quality = quality
+        self.compression = compression
+        self.lossless = lossless
+        self.thumbnails = sorted(set(int(side) for side in thumbnails), reverse=True)
+
+    @classmethod
+    def fromSpec(cls, spec):
+        '''Builds the settings from the "save" part of a pipeline spec, e.g.
+           {"quality": 90, "compression": 3, "lossless": false,
+            "thumbnails": [1024, 256]}'''
+        return cls(quality=spec.get('quality'),
+                   compression=int(spec.get('compression', PNG_COMPRESSION)),
+                   lossless=bool(spec.get('lossless', False)),
+                   thumbnails=spec.get('thumbnails') or ())
+
+    def params(self, extension):
+        '''The cv2.imencode parameters for a file extension.'''
+        if extension in ('.jpg', '.jpeg'):
+            quality = JPEG_QUALITY if self.quality is None else self.quality
+            return [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        if extension == '.png':
+            return [cv2.IMWRITE_PNG_COMPRESSION, int(self.compression)]
+        if extension == '.webp':
+            # OpenCV encodes losslessly for qualities above 100
+            if self.lossless:
+                return [cv2.IMWRITE_WEBP_QUALITY, 101]
+            quality = WEBP_QUALITY if self.quality is None else self.quality
+            return [cv2.IMWRITE_WEBP_QUALITY, max(1, int(quality))]
+        return []
+
+
+DEFAULT_SETTINGS = ExportSettings()
+
+
+def _extension(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def thumbnailPath(filename, side):
+    base, extension = os.path.splitext(filename)
+    return THUMBNAIL_NAME % (base, side, extension)
+
+
+def _encodable(image, extension):
+    '''Drops the alpha channel for formats without one and expands gray
+       images for PPM, which only stores colour.'''
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    if channels == 4 and not ALPHA.get(extension, True):
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    if channels == 1 and extension == '.ppm':
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return image
+
+
+def encode(image, extension, settings=None):
+    '''Encodes an image into the format of the extension and returns the
+       encoded bytes as a numpy array.'''
+    settings = settings or DEFAULT_SETTINGS
+    extension = extension.lower()
+    with metrics.span('encode'):
+        ok, data = cv2.imencode(extension, _encodable(image, extension),
+                                settings.params(extension))
+    if not ok:
+        raise IOError('Could not encode image as ' + extension)
+    return data
+
+
+@contextmanager
+def atomicPath(filename):
+    '''Yields a temporary path in the directory of filename, with the same
+       extension, which replaces filename once the block succeeds.'''
+    directory = os.path.dirname(os.path.abspath(filename))
+    name = os.path.basename(filename)
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.' + name + '.',
+                                suffix='.tmp' + os.path.splitext(name)[1])
+    os.close(fd)
+    try:
+        yield path
+        # Files created by mkstemp are private, exports get the usual
+        # permissions
+        os.chmod(path, 0o666 & ~_currentUmask())
+        os.replace(path, filename)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def writeBytes(filename, data):
+    '''Writes encoded data atomically.'''
+    with atomicPath(filename) as path:
+        with open(path, 'wb') as f:
+            f.write(memoryview(data))
+    metrics.increment('bytes_written', len(data))
+
+
+def writeImage(filename, image, settings=None):
+    '''Encodes and writes one image atomically. Tiled images are written
+       tile by tile where the format allows it (see tiles.writeImage).'''
+    if tiles.isTiled(image):
+        extension = _extension(filename)
+        params = (settings or DEFAULT_SETTINGS).params(extension)
+        with metrics.span('encode'), atomicPath(filename) as path:
+            tiles.writeImage(path, _encodable(image, extension), params=params)
+    else:
+        writeBytes(filename, encode(image, _extension(filename), settings))
+    return filename
+
+
+def thumbnail(image, side):
+    '''Shrinks the image so its longest side is at most side.'''
+    height, width = image.shape[:2]
+    if max(height, width) <= side:
+        return image
+    if tiles.isTiled(image):
+        # Halve tile by tile first, the rest fits in memory
+        image, _ = tiles.proxy(image, side)
+        height, width = image.shape[:2]
+    scale = side / float(max(height, width))
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+@metrics.timed('export')
+def exportImage(filename, image, settings=None, workers=None):
+    '''Writes the image and the thumbnails requested by settings, encoding
+       them in parallel. Returns the written file names, the full size image
+       first.'''
+    settings = settings or DEFAULT_SETTINGS
+    workers = workers or WORKERS or os.cpu_count() or 1
+    if workers == 1 or not settings.thumbnails:
+        written = [writeImage(filename, image, settings)]
+        for side in settings.thumbnails:
+            image = thumbnail(image, side)
+            written.append(writeImage(thumbnailPath(filename, side), image, settings))
+        return written
+    # The larger sizes encode while the smaller ones are being shrunk, each
+    # from the previous one
+    futures = [_executor().submit(writeImage, filename, image, settings)]
+    for side in settings.thumbnails:
+        image = thumbnail(image, side)
+        futures.append(_executor().submit(writeImage, thumbnailPath(filename, side),
+                                          image, settings))
+    return [future.result() for future in futures]
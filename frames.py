@@ -1,17 +1,19 @@
 import tkinter as tk
 import tkinter.filedialog as tkFileDialog
-import tkinter.messagebox as tkMessageBox
 import tkinter.ttk as ttk
 import os
-import math
-import json
-import numpy as np
-import cv2
-from PIL import Image, ImageTk, ImageDraw
-from rembg import remove
+import importlib.util
 import image_editorUI
-import requests
-from io import BytesIO
+import convolution
+import display
+import document
+import export
+import graph
+import jobs
+import matting
+import metrics
+import operations
+import sessions
 
 BUTTON_WIDTH = 1
 SLIDER_LENGTH = 250
@@ -23,8 +25,23 @@ GREEN = (0, 255, 0)
 RED = (0, 0, 255)
 AQUAMARINE = (212, 255, 127)
 
+# Sizes offered for the convolution matrix
+KERNEL_SIZES = [3, 5, 7, 9, 11]
+# How long to wait after a keystroke before previewing the kernel
+LIVE_PREVIEW_DELAY = 30  # milliseconds
+# How often the metrics overlay is refreshed
+METRICS_REFRESH = 500  # milliseconds
+# How often finished generated images are looked for
+GENERATION_POLL = 50  # milliseconds
+# Most images generated from one prompt at once
+MAX_VARIATIONS = 8
+# How long after the window appears the background removal model starts
+# loading, so it doesn't slow down the first paint. Set
+# IMAGE_EDITOR_NO_WARMUP to only load it on the first Remove Background.
+MODEL_WARMUP_DELAY = 1000  # milliseconds
+
 supportedFiletypes = [('JPEG Image', '*.jpg'), ('PNG Image', '*.png'),
-                      ('PPM Image', '*.ppm')]
+                      ('WebP Image', '*.webp'), ('PPM Image', '*.ppm')]
 
 
 class BaseFrame(tk.Frame):
@@ -47,14 +64,238 @@ class BaseFrame(tk.Frame):
 
         self.imageCanvas = image_editorUI.ImageWidget(self)
 
+        # Slow operations run on worker threads, one job at a time per frame.
+        # Quick previews of an image being opened use a lane of their own,
+        # so they run next to the full resolution decode.
+        self.jobs = jobs.executorFor(root)
+        self.previewLane = (self, 'preview')
+        self.loadingFilename = None
+        # Saving has a lane of its own too, so editing goes on while the
+        # result is encoded
+        self.exportLane = (self, 'export')
+        self.exportSettings = export.ExportSettings()
+        self.jobs.setStatusCallback(self.exportLane, self.setStatus)
+        self.cancelButton = tk.Button(self, text='Cancel', command=self.cancelJobs,
+                                      width=BUTTON_WIDTH)
+        self.cancelButton.grid(row=4, column=5, sticky=tk.E)
+
+        # All tabs show and edit the same image. Jobs that read or change it
+        # share the document's lane, whichever tab started them, and their
+        # progress is shown in every tab.
+        self.document = document.documentFor(root)
+        self.document.observe(self.documentChanged)
+        self.jobs.setStatusCallback(self.document, self.document.report)
+        # Tabs that are not shown are redrawn when they are selected. A tab
+        # built after an image was opened draws it when first shown.
+        self.stale = self.graph is not None
+        self.bind('<Map>', self.frameShown)
+
+        # Every edit is recorded so it can be undone
+        self.undoButton = tk.Button(self, text='Undo', command=self.undo,
+                                    width=BUTTON_WIDTH)
+        self.redoButton = tk.Button(self, text='Redo', command=self.redo,
+                                    width=BUTTON_WIDTH)
+
+        # Timings, cache hits and memory use, toggled with F12 or shown
+        # from the start when IMAGE_EDITOR_METRICS is set
+        self.metricsLabel = tk.Label(self, anchor=tk.W, fg='gray30')
+        self.metricsVisible = False
+        self.metricsJob = None
+        self.root.bind('<F12>', self.toggleMetrics, add='+')
+        if os.environ.get('IMAGE_EDITOR_METRICS'):
+            self.toggleMetrics()
+
         for i in range(6):
             self.grid_columnconfigure(i, weight=1)
 
         self.grid_rowconfigure(3, weight=1)
 
+    @property
+    def graph(self):
+        return self.document.graph
+
+    @property
+    def history(self):
+        return self.document.history
+
     def setStatus(self, text):
         self.status.configure(text=text)
 
+    def documentChanged(self, event, document):
+        if event == 'status':
+            self.setStatus(document.statusText)
+        elif self.winfo_ismapped():
+            self.drawDocument()
+        else:
+            self.stale = True
+
+    def frameShown(self, event):
+        if self.stale:
+            self.stale = False
+            self.drawDocument()
+
+    def drawDocument(self):
+        if self.graph is not None:
+            self.imageCanvas.drawGraph(self.graph)
+        else:
+            self.imageCanvas.clear()
+
+    def toggleMetrics(self, event=None):
+        self.metricsVisible = not self.metricsVisible
+        if self.metricsVisible:
+            metrics.startSampling()
+            self.metricsLabel.grid(row=6, columnspan=6, sticky=tk.W+tk.E)
+            self.refreshMetrics()
+        else:
+            self.metricsLabel.grid_remove()
+
+    def refreshMetrics(self):
+        if self.metricsJob is not None:
+            self.after_cancel(self.metricsJob)
+            self.metricsJob = None
+        if self.metricsVisible:
+            self.metricsLabel.configure(text=metrics.overlayText())
+            self.metricsJob = self.after(METRICS_REFRESH, self.refreshMetrics)
+
+    def cancelJobs(self):
+        self.jobs.cancel(self.document)
+
+    def jobFailed(self, e):
+        self.setStatus('Error: %s' % e)
+        image_editorUI.error(str(e))
+
+    def loadImage(self):
+        filename = tkFileDialog.askopenfilename(parent=self.root,
+                                                filetypes=supportedFiletypes)
+        if filename and os.path.isfile(filename):
+            # A new image replaces whatever was being done to the old one
+            self.jobs.cancel(self.document)
+            self.jobs.cancel(self.previewLane)
+            self.loadingFilename = filename
+            # Show the EXIF thumbnail and then a reduced decode while the
+            # full resolution image is decoded
+            self.jobs.submit(self.previewLane,
+                             lambda job: operations.probeImage(filename),
+                             onDone=lambda probe: self.imageProbed(filename, probe),
+                             onError=lambda e: None, key='probe')
+            self.jobs.submit(self.document, lambda job: operations.loadImage(filename, job),
+                             onDone=lambda image: self.imageLoaded(filename, image),
+                             onError=self.loadFailed, key='load',
+                             message='Loading ' + filename)
+
+    def imageProbed(self, filename, probe):
+        if self.loadingFilename != filename:
+            return
+        self.setStatus('Loading %s (%dx%d)' % ((filename,) + probe['size']))
+        if probe['thumbnail'] is not None:
+            self.showLoadingPreview(probe['thumbnail'])
+        if probe['format'] == 'JPEG':
+            width = self.imageCanvas.winfo_width()
+            height = self.imageCanvas.winfo_height()
+            self.jobs.submit(self.previewLane, lambda job: operations.loadReduced(
+                                 filename, probe['size'], width, height),
+                             onDone=lambda image: self.reducedLoaded(filename, image),
+                             onError=lambda e: None, key='reduced')
+
+    def reducedLoaded(self, filename, image):
+        if self.loadingFilename == filename and image is not None:
+            self.showLoadingPreview(image)
+
+    def showLoadingPreview(self, image):
+        # The old image stays open until the new one is decoded, so that it
+        # and its history are still there if decoding fails
+        self.imageCanvas.drawCVImage(image)
+
+    def loadFailed(self, e):
+        self.loadingFilename = None
+        self.jobs.cancel(self.previewLane)
+        # Show the old image again instead of the preview of the new one
+        self.drawDocument()
+        self.jobFailed(e)
+
+    def imageLoaded(self, filename, image):
+        self.loadingFilename = None
+        self.jobs.cancel(self.previewLane)
+        self.document.open(image, filename)
+        self.setStatus('Loaded ' + filename)
+
+    def reloadImage(self, image):
+        if self.graph is not None:
+            self.document.open(image, self.document.filename)
+
+    def whenIdle(self, function):
+        '''Calls function on the Tk thread once the jobs queued before it
+           have finished, so the graph is never changed while a worker is
+           reading it.'''
+        if self.jobs.isBusy(self.document):
+            self.jobs.submit(self.document, lambda job: None,
+                             onDone=lambda result: function())
+        else:
+            function()
+
+    def applyOp(self, op, status):
+        # An edit made while another image is loading waits for it, and is
+        # dropped rather than applied to the new image
+        edited = self.graph
+        self.whenIdle(lambda: self.graph is edited and self.pushOp(op, status))
+
+    def pushOp(self, op, status):
+        '''Adds an operation to the graph, records it in the history and
+           shows the preview. Nothing is computed at full resolution.'''
+        self.document.push(op)
+        self.setStatus(status)
+
+    def canEdit(self):
+        return True
+
+    def undo(self):
+        if self.history.canUndo() and self.canEdit():
+            self.whenIdle(lambda: self.historyMoved(self.document.undo, 'Undone'))
+
+    def redo(self):
+        if self.history.canRedo() and self.canEdit():
+            self.whenIdle(lambda: self.historyMoved(self.document.redo, 'Redone'))
+
+    def historyMoved(self, move, status):
+        move()
+        self.setStatus(status)
+
+    def askExport(self):
+        '''Asks for a file name and the encoder settings. Returns
+           (filename, settings), or None if either dialog was cancelled.'''
+        filename = tkFileDialog.asksaveasfilename(parent=self.root,
+                                                  filetypes=supportedFiletypes, defaultextension=".png")
+        if not filename:
+            return None
+        settings = image_editorUI.ExportDialog(self.root, filename,
+                                               self.exportSettings).show()
+        if settings is None:
+            return None
+        self.exportSettings = settings
+        return filename, settings
+
+    def exported(self, filenames):
+        if len(filenames) > 1:
+            self.setStatus('Saved image to %s and %d thumbnail(s)'
+                           % (filenames[0], len(filenames) - 1))
+        else:
+            self.setStatus('Saved image to ' + filenames[0])
+
+    def saveGraph(self):
+        if self.graph is not None:
+            chosen = self.askExport()
+            if chosen:
+                filename, settings = chosen
+                # The edits made while saving don't change what is saved
+                snapshot = self.document.snapshot()
+                # The full resolution image is only rendered here
+                self.jobs.submit(self.exportLane, lambda job: operations.writeImage(
+                                     filename, snapshot.render(job), settings),
+                                 onDone=self.exported,
+                                 onError=self.jobFailed, message='Saving')
+        else:
+            image_editorUI.error('Load image before taking a screenshot!')
+
 
 class ImageGenerationFrame(BaseFrame):
     def __init__(self, parent, root):
@@ -69,63 +310,132 @@ class ImageGenerationFrame(BaseFrame):
         self.generateButton.grid(
             row=0, column=0, sticky=tk.W+tk.E)
 
+        # The same prompt and seed always give the same image, the
+        # variations use the following seeds
+        self.seedLabel = tk.Label(self, text='Seed:')
+        self.seedLabel.grid(row=0, column=1, sticky=tk.E)
+        self.seed = tk.Spinbox(self, from_=0, to=2 ** 31 - 1, width=10)
+        self.seed.grid(row=0, column=2, sticky=tk.W)
+        self.variationsLabel = tk.Label(self, text='Variations:')
+        self.variationsLabel.grid(row=0, column=3, sticky=tk.E)
+        self.variations = tk.Spinbox(self, from_=1, to=MAX_VARIATIONS, width=4)
+        self.variations.grid(row=0, column=4, sticky=tk.W)
+
         self.textEntry = tk.Entry(self)  # Create a text entry widget
         # Adjust the row and column as needed
         self.textEntry.grid(rowspan=2, columnspan=6,
                             sticky=tk.N+tk.S+tk.E+tk.W)
+        self.textEntry.bind('<Return>', lambda event: self.generateImage())
 
         self.imageCanvas.grid(row=3, columnspan=6, sticky=tk.N+tk.S+tk.E+tk.W)
 
-        self.status.grid(row=4, columnspan=6, sticky=tk.S)
-
-        self.image = None
+        self.status.grid(row=4, columnspan=5, sticky=tk.S)
+        self.setStatus('Describe the image and press Generate Image')
+
+        # Finished variations are previewed here to pick from, and only the
+        # one opened replaces the image edited in every tab
+        self.variationLabel = tk.Label(self, text='Variation (seed):')
+        self.variationLabel.grid(row=5, column=0, sticky=tk.E)
+        self.variation = tk.StringVar(self, '')
+        self.variationMenu = tk.OptionMenu(self, self.variation, '')
+        self.variationMenu.grid(row=5, column=1, columnspan=2, sticky=tk.W+tk.E)
+        self.openVariationButton = tk.Button(self, text='Open Variation',
+                                             command=self.openVariation,
+                                             width=BUTTON_WIDTH)
+        self.openVariationButton.grid(row=5, column=3, sticky=tk.W+tk.E)
+
+        # Images still being generated, as (seed, future), and the finished
+        # ones by seed
+        self.generating = []
+        self.variationImages = {}
+        self.pollJob = None
 
     def get_text(self):
         return self.textEntry.get()
 
     def generateImage(self):
-        # text = self.get_text()
-        # if (text == ''):
-        #     self.setStatus('Please write a description of the desired image')
-        # else:
-        #     self.setStatus('Generating Image...')
-        #     r = requests.post("https://api.deepai.org/api/text2img",
-        #                       data={
-        #                           'text': text,
-        #                       },
-        #                       headers={
-        #                           'api-key': 'b10bfb39-9d84-45e8-bc89-8f8f57c220e1',
-        #                           'grid_size': "1"}
-        #                       )
-        #     print(r.json())
-        #     response = r.json()
-        #     if 'output_url' in response:
-        #         image_url = response['output_url']
-        #         image_data = requests.get(
-        #             image_url).content  # Fetch the image data
-        #         # Open the image using PIL
-        #         image = Image.open(BytesIO(image_data))
-        #         # # Convert the image to a Tkinter-compatible format
-        #         # photo = ImageTk.PhotoImage(image)
-        #         photo = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        #         # self.imageCanvas.config(image=photo)  # Set the image in the label
-        #         # # Keep a reference to prevent image garbage collection
-        #         # self.imageCanvas.image = photo
-        #         self.imageCanvas.drawCVImage(photo)
-        #         self.setStatus('Image Generated Successfully')
-        #     else:
-        #         self.setStatus('Error Generating Image')
-        self.setStatus('Sorry, our image generation is out of order :()')
+        text = self.get_text().strip()
+        if text == '':
+            self.setStatus('Please write a description of the desired image')
+            return
+        try:
+            seed = int(self.seed.get())
+            count = max(1, min(MAX_VARIATIONS, int(self.variations.get())))
+        except ValueError:
+            self.setStatus('The seed and the number of variations must be numbers')
+            return
+        self.cancelGeneration()
+        self.variationImages = {}
+        self.variationMenu['menu'].delete(0, tk.END)
+        self.variation.set('')
+        # The client batches the variations into one backend request and
+        # answers from its cache when it can; the results are previewed as
+        # they come in
+        # Only imported when first used, so it doesn't delay the window
+        import generation
+        client = generation.defaultClient()
+        self.generating = [(seed + i, client.submit(text, seed=seed + i))
+                           for i in range(count)]
+        self.setStatus('Generating %d image(s)...' % count)
+        self.collectGenerated()
+
+    def collectGenerated(self):
+        self.pollJob = None
+        total = len(self.variationImages) + len(self.generating)
+        for seed, future in [item for item in self.generating if item[1].done()]:
+            self.generating.remove((seed, future))
+            if future.cancelled():
+                continue
+            try:
+                image = future.result()
+            except Exception as e:
+                self.setStatus('Error generating image: %s' % e)
+                continue
+            self.variationImages[seed] = image
+            self.variationMenu['menu'].add_command(
+                label=str(seed), command=lambda seed=seed: self.showVariation(seed))
+            if not self.variation.get():
+                self.showVariation(seed)
+            self.setStatus('Generated image %d of %d, pick one and press Open Variation'
+                           % (len(self.variationImages), total))
+        if self.generating:
+            self.pollJob = self.after(GENERATION_POLL, self.collectGenerated)
+
+    def showVariation(self, seed):
+        self.variation.set(str(seed))
+        self.imageCanvas.drawCVImage(self.variationImages[seed])
+
+    def openVariation(self):
+        if not self.variation.get():
+            self.setStatus('Generate an image first')
+            return
+        seed = int(self.variation.get())
+        image = self.variationImages[seed]
+        # Opened like a loaded image, so it can be edited in every tab.
+        # Edits of the previous image still running are dropped.
+        self.jobs.cancel(self.document)
+        self.whenIdle(lambda: self.document.open(image))
+        self.seed.delete(0, tk.END)
+        self.seed.insert(0, str(seed))
+        self.setStatus('Opened the image of seed %d' % seed)
+
+    def cancelGeneration(self):
+        for _, future in self.generating:
+            future.cancel()
+        self.generating = []
+        if self.pollJob is not None:
+            self.after_cancel(self.pollJob)
+            self.pollJob = None
+
+    def cancelJobs(self):
+        if self.generating:
+            self.cancelGeneration()
+            self.setStatus('Generation cancelled')
+        BaseFrame.cancelJobs(self)
 
     def screenshot(self):
-        if self.image is not None:
-            filename = tkFileDialog.asksaveasfilename(parent=self.root,
-                                                      filetypes=supportedFiletypes, defaultextension=".png")
-            if filename:
-                self.imageCanvas.writeToFile(filename)
-                self.setStatus('Saved image to ' + filename)
-        else:
-            image_editorUI.error('Load image before taking a screenshot!')
+        # Generated images are opened in the shared document like loaded ones
+        self.saveGraph()
 
 
 class ConvolveFrame(BaseFrame):
@@ -145,31 +455,68 @@ class ConvolveFrame(BaseFrame):
 
         self.convolveButton.grid(row=5, column=1, sticky=tk.W+tk.E)
 
+        self.undoButton.grid(row=5, column=2, sticky=tk.W+tk.E)
+        self.redoButton.grid(row=5, column=3, sticky=tk.W+tk.E)
+
         self.imageCanvas.grid(row=3, columnspan=6, sticky=tk.N+tk.S+tk.E+tk.W)
 
-        self.status.grid(row=4, columnspan=6, sticky=tk.S)
+        self.status.grid(row=4, columnspan=5, sticky=tk.S)
 
-        self.image = None
+        self.kernelSize = tk.IntVar(self, KERNEL_SIZES[0])
+        self.kernelSizeMenu = tk.OptionMenu(self, self.kernelSize, *KERNEL_SIZES,
+                                            command=self.buildMatrixEntries)
+        self.kernelSizeMenu.grid(row=0, column=0, sticky=tk.W+tk.E)
 
-        self.matrix_entries = []
+        # The kernel being typed is previewed on the displayed image only,
+        # the full resolution image is filtered when Convolve is pressed.
+        # Set up before the entries, which preview the kernel as soon as
+        # they are built if an image is already open.
+        self.livePreview = display.LivePreview()
+        self.livePreviewJob = None
 
-        for i in range(3):
+        self.matrixFrame = tk.Frame(self)
+        self.matrixFrame.grid(row=0, column=1, rowspan=3, columnspan=3)
+        self.matrix_entries = []
+        self.entrymult = tk.Entry(self)
+        self.entrymult.grid(row=1, column=0, padx=5, pady=5)
+        self.entrymult.bind('<KeyRelease>', self.kernelEdited)
+        self.buildMatrixEntries(KERNEL_SIZES[0])
+
+        # Dragging over the image limits the convolution to a rectangle,
+        # only whose pixels are computed
+        self.imageCanvas.startSelection()
+        self.imageCanvas.bind('<ButtonRelease-1>', self.kernelEdited, add='+')
+        self.wholeImageButton = tk.Button(self, text='Whole Image',
+                                          command=self.selectWholeImage, width=BUTTON_WIDTH)
+        self.wholeImageButton.grid(row=5, column=4, sticky=tk.W+tk.E)
+
+    def buildMatrixEntries(self, size):
+        '''Replaces the entry grid with one of size x size, keeping the
+           values around the centre.'''
+        old = [[entry.get() for entry in row] for row in self.matrix_entries]
+        for row in self.matrix_entries:
+            for entry in row:
+                entry.destroy()
+        offset = (size - len(old)) // 2
+        self.matrix_entries = []
+        for i in range(size):
             row_entries = []
-            for j in range(3):
-                entry = tk.Entry(self)
-                entry.grid(row=i, column=j+1, padx=5, pady=5)
+            for j in range(size):
+                entry = tk.Entry(self.matrixFrame, width=20 if size == 3 else 6)
+                entry.grid(row=i, column=j, padx=5, pady=5)
+                entry.bind('<KeyRelease>', self.kernelEdited)
+                if 0 <= i - offset < len(old) and 0 <= j - offset < len(old):
+                    entry.insert(0, old[i - offset][j - offset])
                 row_entries.append(entry)
             self.matrix_entries.append(row_entries)
+        self.kernelEdited()
 
-        self.entrymult = tk.Entry(self)
-        self.entrymult.grid(row=1, column=0, padx=5, pady=5)
-
-    def applyConvolution(self):
+    def readMatrix(self):
         # Retrieve the entered matrix values
         matrix = []
-        for i in range(3):
+        for i in range(len(self.matrix_entries)):
             row_values = []
-            for j in range(3):
+            for j in range(len(self.matrix_entries)):
                 entry = self.matrix_entries[i][j]
                 try:
                     value = float(entry.get())
@@ -177,56 +524,75 @@ class ConvolveFrame(BaseFrame):
                     value = 0.0
                 row_values.append(value)
             matrix.append(row_values)
+        return matrix
+
+    def kernelEdited(self, event=None):
+        if self.graph is None:
+            return
+        if self.livePreviewJob is not None:
+            self.after_cancel(self.livePreviewJob)
+        self.livePreviewJob = self.after(LIVE_PREVIEW_DELAY, self.showLivePreview)
+
+    def showLivePreview(self):
+        self.livePreviewJob = None
+        if self.graph is None:
+            return
+        if not any(entry.get().strip() for row in self.matrix_entries for entry in row):
+            self.imageCanvas.drawGraph(self.graph)
+            return
+        try:
+            kernel = operations.buildKernel(self.readMatrix(), self.entrymult.get())
+        except ValueError:
+            # The multiplier is still being typed
+            return
+        image = self.graph.preview(self.imageCanvas.winfo_width(),
+                                   self.imageCanvas.winfo_height())
+        rect = self.imageCanvas.selection()
+        if rect is None:
+            function = lambda level: convolution.convolve(level, kernel)
+        else:
+            fullWidth = self.graph.shape()[1]
 
+            def function(level):
+                height, width = level.shape[:2]
+                return operations.convolveRegion(level, kernel, graph.scaleRect(
+                    rect, width / float(fullWidth), width, height))
+        self.imageCanvas.showPreview(self.livePreview.render(image, function))
+        self.setStatus('Previewing kernel, press Convolve to apply it')
+
+    def applyConvolution(self):
+        if self.livePreviewJob is not None:
+            self.after_cancel(self.livePreviewJob)
+            self.livePreviewJob = None
         # Perform the convolution with the entered matrix
-        if self.image is not None:
-            self.convolve(matrix)
+        if self.graph is not None:
+            self.convolve(self.readMatrix())
 
     def convolve(self, matrix):
 
-        kernel = np.array(matrix)
-        kernel = float(self.entrymult.get()) * kernel
-        print(kernel)
+        try:
+            kernel = operations.buildKernel(matrix, self.entrymult.get())
+        except ValueError:
+            image_editorUI.error('The multiplier must be a number')
+            return
 
-        convolved = cv2.filter2D(src=self.image, ddepth=-1, kernel=kernel)
-        self.image = np.copy(convolved)
-        self.imageCanvas.drawCVImage(convolved)
-        self.setStatus('Convolved')
+        rect = self.imageCanvas.selection()
+        self.applyOp(graph.Convolve(kernel, rect),
+                     'Convolved' if rect is None else 'Convolved the selection')
 
-    def loadImage(self):
-        filename = tkFileDialog.askopenfilename(parent=self.root,
-                                                filetypes=supportedFiletypes)
-        if filename and os.path.isfile(filename):
-            self.image = cv2.imread(filename)
-            self.imageCanvas.drawCVImage(self.image)
-            self.setStatus('Loaded ' + filename)
-
-    def reloadImage(self, image):
-        if self.image is not None:
-            self.keypoints = None
-            self.image = image
-            self.imageCanvas.drawCVImage(self.image)
+    def selectWholeImage(self):
+        self.imageCanvas.clearSelection()
+        self.kernelEdited()
 
     def screenshot(self):
-        if self.image is not None:
-            filename = tkFileDialog.asksaveasfilename(parent=self.root,
-                                                      filetypes=supportedFiletypes, defaultextension=".png")
-            if filename:
-                self.imageCanvas.writeToFile(filename)
-                self.setStatus('Saved image to ' + filename)
-        else:
-            image_editorUI.error('Load image before taking a screenshot!')
+        self.saveGraph()
 
 
 class EditImageFrame(BaseFrame):
     def __init__(self, parent, root):
         BaseFrame.__init__(self, parent, root)
 
-        self.start_x, self.start_y = -1, -1
-        self.end_x, self.end_y = -1, -1
         self.cropping = False
-        self.image = None
-        self.image2 = None
 
         self.loadImageButton = tk.Button(self, text='Load Image',
                                          command=self.loadImage, width=BUTTON_WIDTH)
@@ -251,116 +617,150 @@ class EditImageFrame(BaseFrame):
 
         self.rotateButton.grid(row=0, column=3, sticky=tk.W+tk.E)
 
-        self.imageCanvas.grid(row=3, columnspan=6, sticky=tk.N+tk.S+tk.E+tk.W)
+        self.model = tk.StringVar(self, sessions.DEFAULT_MODEL)
+        self.modelMenu = tk.OptionMenu(self, self.model, *sessions.MODELS,
+                                       command=self.selectModel)
+        self.modelMenu.grid(row=0, column=4, sticky=tk.W+tk.E)
 
-        self.status.grid(row=4, columnspan=6, sticky=tk.S)
+        # Trades the resolution the model runs at against speed
+        self.mattingQuality = tk.StringVar(self, matting.DEFAULT_QUALITY)
+        self.mattingMenu = tk.OptionMenu(self, self.mattingQuality, *matting.QUALITY_NAMES)
+        self.mattingMenu.grid(row=1, column=4, sticky=tk.W+tk.E)
 
-        self.image = None
-
-    def loadImage(self):
-        filename = tkFileDialog.askopenfilename(parent=self.root,
-                                                filetypes=supportedFiletypes)
-        if filename and os.path.isfile(filename):
-            self.image = cv2.imread(filename)
-            self.imageCanvas.drawCVImage(self.image)
-            self.setStatus('Loaded ' + filename)
+        self.undoButton.grid(row=1, column=0, sticky=tk.W+tk.E)
+        self.redoButton.grid(row=1, column=1, sticky=tk.W+tk.E)
 
-    def reloadImage(self, image):
-        if self.image is not None:
-            self.keypoints = None
-            self.image = image
-            self.imageCanvas.drawCVImage(self.image)
+        self.imageCanvas.grid(row=3, columnspan=6, sticky=tk.N+tk.S+tk.E+tk.W)
 
-    def screenshot(self):
-        if self.image is not None:
-            filename = tkFileDialog.asksaveasfilename(parent=self.root,
-                                                      filetypes=supportedFiletypes, defaultextension=".png")
-            if filename:
-                self.imageCanvas.writeToFile(filename)
-                self.setStatus('Saved image to ' + filename)
-        else:
-            image_editorUI.error('Load image before taking a screenshot!')
+        self.status.grid(row=4, columnspan=5, sticky=tk.S)
 
-    def computeRemove(self, *args):
-        if self.image is not None:
-            self.setStatus('Clearing Background')
+        # Load the model while the user is picking an image, once the window
+        # is up
+        if not os.environ.get('IMAGE_EDITOR_NO_WARMUP'):
+            self.after(MODEL_WARMUP_DELAY, self.warmUp)
 
-            output = remove(self.image)
+    def loadImage(self):
+        self.finishCrop(False)
+        BaseFrame.loadImage(self)
 
-            self.reloadImage(output)
+    def warmUp(self):
+        # Without rembg the error is shown on the first Remove Background
+        if importlib.util.find_spec('rembg') is not None:
+            sessions.defaultPool().preload(self.model.get())
 
-            self.setStatus('Cleared Background')
+    def selectModel(self, model):
+        sessions.defaultPool().preload(model)
 
-    def crop_image(self, image, start_x, start_y, end_x, end_y):
-        cropped_image = image[start_y:end_y, start_x:end_x]
-        return cropped_image
+    def screenshot(self):
+        self.saveGraph()
 
-    def mouse_callback(self, event, x, y, flags, param):
-        # Access the global variables
+    def computeRemove(self, *args):
+        if self.graph is not None:
+            rect = None
+            if self.cropping:
+                # A rectangle selected with Crop Image limits the removal to
+                # it instead
+                rect = self.imageCanvas.selection()
+                self.finishCrop(False)
+            model = self.model.get()
+            quality = self.mattingQuality.get()
+            # The worker only sees this version, whatever happens to the
+            # document meanwhile
+            snapshot = self.document.snapshot()
+            self.jobs.submit(self.document,
+                             lambda job: self.computeMask(snapshot, model, quality, rect, job),
+                             onDone=lambda mask: self.pushOp(
+                                 graph.Mask(mask, rect), 'Cleared Background'),
+                             onError=self.jobFailed,
+                             key='remove', message='Clearing Background')
+
+    def computeMask(self, snapshot, model, quality, rect=None, job=None):
+        # The model needs the real pixels of the current state; rendering
+        # and the model each report half of the progress
+        image = snapshot.render(jobs.part(job, 0.0, 0.5))
+        passes = snapshot.plan()
+        source = None
+        if not passes and rect is not None:
+            # The selection can reuse the cached mask of the loaded image
+            source = (snapshot.sourceKey(), 0, 0)
+        elif len(passes) == 1 and isinstance(passes[0], graph.GeometryPass) and \
+                passes[0].turns == 0:
+            # A plain crop of the loaded image can reuse the cached mask of
+            # the whole image
+            x0, y0, _, _ = passes[0].rect
+            source = (snapshot.sourceKey(), x0, y0)
+        if rect is not None:
+            return operations.computeMaskRegion(image, rect, model, source, quality,
+                                                job=jobs.part(job, 0.5, 1.0))
+        return operations.computeMask(image, model, source, quality,
+                                      job=jobs.part(job, 0.5, 1.0))
+
+    def documentChanged(self, event, document):
+        if event in ('opened', 'closed'):
+            # A selection on the old image means nothing on the new one
+            self.finishCrop(False)
+        BaseFrame.documentChanged(self, event, document)
+
+    def canEdit(self):
+        return not self.cropping
 
-        if event == cv2.EVENT_LBUTTONDOWN:
-            # Initialize the starting coordinates
-            self.start_x, self.start_y = x, y
-            self.end_x, self.end_y = x, y
-            self.image = np.copy(self.image2)
-            cv2.imshow('Press q to quit, c to crop', self.image)
+    def croppingImage(self):
+        if self.cropping:
+            # Pressed again to apply the selection
+            self.finishCrop(True)
+            return
+        if self.graph is not None:
+            # The rectangle is drawn over the preview, the crop itself is
+            # only a parameter in the graph
             self.cropping = True
+            self.imageCanvas.startSelection()
+            self.imageCanvas.bind('<Return>', lambda event: self.finishCrop(True))
+            self.imageCanvas.bind('<Key-c>', lambda event: self.finishCrop(True))
+            self.imageCanvas.bind('<Escape>', lambda event: self.finishCrop(False))
+            self.imageCanvas.bind('<Key-q>', lambda event: self.finishCrop(False))
+            self.cropButton.configure(text='Apply Crop')
+            self.setStatus('Drag over the image to select, then press Apply Crop '
+                           'or c to crop, Remove Background to remove it in the '
+                           'selection only, q to cancel')
+        else:
+            image_editorUI.error('Load image before cropping!')
 
-        elif event == cv2.EVENT_LBUTTONUP:
-            # Update the ending coordinates and indicate that cropping is finished
-            self.end_x, self.end_y = x, y
-            self.cropping = False
-
-            # Ensure the coordinates are valid (start < end)
-            self.start_x, self.start_y = min(
-                self.start_x, self.end_x), min(self.start_y, self.end_y)
-            self.end_x, self.end_y = max(
-                self.start_x, self.end_x), max(self.start_y, self.end_y)
+    def finishCrop(self, apply):
+        if not self.cropping:
+            return
+        self.cropping = False
+        rect = self.imageCanvas.stopSelection()
+        for sequence in ('<Return>', '<Key-c>', '<Escape>', '<Key-q>'):
+            self.imageCanvas.unbind(sequence)
+        self.cropButton.configure(text='Crop Image')
+        if apply and rect is not None:
+            self.applyOp(graph.Crop(*rect), 'Cropped')
+        else:
+            self.setStatus('Crop cancelled' if not apply else 'Nothing selected')
 
-            self.image = np.copy(self.image2)
+    def rotateImage(self):
+        if self.graph is not None and not self.cropping:
+            self.applyOp(graph.Rotate(1), 'Rotated')
+        elif self.graph is None:
+            image_editorUI.error('Load image before rotating')
 
-            cv2.rectangle(self.image, (self.start_x, self.start_y),
-                          (self.end_x, self.end_y), (0, 255, 0), 2)
 
-            cv2.imshow('Press q to quit, c to crop', self.image)
+class LazyTab(tk.Frame):
+    '''A notebook page whose frame is only built when it is first shown.'''
 
-    def croppingImage(self):
-        if self.image is not None:
-            self.image2 = np.copy(self.image)
-            cv2.namedWindow('Press q to quit, c to crop')
-            cv2.setMouseCallback(
-                'Press q to quit, c to crop', self.mouse_callback)
-
-            while True:
-                cv2.imshow('Press q to quit, c to crop', self.image)
-
-                key = cv2.waitKey(0) & 0xFF
-
-                if key == ord('q'):
-                    self.image = np.copy(self.image2)
-                    break
-
-                if key == ord('c') and not self.cropping:
-                    cropped_image = self.crop_image(
-                        self.image2, self.start_x, self.start_y, self.end_x, self.end_y)
-                    # self.image = np.copy(self.image2)
-                    # cv2.imshow('Cropped Image', cropped_image)
-                    self.image = np.copy(cropped_image)
-                    self.imageCanvas.drawCVImage(cropped_image)
-                    # cv2.waitKey(0)
-                    break
-
-            cv2.destroyAllWindows()
-        else:
-            image_editorUI.error('Load image before cropping!')
+    def __init__(self, parent, root, frameClass):
+        tk.Frame.__init__(self, parent)
+        self.root = root
+        self.frameClass = frameClass
+        self.frame = None
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
 
-    def rotateImage(self):
-        if self.image is not None:
-            rotated = np.copy(cv2.rotate(self.image, cv2.ROTATE_90_CLOCKWISE))
-            self.image = np.copy(rotated)
-            self.imageCanvas.drawCVImage(rotated)
-        else:
-            image_editorUI.error('Load image before rotating')
+    def build(self):
+        if self.frame is None:
+            with metrics.span('build_tab'):
+                self.frame = self.frameClass(self, self.root)
+        return self.frame
 
 
 class ImageEditorFrame(tk.Frame):
@@ -369,28 +769,31 @@ class ImageEditorFrame(tk.Frame):
         self.parent = parent
         self.root = root
         self.notebook = ttk.Notebook(self.parent)
-        # Add Sections and Buttons here that specifies what to do
-        self.ImageEditingFrame = EditImageFrame(
-            self.notebook, root)
-
-        self.notebook.add(self.ImageEditingFrame,
-                          text='Edit Pictures Tab')
-
-        self.ConvolveFrame = ConvolveFrame(self.notebook, root)
+        # Add Sections and Buttons here that specifies what to do. Only the
+        # first tab is built before the window appears, the others when
+        # they are first selected.
+        self.editTab = LazyTab(self.notebook, root, EditImageFrame)
+        self.notebook.add(self.editTab, text='Edit Pictures Tab')
 
-        self.notebook.add(self.ConvolveFrame, text="Colvolve an Image")
+        self.convolveTab = LazyTab(self.notebook, root, ConvolveFrame)
+        self.notebook.add(self.convolveTab, text="Colvolve an Image")
 
-        self.ImageGenerationFrame = ImageGenerationFrame(self.notebook, root)
+        self.generationTab = LazyTab(self.notebook, root, ImageGenerationFrame)
+        self.notebook.add(self.generationTab, text='Generate an Image')
 
-        self.notebook.add(self.ImageGenerationFrame, text='Generate an Image')
+        self.editTab.build()
+        self.notebook.bind('<<NotebookTabChanged>>', self.tabChanged)
 
         self.notebook.grid(row=0, sticky=tk.N+tk.S+tk.E+tk.W)
 
+    def tabChanged(self, event):
+        self.notebook.nametowidget(self.notebook.select()).build()
+
     def CloseWindow(self):
         self.root.quit()
 
 
-if __name__ == '__main__':
+def createWindow():
     root = tk.Tk()
     app = ImageEditorFrame(root, root)
     root.title('Image Editor')
@@ -401,4 +804,9 @@ if __name__ == '__main__':
     root.grid_columnconfigure(0, weight=1)
     root.grid_rowconfigure(0, weight=1)
     # root.wm_attributes('-topmost', 1)
+    return root, app
+
+
+if __name__ == '__main__':
+    root, app = createWindow()
     root.mainloop()
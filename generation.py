@@ -0,0 +1,489 @@
+'''Image generation from text prompts.
+
+   A Backend turns a batch of (prompt, params) requests into images:
+   - ProceduralBackend draws them locally from a hash of the request. It is
+     deterministic and needs no network, so the editor works offline.
+   - HTTPBackend posts them to a generation server. Connections are kept
+     alive in a pool and reused, every request has a timeout, and failed
+     connections, timeouts and 429/5xx answers are retried with exponential
+     backoff.
+   serve() puts any backend behind the HTTP protocol HTTPBackend speaks, as
+   a stand-in server for testing the HTTP path offline:
+       python generation.py --port 8765
+       IMAGE_EDITOR_GENERATOR=http://localhost:8765 python frames.py
+
+   The protocol: POST /generate with
+       {"requests": [{"prompt": "...", "width": 512, "height": 512,
+                      "seed": 0}, ...]}
+   answered with {"images": ["<base64 PNG>", ...]} in the same order.
+
+   GenerationClient returns a Future for every prompt submitted and sends
+   the prompts submitted within BATCH_WAIT seconds of each other to the
+   backend as one batch. Results are kept in a PromptCache on disk, keyed
+   by the backend, the prompt and the parameters, so asking again for the
+   same image doesn't call the backend.'''
+import argparse
+import base64
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import cv2
+import export
+import metrics
+
+DEFAULT_PARAMS = {'width': 512, 'height': 512, 'seed': 0}
+# Prompts sent to the backend in one request at most, and how long the
+# client waits for more prompts before sending a batch
+BATCH_SIZE = 8
+BATCH_WAIT = 0.05  # seconds
+# Batches sent to the backend at the same time
+WORKERS = 2
+# HTTPBackend: seconds to connect and to wait for an answer, attempts after
+# the first one, and the wait before the first retry (doubled every time)
+TIMEOUT = 60.0
+RETRIES = 3
+BACKOFF = 0.5
+# Connections kept open to the server
+CONNECTIONS = 4
+# Answers worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'image_editor', 'generated')
+DISK_CACHE_BYTES = 256 * 1024 * 1024
+
+# Colour words recognised by ProceduralBackend, in BGR
+COLOURS = {'red': (40, 40, 220), 'orange': (30, 140, 250), 'yellow': (40, 220, 240),
+           'green': (60, 180, 60), 'blue': (220, 120, 40), 'purple': (160, 50, 130),
+           'pink': (190, 150, 250), 'white': (245, 245, 245), 'black': (20, 20, 20),
+           'gray': (128, 128, 128), 'brown': (40, 80, 130), 'sky': (235, 206, 135),
+           'sea': (160, 110, 20), 'sunset': (60, 100, 250), 'forest': (40, 100, 30),
+           'night': (60, 30, 20), 'snow': (250, 245, 240), 'sand': (150, 200, 230)}
+
+
+class GenerationError(Exception):
+    '''The backend could not generate an image.'''
+
+
+def requestParams(params=None):
+    '''The parameters of a request with the defaults filled in.'''
+    result = dict(DEFAULT_PARAMS)
+    result.update(params or {})
+    result['width'] = int(result['width'])
+    result['height'] = int(result['height'])
+    result['seed'] = int(result['seed'])
+    return result
+
+
+def encodeImage(image):
+    return base64.b64encode(export.encode(image, '.png').tobytes()).decode('ascii')
+
+
+def decodeImage(text):
+    data = np.frombuffer(base64.b64decode(text), np.uint8)
+    # Servers may send gray or transparent PNGs, the editor expects BGR
+    image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if image is None:
+        raise GenerationError('The server sent an image that could not be decoded')
+    return image
+
+
+class Backend(object):
+    '''Generates images. name identifies the backend in cache keys.'''
+
+    name = 'backend'
+
+    def generate(self, requests):
+        '''Returns one BGR image for every (prompt, params) in requests.'''
+        raise NotImplementedError()
+
+
+class ProceduralBackend(Backend):
+    '''Draws a picture from the prompt without any model: the colour words
+       in it pick the palette, and a random generator seeded from the prompt
+       and the seed places soft shapes on a gradient.'''
+
+    name = 'procedural'
+
+    def generate(self, requests):
+        return [self.draw(prompt, requestParams(params)) for prompt, params in requests]
+
+    def draw(self, prompt, params):
+        width, height = params['width'], params['height']
+        digest = hashlib.blake2b(('%s\0%d' % (prompt, params['seed'])).encode('utf-8'),
+                                 digest_size=8).digest()
+        rng = np.random.default_rng(int.from_bytes(digest, 'little'))
+        words = prompt.lower().split()
+        palette = [COLOURS[word] for word in words if word in COLOURS]
+        while len(palette) < 3:
+            palette.append(tuple(int(c) for c in rng.integers(0, 256, 3)))
+        palette = np.array(palette, np.float32)
+
+        # Vertical gradient between the first two colours
+        t = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis, np.newaxis]
+        image = (palette[0] * (1 - t) + palette[1] * t) * np.ones((1, width, 1), np.float32)
+
+        # One soft shape per word
+        shapes = np.zeros((height, width, 3), np.float32)
+        weight = np.zeros((height, width), np.float32)
+        side = min(width, height)
+        for i in range(max(1, len(words))):
+            colour = palette[2 + i % (len(palette) - 2)].tolist()
+            layer = np.zeros((height, width), np.float32)
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            size = int(side * rng.uniform(0.08, 0.3))
+            if rng.random() < 0.5:
+                cv2.circle(layer, center, size, 1.0, -1, cv2.LINE_AA)
+            else:
+                axes = (size, int(size * rng.uniform(0.3, 1.0)))
+                cv2.ellipse(layer, center, axes, float(rng.uniform(0, 180)), 0, 360,
+                            1.0, -1, cv2.LINE_AA)
+            layer = cv2.GaussianBlur(layer, (0, 0), max(1.0, side / 100.0))
+            shapes += layer[:, :, np.newaxis] * np.array(colour, np.float32)
+            weight += layer
+        alpha = np.minimum(weight, 1.0)[:, :, np.newaxis]
+        shapes /= np.maximum(weight, 1e-6)[:, :, np.newaxis]
+        image = image * (1 - alpha) + shapes * alpha
+
+        # A little grain so it looks less flat
+        image += rng.normal(0, 4, (height, width, 1)).astype(np.float32)
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+
+class ConnectionPool(object):
+    '''Keeps up to size idle keep-alive connections to one server.'''
+
+    def __init__(self, url, size=CONNECTIONS, timeout=TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            connection = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            return connection(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HTTPBackend(Backend):
+    '''Sends the requests to a generation server, see the protocol above.'''
+
+    def __init__(self, url, timeout=TIMEOUT, retries=RETRIES, connections=CONNECTIONS):
+        self.name = url.rstrip('/')
+        self.path = urllib.parse.urlsplit(self.name).path + '/generate'
+        self.retries = retries
+        self.pool = ConnectionPool(url, connections, timeout)
+
+    def generate(self, requests):
+        body = json.dumps({'requests': [dict(requestParams(params), prompt=prompt)
+                                        for prompt, params in requests]}).encode('utf-8')
+        answer = self.post(body)
+        images = answer.get('images')
+        if not isinstance(images, list) or len(images) != len(requests):
+            raise GenerationError('The server answered %d images for %d prompts'
+                                  % (len(images or ()), len(requests)))
+        return [decodeImage(image) for image in images]
+
+    def post(self, body):
+        '''Posts body and returns the decoded JSON answer, retrying failed
+           connections and temporary errors.'''
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(error[1] if error[1] is not None else BACKOFF * 2 ** (attempt - 1))
+                metrics.increment('generation_retries')
+            connection = self.pool.get()
+            try:
+                connection.request('POST', self.path, body,
+                                   {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # Dropped keep-alive connections end up here too
+                connection.close()
+                error = ('Could not reach %s: %s' % (self.name, e), None)
+                continue
+            if response.status == 200:
+                self.pool.put(connection)
+                try:
+                    return json.loads(data.decode('utf-8'))
+                except ValueError:
+                    raise GenerationError('The server sent an invalid answer')
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(connection)
+            message = 'The server answered %d %s' % (response.status, response.reason)
+            if response.status not in RETRY_STATUSES:
+                raise GenerationError(message)
+            retryAfter = response.getheader('Retry-After')
+            error = (message, float(retryAfter) if retryAfter and
+                     retryAfter.isdigit() else None)
+        raise GenerationError(error[0])
+
+
+class PromptCache(object):
+    '''Generated images as PNG files in a directory, bounded by a number of
+       bytes; the least recently used images are evicted first.'''
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, diskBytes=DISK_CACHE_BYTES):
+        self.directory = directory
+        self.diskBytes = diskBytes
+        self.diskUsed = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(backend, prompt, params):
+        text = json.dumps({'backend': backend, 'prompt': prompt,
+                           'params': requestParams(params)}, sort_keys=True)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def get(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        image = cv2.imread(path, cv2.IMREAD_COLOR) if os.path.exists(path) else None
+        if image is None:
+            metrics.increment('generation_cache_misses')
+            return None
+        try:
+            os.utime(path)  # mark as recently used for eviction
+        except OSError:
+            pass
+        metrics.increment('generation_cache_hits')
+        return image
+
+    def put(self, key, image):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = export.writeImage(self._path(key), image)
+        with self.lock:
+            if self.diskUsed is None:
+                self.diskUsed = sum(entry.stat().st_size
+                                    for entry in os.scandir(self.directory)
+                                    if entry.name.endswith('.png'))
+            else:
+                self.diskUsed += os.path.getsize(path)
+            if self.diskUsed > self.diskBytes:
+                self._evict()
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.name.endswith('.png')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        used = sum(entry.stat().st_size for entry in entries)
+        # Evict down to 90% so we don't rescan the directory on every write
+        for entry in entries:
+            if used <= 0.9 * self.diskBytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                used -= size
+            except OSError:
+                pass
+        self.diskUsed = used
+
+
+class GenerationClient(object):
+    '''Batches prompts for a backend and caches the results. submit() never
+       blocks; the cache is read on a thread of its own and the backend is
+       called on worker threads.'''
+
+    def __init__(self, backend, cache=None, batchSize=BATCH_SIZE, batchWait=BATCH_WAIT,
+                 workers=WORKERS):
+        self.backend = backend
+        self.cache = cache or PromptCache(directory=None)
+        self.batchSize = batchSize
+        self.batchWait = batchWait
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='generate')
+        # Cache hits shouldn't wait for the batches being generated
+        self.lookups = ThreadPoolExecutor(1, thread_name_prefix='generate-cache')
+        self.waiting = queue.Queue()
+        self.dispatcher = None
+        self.lock = threading.Lock()
+
+    def submit(self, prompt, **params):
+        '''Returns a Future of the BGR image for prompt.'''
+        params = requestParams(params)
+        future = Future()
+        key = PromptCache.key(self.backend.name, prompt, params)
+        self.lookups.submit(self._lookup, key, prompt, params, future)
+        return future
+
+    def _lookup(self, key, prompt, params, future):
+        if future.cancelled():
+            return
+        try:
+            cached = self.cache.get(key)
+        except Exception as e:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+            return
+        if cached is not None:
+            if future.set_running_or_notify_cancel():
+                future.set_result(cached)
+            return
+        with self.lock:
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self._dispatch, daemon=True,
+                                                   name='generate-batches')
+                self.dispatcher.start()
+        self.waiting.put((key, prompt, params, future))
+
+    def generate(self, prompt, **params):
+        return self.submit(prompt, **params).result()
+
+    def _dispatch(self):
+        while True:
+            batch = [self.waiting.get()]
+            deadline = time.monotonic() + self.batchWait
+            while len(batch) < self.batchSize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.waiting.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Drop the cancelled ones, the others can't be cancelled any more
+            batch = [request for request in batch
+                     if request[3].set_running_or_notify_cancel()]
+            if batch:
+                self.pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        # The same request twice in a batch is only generated once
+        unique = {}
+        for key, prompt, params, future in batch:
+            unique.setdefault(key, (prompt, params, []))[2].append(future)
+        try:
+            with metrics.span('generate'):
+                images = self.backend.generate([(prompt, params) for prompt, params, _
+                                                in unique.values()])
+            metrics.increment('images_generated', len(images))
+        except Exception as e:
+            for _, _, futures in unique.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for (key, (_, _, futures)), image in zip(unique.items(), images):
+            try:
+                self.cache.put(key, image)
+            except Exception:
+                # A full or read-only disk, or an image that can't be
+                # encoded, only costs the cache
+                pass
+            for future in futures:
+                future.set_result(image)
+
+
+def backendFor(spec=None):
+    '''The backend named by spec or by IMAGE_EDITOR_GENERATOR: "procedural"
+       (the default) or the URL of a generation server.'''
+    spec = spec or os.environ.get('IMAGE_EDITOR_GENERATOR') or ProceduralBackend.name
+    if spec == ProceduralBackend.name:
+        return ProceduralBackend()
+    if spec.startswith(('http://', 'https://')):
+        return HTTPBackend(spec)
+    raise ValueError('Unknown generation backend ' + spec)
+
+
+_client = None
+
+
+def defaultClient():
+    global _client
+    if _client is None:
+        _client = GenerationClient(backendFor(), PromptCache(
+            os.environ.get('IMAGE_EDITOR_GENERATION_CACHE', DEFAULT_CACHE_DIR)))
+    return _client
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, so clients can reuse their connections
+    protocol_version = 'HTTP/1.1'
+    backend = None
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/generate':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            requests = json.loads(self.rfile.read(length).decode('utf-8'))['requests']
+            requests = [(request.pop('prompt'), request) for request in requests]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_error(400, 'Expected {"requests": [{"prompt": ...}, ...]}')
+            return
+        try:
+            images = self.backend.generate(requests)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        body = json.dumps({'images': [encodeImage(image) for image in images]})
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(backend=None, host='127.0.0.1', port=8765):
+    '''Returns an HTTP server answering generation requests with backend.
+       Call serve_forever() on it, or shutdown() to stop it.'''
+    handler = type('Handler', (_Handler,), {'backend': backend or ProceduralBackend()})
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the procedural image '
+                                     'generator over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args(argv)
+    server = serve(host=args.host, port=args.port)
+    print('Serving on http://%s:%d' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
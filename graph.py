@@ -0,0 +1,355 @@
+'''A lazy record of the edits made to an image.
+
+   Edits are appended to an EditGraph as operations and nothing is computed
+   until an image is needed. Previews are evaluated at display resolution
+   from a pyramid of the source, and the full resolution image is only
+   rendered when it is saved or when an operation needs the real pixels.
+
+   Before evaluating, consecutive operations are fused into passes:
+   - any run of crops and rotations becomes a single crop of its input
+     followed by at most one rotation, which is also expressed as one
+     affine transform for previews,
+   - consecutive convolutions are composed into a single kernel when no
+     intermediate value can saturate, the kernels treat the image borders
+     alike, and no later kernel can amplify the rounding of the skipped
+     intermediate images (see composable and bounded). Each
+     skipped image is off by at most half a level and the kernels after it
+     don't make that larger, so the result differs from filtering one
+     kernel at a time by at most half a level per composed kernel, and in
+     practice by one level.'''
+import numpy as np
+import cv2
+import display
+import metrics
+import jobs
+import operations
+import sessions
+
+
+class Crop(object):
+    def __init__(self, x0, y0, x1, y1):
+        self.rect = (x0, y0, x1, y1)
+
+    def __repr__(self):
+        return 'Crop%r' % (self.rect,)
+
+
+class Rotate(object):
+    def __init__(self, turns=1):
+        self.turns = turns % 4
+
+    def __repr__(self):
+        return 'Rotate(%d)' % self.turns
+
+
+class Convolve(object):
+    '''Filters the image, or only the region rect = (x0, y0, x1, y1) of it.'''
+
+    def __init__(self, kernel, rect=None):
+        self.kernel = np.asarray(kernel, dtype=np.float64)
+        self.rect = rect
+
+    def __repr__(self):
+        if self.rect is None:
+            return 'Convolve(%s)' % self.kernel.tolist()
+        return 'Convolve(%s, %r)' % (self.kernel.tolist(), self.rect)
+
+
+class Mask(object):
+    '''Applies an alpha mask, e.g. one computed by background removal. The
+       mask has the size of the image at the point where it is applied, or
+       of the region rect = (x0, y0, x1, y1) of it, outside of which the
+       image stays opaque.'''
+
+    def __init__(self, mask, rect=None):
+        self.arrays = [mask]
+        self.rect = rect
+        self.preview = None
+
+    @property
+    def mask(self):
+        return self.arrays[0]
+
+    def previewMask(self, width, height):
+        if self.preview is None or self.preview.shape != (height, width):
+            self.preview = cv2.resize(self.mask, (width, height),
+                                      interpolation=cv2.INTER_AREA)
+        return self.preview
+
+    def __repr__(self):
+        if self.rect is None:
+            return 'Mask(%dx%d)' % (self.mask.shape[1], self.mask.shape[0])
+        return 'Mask(%dx%d at %r)' % (self.mask.shape[1], self.mask.shape[0], self.rect)
+
+
+def composeKernels(first, second):
+    '''Returns the kernel equivalent to filtering with first and then with
+       second (cv2.filter2D computes a correlation, which composes by full
+       convolution of the kernels).'''
+    h1, w1 = first.shape
+    h2, w2 = second.shape
+    composed = np.zeros((h1 + h2 - 1, w1 + w2 - 1))
+    for i in range(h2):
+        for j in range(w2):
+            composed[i:i + h1, j:j + w1] += second[i, j] * first
+    return composed
+
+
+def bounded(kernel):
+    '''Whether the kernel is non-negative and sums to at most one, so it can
+       never produce a value outside 0..255 nor make an error larger.'''
+    return bool(np.all(kernel >= 0)) and kernel.sum() <= 1 + 1e-9
+
+
+def composable(kernel):
+    '''Filtering 8-bit images clips every intermediate result to 0..255, so
+       kernels can only be composed if they are bounded. They must also
+       have odd sizes so their centres line up, and be mirror symmetric
+       both ways: filter2D reflects the image at its borders, and only
+       such kernels give the same result there whether the reflection is
+       of the source or of the intermediate image.'''
+    return kernel.shape[0] % 2 == 1 and kernel.shape[1] % 2 == 1 and \
+        np.allclose(kernel, kernel[::-1], rtol=0, atol=1e-12) and \
+        np.allclose(kernel, kernel[:, ::-1], rtol=0, atol=1e-12) and bounded(kernel)
+
+
+def scaleRect(rect, scale, width, height):
+    '''Scales a rectangle to an image scaled by scale, of size width x
+       height, keeping it at least one pixel large.'''
+    if scale == 1.0:
+        return rect
+    x0, y0, x1, y1 = [int(round(v * scale)) for v in rect]
+    x0, y0 = min(max(0, x0), width - 1), min(max(0, y0), height - 1)
+    return x0, y0, min(max(x0 + 1, x1), width), min(max(y0 + 1, y1), height)
+
+
+def unrotateRect(rect, turns, width, height):
+    '''Maps a rectangle in an image that was rotated clockwise by turns
+       quarter turns back to the unrotated image of size width x height.'''
+    for done in range(turns, 0, -1):
+        # Height of the image before the turn being undone
+        before = height if (done - 1) % 2 == 0 else width
+        a, b, c, d = rect
+        rect = (b, before - c, d, before - a)
+    return rect
+
+
+class GeometryPass(object):
+    '''A crop of the input to rect followed by turns clockwise rotations.'''
+
+    def __init__(self, width, height):
+        self.rect = (0, 0, width, height)
+        self.turns = 0
+
+    def outputSize(self):
+        x0, y0, x1, y1 = self.rect
+        if self.turns % 2:
+            return y1 - y0, x1 - x0
+        return x1 - x0, y1 - y0
+
+    def crop(self, rect):
+        x0, y0, x1, y1 = self.rect
+        a, b, c, d = unrotateRect(rect, self.turns, x1 - x0, y1 - y0)
+        self.rect = (x0 + a, y0 + b, x0 + c, y0 + d)
+
+    def rotate(self, turns):
+        self.turns = (self.turns + turns) % 4
+
+    def render(self, image, job=None):
+        return operations.rotateImage(operations.cropImage(image, *self.rect),
+                                      self.turns, job)
+
+    def affine(self, inputScale=1.0, outputScale=1.0):
+        '''Returns the 2x3 matrix mapping pixels of the input, scaled by
+           inputScale, to pixels of the output scaled by outputScale.'''
+        def scaling(s):
+            return np.array([[s, 0, 0.5 * s - 0.5], [0, s, 0.5 * s - 0.5], [0, 0, 1]])
+
+        x0, y0, x1, y1 = self.rect
+        matrix = scaling(1.0 / inputScale)
+        matrix = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]]).dot(matrix)
+        height = y1 - y0
+        width = x1 - x0
+        for _ in range(self.turns):
+            matrix = np.array([[0, -1, height - 1], [1, 0, 0], [0, 0, 1]]).dot(matrix)
+            width, height = height, width
+        return scaling(outputScale).dot(matrix)[:2]
+
+
+class KernelPass(object):
+    def __init__(self, kernel, rect=None):
+        self.kernel = kernel
+        self.rect = rect
+
+    def render(self, image, scale=1.0, job=None):
+        if self.rect is None:
+            return operations.convolveImage(image, self.kernel, job=job)
+        rect = scaleRect(self.rect, scale, image.shape[1], image.shape[0])
+        return operations.convolveRegion(image, self.kernel, rect, job=job)
+
+
+class MaskPass(object):
+    def __init__(self, op):
+        self.op = op
+
+    def render(self, image, job=None):
+        if self.op.rect is None:
+            return operations.applyMask(image, self.op.mask, job)
+        return operations.applyMaskRegion(image, self.op.mask, self.op.rect, job)
+
+    def preview(self, image, scale):
+        height, width = image.shape[:2]
+        if self.op.rect is None:
+            return sessions.compositeMask(image, self.op.previewMask(width, height))
+        x0, y0, x1, y1 = rect = scaleRect(self.op.rect, scale, width, height)
+        return operations.applyMaskRegion(image, self.op.previewMask(x1 - x0, y1 - y0),
+                                          rect)
+
+
+class EditGraph(object):
+    '''The source image and the list of operations applied to it.'''
+
+    def __init__(self, source):
+        source.flags.writeable = False
+        self.source = source
+        self.ops = []
+        self.pyramid = display.ImagePyramid(source)
+        self.previewCache = display.DisplayCache(4, 'preview')
+        self.key = None
+
+    def sourceKey(self):
+        '''Hash of the source pixels, computed once.'''
+        if self.key is None:
+            self.key = sessions.imageKey(self.source)
+        return self.key
+
+    def push(self, op):
+        if isinstance(op, Crop) or (isinstance(op, Convolve) and op.rect is not None):
+            op.rect = operations.cropRect(self.shape(), *op.rect)
+        self.ops.append(op)
+        return op
+
+    def pop(self):
+        return self.ops.pop()
+
+    def shape(self, ops=None):
+        '''Returns the shape of the result without rendering anything.'''
+        height, width = self.source.shape[:2]
+        count = 1 if self.source.ndim == 2 else self.source.shape[2]
+        for op in self.ops if ops is None else ops:
+            if isinstance(op, Crop):
+                x0, y0, x1, y1 = op.rect
+                width, height = x1 - x0, y1 - y0
+            elif isinstance(op, Rotate) and op.turns % 2:
+                width, height = height, width
+            elif isinstance(op, Mask):
+                count = 4
+        return (height, width, count)
+
+    def plan(self, ops=None):
+        '''Fuses the operations into as few passes as possible.'''
+        ops = self.ops if ops is None else ops
+        passes = []
+        height, width = self.source.shape[:2]
+        # amplified[i]: a kernel that can amplify the rounding skipped by a
+        # composition comes after ops[i]
+        amplified = [False] * len(ops)
+        for i in range(len(ops) - 2, -1, -1):
+            op = ops[i + 1]
+            amplified[i] = amplified[i + 1] or \
+                (isinstance(op, Convolve) and not bounded(op.kernel))
+        for op, followed in zip(ops, amplified):
+            last = passes[-1] if passes else None
+            if isinstance(op, (Crop, Rotate)):
+                if not isinstance(last, GeometryPass):
+                    last = GeometryPass(width, height)
+                    passes.append(last)
+                if isinstance(op, Crop):
+                    last.crop(op.rect)
+                else:
+                    last.rotate(op.turns)
+                width, height = last.outputSize()
+            elif isinstance(op, Convolve):
+                # Filtering a region twice reads unfiltered pixels around
+                # it the second time, so only whole images are composed
+                if isinstance(last, KernelPass) and last.rect is None and \
+                   op.rect is None and composable(last.kernel) and \
+                   composable(op.kernel) and not followed:
+                    last.kernel = composeKernels(last.kernel, op.kernel)
+                else:
+                    passes.append(KernelPass(op.kernel, op.rect))
+            elif isinstance(op, Mask):
+                passes.append(MaskPass(op))
+        return passes
+
+    @metrics.timed('render')
+    def render(self, ops=None, job=None):
+        '''Renders the full resolution result, reporting the progress to job
+           (see jobs.py) if given.'''
+        image = self.source
+        passes = self.plan(ops)
+        for i, step in enumerate(passes):
+            part = jobs.part(job, i / float(len(passes)), (i + 1) / float(len(passes)))
+            image = step.render(image, job=part)
+        return image
+
+    def preview(self, maxWidth, maxHeight, quality=display.QUALITY):
+        '''Renders the result at the size it is displayed at.'''
+        height, width = self.shape()[:2]
+        if width == 0 or height == 0:
+            return np.zeros((0, 0, 3), np.uint8)
+        displayWidth, displayHeight = display.fitSize(width, height,
+                                                      maxWidth, maxHeight)
+        key = (tuple(self.ops), displayWidth, displayHeight, quality)
+        cached = self.previewCache.get(key)
+        if cached is not None:
+            return cached
+        with metrics.span('preview'):
+            image = self._preview(displayWidth / float(width), quality)
+        self.previewCache.put(key, image)
+        return image
+
+    def _preview(self, scale, quality):
+        passes = self.plan()
+        sourceHeight, sourceWidth = self.source.shape[:2]
+        if passes and isinstance(passes[0], GeometryPass):
+            image = self._previewGeometry(passes.pop(0), scale, quality)
+        else:
+            image = self.pyramid.resize(max(1, int(round(sourceWidth * scale))),
+                                        max(1, int(round(sourceHeight * scale))),
+                                        quality)
+        for step in passes:
+            if isinstance(step, GeometryPass):
+                outWidth, outHeight = step.outputSize()
+                image = cv2.warpAffine(image, step.affine(scale, scale),
+                                       self._scaled(outWidth, outHeight, scale),
+                                       flags=cv2.INTER_LINEAR,
+                                       borderMode=cv2.BORDER_REPLICATE)
+            elif isinstance(step, MaskPass):
+                image = step.preview(image, scale)
+            else:
+                image = step.render(image, scale)
+        return image
+
+    def _scaled(self, width, height, scale):
+        return (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+    def _previewGeometry(self, step, scale, quality):
+        sourceHeight, sourceWidth = self.source.shape[:2]
+        level = self.pyramid.levelFor(int(np.ceil(sourceWidth * scale)),
+                                      int(np.ceil(sourceHeight * scale)))
+        levelScale = level.shape[1] / float(sourceWidth)
+        outWidth, outHeight = step.outputSize()
+        if quality == display.FAST:
+            return cv2.warpAffine(level, step.affine(levelScale, scale),
+                                  self._scaled(outWidth, outHeight, scale),
+                                  flags=cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_REPLICATE)
+        # Cut out the region at the resolution of the pyramid level, then
+        # shrink it with a high quality filter
+        image = cv2.warpAffine(level, step.affine(levelScale, levelScale),
+                               self._scaled(outWidth, outHeight, levelScale),
+                               flags=cv2.INTER_NEAREST,
+                               borderMode=cv2.BORDER_REPLICATE)
+        return cv2.resize(image, self._scaled(outWidth, outHeight, scale),
+                          interpolation=display.INTERPOLATION[quality])
@@ -0,0 +1,152 @@
+'''Undo and redo for the editing frames.
+
+   The frames record their edits as operations in a graph.EditGraph, so the
+   history only has to remember which operations were added. Crops,
+   rotations and convolutions are pure parameter records; background
+   removal also keeps the mask it computed.
+
+   Every record is symmetric: applying it to the graph either removes its
+   operation or adds it back, so the same record moves between the undo
+   and redo stacks.
+
+   When the masks held in memory exceed the budget, the ones furthest from
+   the current state are written to disk and memory mapped, so they are
+   read back transparently when they are needed again.'''
+import atexit
+import os
+import shutil
+import tempfile
+import numpy as np
+import metrics
+
+MEMORY_BUDGET = 512 * 1024 * 1024
+
+
+class Edit(object):
+    '''The addition of one operation to the graph. Its pixel data, e.g.
+       the mask of a background removal, is kept in self.arrays so it can
+       be moved to disk.'''
+
+    def __init__(self, op):
+        self.op = op
+        # Share the list so spilling replaces the arrays the op renders with
+        self.arrays = getattr(op, 'arrays', [])
+        self.paths = []
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays
+                   if not isinstance(array, np.memmap))
+
+    def spill(self, directory):
+        for i, array in enumerate(self.arrays):
+            if isinstance(array, np.memmap):
+                continue
+            fd, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            self.arrays[i] = np.load(path, mmap_mode='r')
+            self.paths.append(path)
+            metrics.increment('bytes_spilled', array.nbytes)
+
+    def discard(self):
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.paths = []
+
+    def apply(self, graph):
+        if graph.ops and graph.ops[-1] is self.op:
+            graph.pop()
+        else:
+            graph.push(self.op)
+        return graph
+
+
+class History(object):
+    '''Undo and redo stacks bounded by a memory budget.'''
+
+    def __init__(self, memoryBudget=MEMORY_BUDGET, directory=None):
+        self.memoryBudget = memoryBudget
+        self.directory = directory
+        self.ownsDirectory = directory is None
+        self.undoStack = []
+        self.redoStack = []
+
+    def canUndo(self):
+        return bool(self.undoStack)
+
+    def canRedo(self):
+        return bool(self.redoStack)
+
+    def push(self, edit):
+        '''Records an edit that has just been made. This clears the redo
+           stack.'''
+        for old in self.redoStack:
+            old.discard()
+        self.redoStack = []
+        self.undoStack.append(edit)
+        self.trim()
+
+    def undo(self, graph):
+        if self.undoStack:
+            edit = self.undoStack.pop()
+            edit.apply(graph)
+            self.redoStack.append(edit)
+            self.trim()
+        return graph
+
+    def redo(self, graph):
+        if self.redoStack:
+            edit = self.redoStack.pop()
+            edit.apply(graph)
+            self.undoStack.append(edit)
+            self.trim()
+        return graph
+
+    def clear(self):
+        for edit in self.undoStack + self.redoStack:
+            edit.discard()
+        self.undoStack = []
+        self.redoStack = []
+
+    @property
+    def nbytes(self):
+        return sum(edit.nbytes for edit in self.undoStack + self.redoStack)
+
+    def _spillDirectory(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='image_editor_history_')
+            atexit.register(self.close)
+        return self.directory
+
+    def trim(self):
+        '''Moves the edits furthest from the current state to disk until
+           the ones in memory fit in the budget.'''
+        used = self.nbytes
+        if used <= self.memoryBudget:
+            return
+        # Interleave the two stacks from the oldest undo and the last redo
+        # towards the current state
+        undo = list(self.undoStack)
+        redo = list(self.redoStack)
+        edits = []
+        while undo or redo:
+            if undo:
+                edits.append(undo.pop(0))
+            if redo:
+                edits.append(redo.pop(0))
+        for edit in edits:
+            if used <= self.memoryBudget:
+                break
+            if edit.nbytes:
+                used -= edit.nbytes
+                edit.spill(self._spillDirectory())
+
+    def close(self):
+        self.clear()
+        if self.ownsDirectory and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
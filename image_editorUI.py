@@ -4,11 +4,12 @@ import tkinter.messagebox as tkMessageBox
 import tkinter.ttk as ttk
 import os
 import math
-import json
 import numpy as np
 import cv2
 from PIL import Image, ImageTk, ImageDraw
-from rembg import remove
+import display
+import export
+import metrics
 
 BUTTON_WIDTH = 14
 SLIDER_LENGTH = 250
@@ -20,123 +21,191 @@ GREEN = (0, 255, 0)
 RED = (0, 0, 255)
 AQUAMARINE = (212, 255, 127)
 
+# How long the canvas size has to stay the same before redrawing in high
+# quality, in milliseconds
+RESIZE_SETTLE_DELAY = 150
+
 supportedFiletypes = [('JPEG Image', '*.jpg'), ('PNG Image', '*.png'),
-                      ('PPM Image', '*.ppm')]
+                      ('WebP Image', '*.webp'), ('PPM Image', '*.ppm')]
 
 
 def error(msg):
     tkMessageBox.showerror("Error", msg)
 
 
-class CustomJSONEncoder(json.JSONEncoder):
-    '''This class supports the serialization of JSON files containing
-       OpenCV's feature and match objects as well as Numpy arrays.'''
-
-    def __init__(self):
-        super(CustomJSONEncoder, self).__init__(indent=True)
-
-    def default(self, o):
-        if hasattr(o, 'pt') and hasattr(o, 'size') and hasattr(o, 'angle') and \
-           hasattr(o, 'response') and hasattr(o, 'octave') and \
-           hasattr(o, 'class_id'):
-            return {'__type__': 'cv2.KeyPoint',
-                    'point': o.pt,
-                    'size': o.size,
-                    'angle': o.angle,
-                    'response': o.response,
-                    'octave': o.octave,
-                    'class_id': o.class_id}
-
-        elif hasattr(o, 'distance') and hasattr(o, 'trainIdx') and \
-                hasattr(o, 'queryIdx') and hasattr(o, 'imgIdx'):
-            return {'__type__': 'cv2.DMatch',
-                    'distance': o.distance,
-                    'trainIdx': o.trainIdx,
-                    'queryIdx': o.queryIdx,
-                    'imgIdx': o.imgIdx}
-
-        elif isinstance(o, np.ndarray):
-            return {'__type__': 'numpy.ndarray',
-                    '__shape__': o.shape,
-                    '__array__': list(o.ravel())}
-        else:
-            json.JSONEncoder.default(self, o)
-
-
-def customLoader(d):
-    '''This function supports the deserialization of the custom types defined
-       above.'''
-    if '__type__' in d:
-        if d['__type__'] == 'cv2.KeyPoint':
-            k = cv2.KeyPoint()
-            k.pt = (float(d['point'][0]), float(d['point'][1]))
-            k.size = float(d['size'])
-            k.angle = float(d['angle'])
-            k.response = float(d['response'])
-            k.octave = int(d['octave'])
-            k.class_id = int(d['class_id'])
-            return k
-        elif d['__type__'] == 'cv2.DMatch':
-            dm = cv2.DMatch()
-            dm.distance = float(d['distance'])
-            dm.trainIdx = int(d['trainIdx'])
-            dm.queryIdx = int(d['queryIdx'])
-            dm.imgIdx = int(d['imgIdx'])
-            return dm
-        elif d['__type__'] == 'numpy.ndarray':
-            arr = np.array([float(x) for x in d['__array__']])
-            arr.reshape(tuple([int(x) for x in d['__shape__']]))
-            return arr
-        else:
-            return d
-    else:
-        return d
+class ExportDialog(tk.Toplevel):
+    '''Asks for the encoder settings of a file about to be saved. Only the
+       settings used by its format are shown. result is the chosen
+       export.ExportSettings, or None if the dialog was cancelled.'''
 
+    def __init__(self, parent, filename, settings):
+        tk.Toplevel.__init__(self, parent)
+        self.title('Export ' + os.path.basename(filename))
+        self.transient(parent)
+        self.result = None
+        self.settings = settings
+        extension = os.path.splitext(filename)[1].lower()
 
-def load(filepath):
-    return json.load(open(filepath, 'r'), object_hook=customLoader)
+        row = 0
+        self.quality = tk.IntVar(value=settings.quality if settings.quality is not None
+                                 else (export.WEBP_QUALITY if extension == '.webp'
+                                       else export.JPEG_QUALITY))
+        self.compression = tk.IntVar(value=settings.compression)
+        self.lossless = tk.BooleanVar(value=settings.lossless)
+        if extension in ('.jpg', '.jpeg', '.webp'):
+            tk.Label(self, text='Quality:').grid(row=row, column=0, sticky=tk.W)
+            tk.Scale(self, from_=1, to=100, orient=tk.HORIZONTAL, length=SLIDER_LENGTH,
+                     variable=self.quality).grid(row=row, column=1)
+            row += 1
+        if extension == '.webp':
+            tk.Checkbutton(self, text='Lossless', variable=self.lossless).grid(
+                row=row, column=1, sticky=tk.W)
+            row += 1
+        if extension == '.png':
+            tk.Label(self, text='Compression:').grid(row=row, column=0, sticky=tk.W)
+            tk.Scale(self, from_=0, to=9, orient=tk.HORIZONTAL, length=SLIDER_LENGTH,
+                     variable=self.compression).grid(row=row, column=1)
+            row += 1
+        tk.Label(self, text='Thumbnails (e.g. 1024, 256):').grid(row=row, column=0,
+                                                                 sticky=tk.W)
+        self.thumbnails = tk.Entry(self)
+        self.thumbnails.insert(0, ', '.join(str(side) for side in settings.thumbnails))
+        self.thumbnails.grid(row=row, column=1, sticky=tk.W+tk.E)
+        row += 1
+        tk.Button(self, text='Save', command=self.accept, width=BUTTON_WIDTH).grid(
+            row=row, column=0)
+        tk.Button(self, text='Cancel', command=self.destroy, width=BUTTON_WIDTH).grid(
+            row=row, column=1)
+        self.bind('<Return>', lambda event: self.accept())
+        self.bind('<Escape>', lambda event: self.destroy())
 
+    def accept(self):
+        try:
+            thumbnails = [int(side) for side in
+                          self.thumbnails.get().replace(',', ' ').split()]
+        except ValueError:
+            error('Thumbnail sizes must be whole numbers')
+            return
+        if any(side <= 0 for side in thumbnails):
+            error('Thumbnail sizes must be positive')
+            return
+        self.result = export.ExportSettings(quality=self.quality.get(),
+                                            compression=self.compression.get(),
+                                            lossless=self.lossless.get(),
+                                            thumbnails=thumbnails)
+        self.destroy()
 
-def dump(filepath, obj):
-    with open(filepath, 'w') as f:
-        f.write(CustomJSONEncoder().encode(obj))
+    def show(self):
+        self.grab_set()
+        self.wait_window(self)
+        return self.result
 
 
 class ImageWidget(tk.Canvas):
     '''This class represents a Canvas on which OpenCV images can be drawn.
        The canvas handles shrinking of the image if the image is too big,
-       as well as writing of the image to files. '''
+       as well as writing of the image to files.
+
+       Shrunk versions are made from a pyramid of the image and cached by
+       size. While the canvas is being resized a fast interpolation is used,
+       and the image is redrawn in high quality once resizing settles.
+
+       Instead of an image, the canvas can also show a graph.EditGraph, in
+       which case only a preview at the size of the canvas is rendered.
+
+       A rectangle can be selected on the image with the mouse. It is drawn
+       as a canvas item on top of the image, so dragging never touches the
+       pixels, and it is kept in full resolution image coordinates.'''
 
     def __init__(self, parent):
         self.imageCanvas = tk.Canvas.__init__(self, parent)
         self.originalImage = None
+        self.graph = None
+        self.previewImage = None
+        self.pyramid = None
+        self.displayCache = display.DisplayCache()
+        self.settleJob = None
+        # Where the image is drawn on the canvas: (x, y, width, height)
+        self.imagePlacement = None
+        self.selecting = False
+        self.selectionStart = None
+        self.selectionRect = None
+        self.selectionSize = None
         self.bind("<Configure>", self.redraw)
 
     def convertCVToTk(self, cvImage):
         height, width, _ = cvImage.shape
         if height == 0 or width == 0:
             return 0, 0, None
-        img = Image.fromarray(cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB))
-        return height, width, ImageTk.PhotoImage(img)
+        with metrics.span('photoimage'):
+            img = Image.fromarray(cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB))
+            photo = ImageTk.PhotoImage(img)
+        metrics.increment('bytes_copied', img.width * img.height * 3)
+        return height, width, photo
 
-    def fitImageToCanvas(self, cvImage):
+    def fitImageToCanvas(self, cvImage, quality=display.QUALITY):
         height, width, _ = cvImage.shape
         if height == 0 or width == 0:
             return cvImage
-        ratio = width / float(height)
-        if self.winfo_height() < height:
-            height = self.winfo_height()
-            width = int(ratio * height)
-        if self.winfo_width() < width:
-            width = self.winfo_width()
-            height = int(width / ratio)
-        dest = cv2.resize(cvImage, (width, height),
-                          interpolation=cv2.INTER_LANCZOS4)
-        return dest
-
-    def drawCVImage(self, cvImage):
-        self.originalImage = cvImage
-        height, width, img = self.convertCVToTk(self.fitImageToCanvas(cvImage))
+        if self.pyramid is None or self.pyramid.image is not cvImage:
+            self.pyramid = display.ImagePyramid(cvImage)
+        width, height = display.fitSize(width, height, self.winfo_width(),
+                                        self.winfo_height())
+        return self.pyramid.resize(width, height, quality)
+
+    def drawCVImage(self, cvImage, quality=display.QUALITY):
+        self.graph = None
+        # The graph preview is no longer what is shown, so drawing the
+        # graph again has to redraw it
+        self.previewImage = None
+        if cvImage is not self.originalImage:
+            self.originalImage = cvImage
+            self.pyramid = display.ImagePyramid(cvImage)
+            self.displayCache.clear()
+        imageHeight, imageWidth = cvImage.shape[:2]
+        if imageHeight == 0 or imageWidth == 0:
+            return
+        key = display.fitSize(imageWidth, imageHeight, self.winfo_width(),
+                              self.winfo_height()) + (quality,)
+        cached = self.displayCache.get(key)
+        if cached is None:
+            # A high quality version of the same size is just as good
+            cached = self.displayCache.get(key[:2] + (display.QUALITY,))
+        if cached is None:
+            cached = self.convertCVToTk(self.fitImageToCanvas(cvImage, quality))
+            self.displayCache.put(key, cached)
+        self.showTkImage(*cached)
+
+    def drawGraph(self, graph, quality=display.QUALITY):
+        self.graph = graph
+        self.originalImage = None
+        self.pyramid = None
+        self.displayCache.clear()
+        preview = graph.preview(self.winfo_width(), self.winfo_height(), quality)
+        # The graph caches its previews, so the same array means the same
+        # picture is already on the canvas
+        if preview is not self.previewImage:
+            self.previewImage = preview
+            self.showTkImage(*self.convertCVToTk(preview))
+
+    def clear(self):
+        '''Removes the image from the canvas.'''
+        self.graph = None
+        self.originalImage = None
+        self.previewImage = None
+        self.pyramid = None
+        self.displayCache.clear()
+        self.imagePlacement = None
+        self.tkImage = None
+        self.delete('all')
+
+    def showPreview(self, image):
+        '''Shows a display sized image without changing what the canvas
+           holds, e.g. a live preview of an edit that isn't made yet.'''
+        self.previewImage = image
+        self.showTkImage(*self.convertCVToTk(image))
+
+    def showTkImage(self, height, width, img):
         if height == 0 or width == 0:
             return
         self.tkImage = img  # prevent the image from being garbage collected
@@ -144,11 +213,118 @@ class ImageWidget(tk.Canvas):
         x = (self.winfo_width() - width) / 2.0
         y = (self.winfo_height() - height) / 2.0
         self.create_image(x, y, anchor=tk.NW, image=self.tkImage)
+        self.imagePlacement = (x, y, width, height)
+        if self.selectionRect is not None and self.fullSize() != self.selectionSize:
+            # The image was cropped, rotated or replaced under the selection
+            self.selectionStart = None
+            self.selectionRect = None
+        self.drawSelection()
+
+    def fullSize(self):
+        '''Returns the (width, height) of the full resolution image.'''
+        if self.graph is not None:
+            height, width = self.graph.shape()[:2]
+        elif self.originalImage is not None:
+            height, width = self.originalImage.shape[:2]
+        else:
+            return 0, 0
+        return width, height
+
+    def canvasToImage(self, x, y):
+        '''Maps a point on the canvas to full resolution image coordinates,
+           clipped to the image.'''
+        left, top, width, height = self.imagePlacement
+        fullWidth, fullHeight = self.fullSize()
+        x = int(round((x - left) * fullWidth / float(width)))
+        y = int(round((y - top) * fullHeight / float(height)))
+        return min(max(x, 0), fullWidth), min(max(y, 0), fullHeight)
+
+    def imageToCanvas(self, x, y):
+        left, top, width, height = self.imagePlacement
+        fullWidth, fullHeight = self.fullSize()
+        return (left + x * width / float(fullWidth),
+                top + y * height / float(fullHeight))
+
+    def startSelection(self):
+        '''Lets the user drag a rectangle over the image.'''
+        self.selecting = True
+        self.selectionStart = None
+        self.selectionRect = None
+        self.configure(cursor='crosshair')
+        self.bind('<ButtonPress-1>', self.selectionPressed)
+        self.bind('<B1-Motion>', self.selectionDragged)
+        self.bind('<ButtonRelease-1>', self.selectionDragged)
+
+    def stopSelection(self):
+        '''Ends selecting and returns the selected rectangle as
+           (x0, y0, x1, y1) in full resolution coordinates, or None.'''
+        self.selecting = False
+        self.configure(cursor='')
+        for sequence in ('<ButtonPress-1>', '<B1-Motion>', '<ButtonRelease-1>'):
+            self.unbind(sequence)
+        rect = self.selection()
+        self.clearSelection()
+        return rect
+
+    def selection(self):
+        '''The rectangle currently selected, or None, without ending
+           selecting.'''
+        rect = self.selectionRect
+        if rect is None or rect[0] == rect[2] or rect[1] == rect[3]:
+            return None
+        return rect
+
+    def clearSelection(self):
+        self.selectionStart = None
+        self.selectionRect = None
+        self.delete('selection')
+
+    def selectionPressed(self, event):
+        if self.imagePlacement is None:
+            return
+        self.focus_set()
+        self.selectionStart = self.canvasToImage(event.x, event.y)
+        self.selectionRect = self.selectionStart + self.selectionStart
+        self.selectionSize = self.fullSize()
+        self.drawSelection()
+
+    def selectionDragged(self, event):
+        if self.selectionStart is None:
+            return
+        x, y = self.canvasToImage(event.x, event.y)
+        x0, y0 = self.selectionStart
+        self.selectionRect = (min(x0, x), min(y0, y), max(x0, x), max(y0, y))
+        self.drawSelection()
+
+    def drawSelection(self):
+        if self.selectionRect is None or self.imagePlacement is None:
+            self.delete('selection')
+            return
+        x0, y0, x1, y1 = self.selectionRect
+        corners = self.imageToCanvas(x0, y0) + self.imageToCanvas(x1, y1)
+        if self.find_withtag('selection'):
+            self.coords('selection', *corners)
+        else:
+            self.create_rectangle(*corners, outline='#00ff00', width=2,
+                                  tags='selection')
 
     def redraw(self, _):
-        if self.originalImage is not None:
-            self.drawCVImage(self.originalImage)
+        if self.originalImage is not None or self.graph is not None:
+            # Draw quickly while the window is being resized, and once the
+            # size stops changing redraw in high quality
+            self.previewImage = None
+            self.draw(display.FAST)
+            if self.settleJob is not None:
+                self.after_cancel(self.settleJob)
+            self.settleJob = self.after(RESIZE_SETTLE_DELAY, self.settle)
+
+    def settle(self):
+        self.settleJob = None
+        self.previewImage = None
+        self.draw(display.QUALITY)
 
-    def writeToFile(self, filename):
-        if self.originalImage is not None:
-            cv2.imwrite(filename, self.originalImage)
+    def draw(self, quality):
+        if self.graph is not None:
+            self.drawGraph(self.graph, quality)
+        elif self.originalImage is not None:
+            self.drawCVImage(self.originalImage, quality)
@@ -0,0 +1,219 @@
+'''Runs slow operations on worker threads so the Tk main loop stays
+   responsive.
+
+   Work is submitted on a lane (usually the frame that owns the image). Jobs
+   on the same lane run one after the other, in the order they were
+   submitted, and a job only starts once the result of the previous one has
+   been handed back on the Tk thread. Different lanes run in parallel.
+
+   Tk widgets must only be touched from the main thread, so results,
+   errors and progress updates are put on a queue that is polled with
+   root.after.'''
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+POLL_INTERVAL = 30  # milliseconds
+
+
+class Cancelled(Exception):
+    '''Raised inside a job function by Job.checkCancelled.'''
+
+
+class Job(object):
+    def __init__(self, executor, lane, key, function, onDone, onError, message):
+        self.executor = executor
+        self.lane = lane
+        self.key = key
+        self.function = function
+        self.onDone = onDone
+        self.onError = onError
+        self.message = message
+        self.fraction = None
+        self.started = None
+        self.cancelEvent = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def checkCancelled(self):
+        '''Long running job functions call this between steps.'''
+        if self.cancelled:
+            raise Cancelled()
+
+    def progress(self, fraction, message=None):
+        '''Reports progress from the worker thread. fraction is between 0
+           and 1.'''
+        self.executor.results.put(('progress', self, (fraction, message)))
+        self.checkCancelled()
+
+    def _run(self):
+        try:
+            self.checkCancelled()
+            result = self.function(self)
+            self.executor.results.put(('done', self, result))
+        except Cancelled:
+            self.executor.results.put(('cancelled', self, None))
+        except Exception as e:
+            self.executor.results.put(('error', self, e))
+
+
+class Part(object):
+    '''The share of a job from start to end, for a step that reports its
+       own progress from 0 to 1.'''
+
+    def __init__(self, job, start, end):
+        self.job = job
+        self.start = start
+        self.end = end
+
+    def checkCancelled(self):
+        self.job.checkCancelled()
+
+    def progress(self, fraction, message=None):
+        self.job.progress(self.start + (self.end - self.start) * fraction, message)
+
+
+def part(job, start, end):
+    '''Part(job, start, end), or None without a job.'''
+    return None if job is None else Part(job, start, end)
+
+
+class JobExecutor(object):
+    '''A thread pool whose results are delivered on the Tk thread.'''
+
+    def __init__(self, root, workers=None):
+        self.root = root
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.results = queue.Queue()
+        self.pending = {}  # lane -> deque of jobs waiting to start
+        self.running = {}  # lane -> job currently running
+        self.statusCallbacks = {}
+        self.polling = False
+
+    def setStatusCallback(self, lane, callback):
+        '''callback(text) is called on the Tk thread with progress messages
+           for jobs on lane.'''
+        self.statusCallbacks[lane] = callback
+
+    def submit(self, lane, function, onDone=None, onError=None, key=None,
+               message=None):
+        '''Queues function(job) to run on a worker thread. onDone(result)
+           and onError(exception) are called on the Tk thread.
+
+           If key is given and a job with the same key is already queued or
+           running on the lane, the new submission is dropped. This coalesces
+           repeated clicks on the same button.'''
+        if key is not None and self.isBusy(lane, key):
+            return None
+        job = Job(self, lane, key, function, onDone, onError, message)
+        self.pending.setdefault(lane, deque()).append(job)
+        self._startNext(lane)
+        self._schedulePoll()
+        return job
+
+    def isBusy(self, lane, key=None):
+        jobs = list(self.pending.get(lane, ()))
+        if self.running.get(lane) is not None:
+            jobs.append(self.running[lane])
+        if key is None:
+            return bool(jobs)
+        return any(job.key == key and not job.cancelled for job in jobs)
+
+    def cancel(self, lane):
+        '''Cancels the running job and drops the queued jobs of a lane.'''
+        for job in self.pending.pop(lane, ()):
+            job.cancel()
+        job = self.running.get(lane)
+        if job is not None:
+            job.cancel()
+            self._status(job, (job.message or 'Working') + ' (cancelling)')
+
+    def _startNext(self, lane):
+        if self.running.get(lane) is not None:
+            return
+        waiting = self.pending.get(lane)
+        while waiting:
+            job = waiting.popleft()
+            if job.cancelled:
+                continue
+            self.running[lane] = job
+            job.started = time.perf_counter()
+            self._status(job, (job.message or 'Working') + '...')
+            self.pool.submit(job._run)
+            return
+
+    def _schedulePoll(self):
+        if not self.polling and any(job is not None
+                                    for job in self.running.values()):
+            self.polling = True
+            self.root.after(POLL_INTERVAL, self._poll)
+
+    def _poll(self):
+        self.polling = False
+        while True:
+            try:
+                kind, job, value = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                job.fraction, message = value
+                if message is not None:
+                    job.message = message
+                continue
+            self._finish(job, kind, value)
+
+        for job in self.running.values():
+            if job is not None and not job.cancelled:
+                self._status(job, self._describe(job))
+
+        self._schedulePoll()
+
+    def _finish(self, job, kind, value):
+        self.running[job.lane] = None
+        try:
+            if kind == 'done' and not job.cancelled:
+                if job.onDone is not None:
+                    job.onDone(value)
+            # A cancelled job that failed, e.g. because what it worked on
+            # went away, is only reported as cancelled
+            elif kind == 'error' and not job.cancelled:
+                if job.onError is not None:
+                    job.onError(value)
+                else:
+                    self._status(job, 'Error: %s' % value)
+            else:
+                self._status(job, (job.message or 'Job') + ' cancelled')
+        finally:
+            self._startNext(job.lane)
+            self._schedulePoll()
+
+    def _describe(self, job):
+        text = (job.message or 'Working') + '...'
+        if job.fraction is not None:
+            text += ' %d%%' % int(100 * job.fraction)
+        return text + ' (%.1fs)' % (time.perf_counter() - job.started)
+
+    def _status(self, job, text):
+        callback = self.statusCallbacks.get(job.lane)
+        if callback is not None:
+            callback(text)
+
+    def shutdown(self):
+        for lane in list(self.pending) + list(self.running):
+            self.cancel(lane)
+        self.pool.shutdown(wait=False)
+
+
+def executorFor(root):
+    '''Returns the executor shared by every frame of the window.'''
+    if getattr(root, 'jobExecutor', None) is None:
+        root.jobExecutor = JobExecutor(root)
+    return root.jobExecutor
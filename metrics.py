@@ -0,0 +1,270 @@
+'''Runtime instrumentation of the editor and the batch tool.
+
+   Three kinds of measurements are kept in a registry:
+   - spans: how long each stage took (decode, rembg inference, convolution,
+     display resize, PhotoImage creation, ...), as count, total, maximum
+     and last duration,
+   - counters: cache hits and misses, bytes copied, ...
+   - gauges: current values such as the resident set size, whose peak is
+     kept as well.
+
+   Recording is cheap (a clock read and a lock), so it is always on. The
+   registry can be shown in the status bar of the GUI (see overlayText) or
+   exported for monitoring, as JSON lines or as a Prometheus text file.
+
+   Example:
+       with metrics.span('decode'):
+           image = cv2.imread(filename)
+       metrics.increment('bytes_copied', image.nbytes)'''
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# How often the resident set size is sampled, in seconds
+SAMPLE_INTERVAL = 0.1
+
+# Spans shown in the status bar overlay, in this order
+OVERLAY_SPANS = ['decode', 'rembg', 'matting', 'convolve', 'display_resize', 'photoimage',
+                 'preview', 'encode']
+
+
+def residentBytes():
+    '''Returns the current resident set size of the process.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # Peak rather than current on systems without /proc, in KB on Linux
+        # and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Registry(object):
+    '''Thread safe store of spans, counters and gauges.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # name -> [count, total seconds, max seconds, last seconds]
+            self.spans = {}
+            self.counters = {}
+            # name -> [current, peak]
+            self.gauges = {}
+
+    def observe(self, name, seconds):
+        with self.lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                self.spans[name] = [1, seconds, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+                entry[3] = seconds
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            entry = self.gauges.get(name)
+            if entry is None:
+                self.gauges[name] = [value, value]
+            else:
+                entry[0] = value
+                entry[1] = max(entry[1], value)
+
+    def snapshot(self):
+        with self.lock:
+            return {'spans': {name: {'count': count, 'seconds': total,
+                                     'max': longest, 'last': last}
+                              for name, (count, total, longest, last)
+                              in self.spans.items()},
+                    'counters': dict(self.counters),
+                    'gauges': {name: {'value': value, 'peak': peak}
+                               for name, (value, peak) in self.gauges.items()}}
+
+    def merge(self, snapshot):
+        '''Adds a snapshot taken in another process, e.g. a batch worker.'''
+        with self.lock:
+            for name, span in snapshot.get('spans', {}).items():
+                entry = self.spans.setdefault(name, [0, 0.0, 0.0, 0.0])
+                entry[0] += span['count']
+                entry[1] += span['seconds']
+                entry[2] = max(entry[2], span['max'])
+                entry[3] = span['last']
+            for name, value in snapshot.get('counters', {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, gauge in snapshot.get('gauges', {}).items():
+                entry = self.gauges.setdefault(name, [gauge['value'], gauge['peak']])
+                entry[0] = gauge['value']
+                entry[1] = max(entry[1], gauge['peak'])
+
+
+REGISTRY = Registry()
+
+
+def span(name):
+    return REGISTRY.span(name)
+
+
+def timed(name):
+    '''Decorator recording every call of a function as a span.'''
+    def decorate(function):
+        def wrapper(*args, **kwargs):
+            with REGISTRY.span(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorate
+
+
+def increment(name, value=1):
+    REGISTRY.increment(name, value)
+
+
+def gauge(name, value):
+    REGISTRY.gauge(name, value)
+
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+
+class MemorySampler(object):
+    '''Samples the resident set size into the rss_bytes gauge on a daemon
+       thread.'''
+
+    def __init__(self, interval=SAMPLE_INTERVAL, registry=None):
+        self.interval = interval
+        self.registry = registry or REGISTRY
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='memory-sampler')
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        self.registry.gauge('rss_bytes', residentBytes())
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sample()
+
+
+_sampler = None
+
+
+def startSampling(interval=SAMPLE_INTERVAL):
+    '''Starts the process wide memory sampler once.'''
+    global _sampler
+    if _sampler is None:
+        _sampler = MemorySampler(interval).start()
+    return _sampler
+
+
+def writeJSONLines(filename, data=None, **fields):
+    '''Appends a snapshot, with any extra fields, as one JSON line.'''
+    record = {'time': time.time()}
+    record.update(fields)
+    record.update(data if data is not None else snapshot())
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheusText(data=None, prefix='image_editor'):
+    data = data if data is not None else snapshot()
+    lines = ['# TYPE %s_span_seconds summary' % prefix]
+    for name, span in sorted(data['spans'].items()):
+        lines.append('%s_span_seconds_sum{span="%s"} %r' % (prefix, _label(name),
+                                                            span['seconds']))
+        lines.append('%s_span_seconds_count{span="%s"} %d' % (prefix, _label(name),
+                                                              span['count']))
+    lines.append('# TYPE %s_span_max_seconds gauge' % prefix)
+    for name, span in sorted(data['spans'].items()):
+        lines.append('%s_span_max_seconds{span="%s"} %r' % (prefix, _label(name),
+                                                            span['max']))
+    lines.append('# TYPE %s_events_total counter' % prefix)
+    for name, value in sorted(data['counters'].items()):
+        lines.append('%s_events_total{counter="%s"} %r' % (prefix, _label(name), value))
+    # Samples of one metric have to be consecutive
+    for suffix, field in (('gauge', 'value'), ('gauge_peak', 'peak')):
+        lines.append('# TYPE %s_%s gauge' % (prefix, suffix))
+        for name, value in sorted(data['gauges'].items()):
+            lines.append('%s_%s{gauge="%s"} %r' % (prefix, suffix, _label(name),
+                                                   value[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def writePrometheus(filename, data=None):
+    '''Writes the Prometheus text format atomically, so a textfile
+       collector never reads a partial file.'''
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(prometheusText(data))
+        os.replace(path, filename)
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def overlayText(data=None):
+    '''A one line summary for the status bar.'''
+    data = data if data is not None else snapshot()
+    parts = []
+    for name in OVERLAY_SPANS:
+        span = data['spans'].get(name)
+        if span is not None:
+            parts.append('%s %.0f ms' % (name, span['last'] * 1000))
+    counters = data['counters']
+    # Every cache counts <name>_cache_hits and <name>_cache_misses
+    hits = sum(value for name, value in counters.items()
+               if name.endswith('_cache_hits'))
+    lookups = hits + sum(value for name, value in counters.items()
+                         if name.endswith('_cache_misses'))
+    if lookups:
+        parts.append('cache hits %d/%d' % (hits, lookups))
+    if counters.get('bytes_copied'):
+        parts.append('copied %.0f MB' % (counters['bytes_copied'] / 1e6))
+    rss = data['gauges'].get('rss_bytes')
+    if rss is not None:
+        parts.append('RSS %.0f MB (peak %.0f MB)' % (rss['value'] / 1e6,
+                                                     rss['peak'] / 1e6))
+    return ' | '.join(parts)
@@ -0,0 +1,413 @@
+'''Headless image operations used by both the Tk frames and the batch
+   command line tool. Nothing in this module touches Tk, so it can run on
+   machines without a display.
+
+   Images that are too large for memory are opened as memory-mapped arrays
+   (see tiles.py), and every operation below switches to its tiled version
+   for them.'''
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import cv2
+from PIL import ExifTags
+import convolution
+import display
+import export
+import matting
+import metrics
+import sessions
+import tiles
+
+STAGES = ['crop', 'rotate', 'convolve', 'remove', 'save']
+
+# Background removal in a selection also shows the model this much of the
+# image around it, relative to the selection's longest side
+ROI_MARGIN = 0.1
+MIN_ROI_MARGIN = 16
+
+EXIF_ORIENTATION = 274
+# EXIF orientations whose width and height are swapped by cv2.imread
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+@metrics.timed('decode')
+def loadImage(filename, job=None):
+    if tiles.isLarge(filename):
+        return tiles.openImage(filename, job=job)
+    image = cv2.imread(filename)
+    if image is None:
+        raise IOError('Could not read image ' + filename)
+    return image
+
+
+def orient(image, orientation):
+    '''Turns an image the way cv2.imread does for the given EXIF
+       orientation.'''
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
+
+
+@metrics.timed('probe')
+def probeImage(filename):
+    '''Reads what can be known about an image without decoding it: its
+       size as cv2.imread will return it, its format and the thumbnail
+       embedded in its EXIF data, if any (or None).'''
+    with tiles.openHeader(filename) as image:
+        width, height = image.size
+        imageFormat = image.format
+        thumbnail = None
+        orientation = 1
+        try:
+            exif = image.getexif()
+            orientation = exif.get(EXIF_ORIENTATION, 1)
+            thumbnail = _exifThumbnail(image.info.get('exif'),
+                                       exif.get_ifd(ExifTags.IFD.IFD1))
+        except Exception:
+            # Broken EXIF data only means there is no thumbnail
+            pass
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    if thumbnail is not None:
+        thumbnail = orient(thumbnail, orientation)
+    return {'size': (width, height), 'format': imageFormat, 'thumbnail': thumbnail}
+
+
+def _exifThumbnail(data, ifd1):
+    offset = ifd1.get(0x0201)
+    length = ifd1.get(0x0202)
+    if not data or offset is None or not length:
+        return None
+    # Offsets are relative to the TIFF header, which follows 'Exif\0\0'
+    start = 6 + offset
+    buffer = np.frombuffer(data[start:start + length], np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+@metrics.timed('decode_reduced')
+def loadReduced(filename, size, maxWidth, maxHeight):
+    '''Decodes a JPEG at 1/2, 1/4 or 1/8 of its size, which libjpeg does
+       much faster than a full decode by skipping most of the inverse DCT.
+       The smallest version that still fills maxWidth x maxHeight is used.
+       size is the full size from probeImage. Returns None if there is no
+       smaller version worth decoding.'''
+    width, height = size
+    fitWidth, _ = display.fitSize(width, height, maxWidth, maxHeight)
+    for factor, flag in REDUCED_FLAGS:
+        if width // factor >= fitWidth:
+            return cv2.imread(filename, flag)
+    return None
+
+
+def writeImage(filename, image, settings=None):
+    '''Saves the image, and any thumbnails the export settings ask for,
+       atomically. Returns the written file names.'''
+    return export.exportImage(filename, image, settings)
+
+
+def cropRect(shape, start_x, start_y, end_x, end_y):
+    '''Orders the corners of a selection and clips it to an image of the
+       given shape. Returns (x0, y0, x1, y1).'''
+    start_x, end_x = sorted((int(start_x), int(end_x)))
+    start_y, end_y = sorted((int(start_y), int(end_y)))
+    height, width = shape[:2]
+    start_x, end_x = min(max(0, start_x), width), max(0, min(width, end_x))
+    start_y, end_y = min(max(0, start_y), height), max(0, min(height, end_y))
+    return start_x, start_y, end_x, end_y
+
+
+def cropImage(image, start_x, start_y, end_x, end_y):
+    '''Returns the selected region as a view into image, without copying.'''
+    x0, y0, x1, y1 = cropRect(image.shape, start_x, start_y, end_x, end_y)
+    return image[y0:y1, x0:x1]
+
+
+@metrics.timed('rotate')
+def rotateImage(image, turns=1, job=None):
+    '''Rotates the image clockwise by the given number of quarter turns.
+       job (see jobs.py), here and below, gets the progress of the tiled
+       and banded loops and can cancel them.'''
+    turns = turns % 4
+    if turns == 0:
+        return image
+    if tiles.isTiled(image):
+        return tiles.rotate(image, turns, job=job)
+    if turns == 1:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if turns == 2:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+
+def buildKernel(matrix, multiplier=1.0):
+    return float(multiplier) * np.array(matrix, dtype=np.float64)
+
+
+@metrics.timed('convolve')
+def convolveImage(image, kernel, strategy=convolution.AUTO, job=None):
+    if tiles.isTiled(image):
+        return tiles.convolve(image, kernel, strategy=strategy, job=job)
+    return convolution.convolve(image, kernel, strategy, job=job)
+
+
+@metrics.timed('remove')
+def computeMask(image, model=sessions.DEFAULT_MODEL, source=None,
+                quality=matting.DEFAULT_QUALITY, job=None):
+    if tiles.isTiled(image):
+        return tiles.computeMask(image, model, quality=quality, job=job)
+    return sessions.computeMask(image, model, source, quality=quality)
+
+
+@metrics.timed('composite')
+def applyMask(image, mask, job=None):
+    if tiles.isTiled(image):
+        return tiles.applyMask(image, mask, job=job)
+    return sessions.compositeMask(image, mask)
+
+
+def expandRect(shape, rect, margin):
+    '''Grows rect by margin pixels on every side, clipped to an image of the
+       given shape.'''
+    x0, y0, x1, y1 = rect
+    return cropRect(shape, x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+
+
+def _copy(image):
+    return tiles.copy(image) if tiles.isTiled(image) else image.copy()
+
+
+@metrics.timed('convolve')
+def convolveRegion(image, kernel, rect, strategy=convolution.AUTO, job=None):
+    '''Convolves only the pixels in rect = (x0, y0, x1, y1) and returns a copy
+       of image with them replaced. The region is read with a halo as wide
+       as the kernel, so its pixels come out the same as when the whole
+       image is convolved.'''
+    x0, y0, x1, y1 = cropRect(image.shape, *rect)
+    kernel = np.asarray(kernel, dtype=np.float64)
+    top, left = kernel.shape[0] // 2, kernel.shape[1] // 2
+    bottom, right = kernel.shape[0] - 1 - top, kernel.shape[1] - 1 - left
+    height, width = image.shape[:2]
+    # Where the halo is clipped the block edge is the image edge, so the
+    # border is handled the same as for the whole image
+    bx0, by0 = max(0, x0 - left), max(0, y0 - top)
+    bx1, by1 = min(width, x1 + right), min(height, y1 + bottom)
+    if tiles.isTiled(image):
+        # The region can be as large as the image, so it is filtered and
+        # copied tile by tile as well
+        block = tiles.convolve(image[by0:by1, bx0:bx1], kernel, strategy=strategy,
+                               job=job)
+        out = tiles.copy(image)
+        tiles.paste(out, block[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0], x0, y0)
+        return out
+    block = convolution.convolve(np.ascontiguousarray(image[by0:by1, bx0:bx1]),
+                                 kernel, strategy, job=job)
+    out = _copy(image)
+    out[y0:y1, x0:x1] = block[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0]
+    return out
+
+
+def computeMaskRegion(image, rect, model=sessions.DEFAULT_MODEL, source=None,
+                      quality=matting.DEFAULT_QUALITY, job=None):
+    '''Returns the foreground mask of the region rect of image. The model
+       sees the region grown by ROI_MARGIN, so objects cut by the selection
+       are still recognised.'''
+    x0, y0, x1, y1 = cropRect(image.shape, *rect)
+    margin = max(MIN_ROI_MARGIN, int(ROI_MARGIN * max(x1 - x0, y1 - y0)))
+    bx0, by0, bx1, by1 = expandRect(image.shape, (x0, y0, x1, y1), margin)
+    if source is not None:
+        parentKey, x, y = source
+        source = (parentKey, x + bx0, y + by0)
+    block = image[by0:by1, bx0:bx1]
+    if not tiles.isTiled(image):
+        block = np.ascontiguousarray(block)
+    mask = computeMask(block, model, source, quality, job)
+    region = mask[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0]
+    if tiles.isTiled(mask):
+        return tiles.copy(region)
+    return np.ascontiguousarray(region)
+
+
+@metrics.timed('composite')
+def applyMaskRegion(image, mask, rect, job=None):
+    '''Applies a mask the size of rect = (x0, y0, x1, y1) to that region of
+       the image. The rest of the result is opaque.'''
+    x0, y0, x1, y1 = rect
+    if tiles.isTiled(image):
+        return tiles.applyMaskRegion(image, mask, rect, job=job)
+    if image.ndim == 2:
+        out = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
+    elif image.shape[2] == 3:
+        out = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    else:
+        out = image.copy()
+    out[y0:y1, x0:x1] = sessions.compositeMask(np.ascontiguousarray(image[y0:y1, x0:x1]),
+                                               mask)
+    return out
+
+
+def removeBackground(image, model=sessions.DEFAULT_MODEL, source=None,
+                     quality=matting.DEFAULT_QUALITY):
+    return applyMask(image, computeMask(image, model, source, quality))
+
+
+class Pipeline(object):
+    '''A declared sequence of operations applied to an image. Stages always
+       run in the order crop -> rotate -> convolve -> remove -> save, and any
+       stage that is not configured is skipped.
+
+       The pipeline only holds plain parameters so it can be sent to worker
+       processes.'''
+
+    def __init__(self, crop=None, rotate=0, kernel=None, remove=False,
+                 outputDir=None, extension=None, model=sessions.DEFAULT_MODEL,
+                 strategy=convolution.AUTO, exportSettings=None,
+                 mattingQuality=matting.DEFAULT_QUALITY):
+        self.crop = crop
+        self.rotate = rotate
+        self.kernel = None if kernel is None else np.asarray(kernel, dtype=np.float64)
+        self.remove = remove
+        self.outputDir = outputDir
+        if remove and extension and not export.ALPHA.get(extension.lower(), False):
+            raise ValueError('%s has no alpha channel, the removed background would '
+                             'be lost; use .png or .webp' % extension)
+        self.extension = extension
+        self.model = model
+        self.mattingQuality = mattingQuality
+        self.strategy = strategy
+        self.exportSettings = exportSettings or export.ExportSettings()
+        self.tileBudget = None
+        # Directory the masks are cached in between runs, None to only keep
+        # them in memory
+        self.maskCache = None
+
+    @classmethod
+    def fromSpec(cls, spec):
+        '''Builds a pipeline from a dictionary, e.g. one loaded from JSON:
+           {"crop": [x0, y0, x1, y1], "rotate": 1,
+            "convolve": {"matrix": [[...], [...], [...]], "multiplier": 1,
+                         "strategy": "auto"},
+            "remove": true, "model": "u2net", "matting": "balanced",
+            "save": {"dir": "out", "extension": ".png", "quality": 90,
+                     "thumbnails": [256]}}
+
+           See export.ExportSettings.fromSpec for the encoder settings.'''
+        kernel = None
+        strategy = convolution.AUTO
+        if spec.get('convolve'):
+            convolve = spec['convolve']
+            kernel = buildKernel(convolve['matrix'], convolve.get('multiplier', 1.0))
+            strategy = convolve.get('strategy', strategy)
+        save = spec.get('save') or {}
+        return cls(crop=spec.get('crop'),
+                   rotate=int(spec.get('rotate', 0)),
+                   kernel=kernel,
+                   remove=bool(spec.get('remove', False)),
+                   outputDir=save.get('dir'),
+                   extension=save.get('extension'),
+                   model=spec.get('model', sessions.DEFAULT_MODEL),
+                   mattingQuality=spec.get('matting', matting.DEFAULT_QUALITY),
+                   strategy=strategy,
+                   exportSettings=export.ExportSettings.fromSpec(save))
+
+    def key(self):
+        '''A hash of every parameter that changes the output, which tells
+           whether a file was already processed by an equal pipeline.'''
+        params = {'crop': self.crop, 'rotate': self.rotate % 4,
+                  'kernel': None if self.kernel is None else self.kernel.tolist(),
+                  'strategy': self.strategy, 'remove': self.remove,
+                  'model': self.model, 'matting': self.mattingQuality,
+                  'outputDir': self.outputDir and os.path.abspath(self.outputDir),
+                  'extension': self.extension, 'export': vars(self.exportSettings)}
+        text = json.dumps(params, sort_keys=True)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def stages(self):
+        stages = []
+        if self.crop is not None:
+            stages.append('crop')
+        if self.rotate % 4:
+            stages.append('rotate')
+        if self.kernel is not None:
+            stages.append('convolve')
+        if self.remove:
+            stages.append('remove')
+        if self.outputDir is not None:
+            stages.append('save')
+        return stages
+
+    def applyStage(self, stage, image):
+        if stage == 'crop':
+            return cropImage(image, *self.crop)
+        if stage == 'rotate':
+            return rotateImage(image, self.rotate)
+        if stage == 'convolve':
+            return convolveImage(image, self.kernel, self.strategy)
+        if stage == 'remove':
+            return removeBackground(image, self.model, quality=self.mattingQuality)
+        raise ValueError('Unknown stage ' + stage)
+
+    def outputPath(self, filename, root=None):
+        '''Where the result of filename is written. With the directory root
+           the input was found in, its path below root is kept under the
+           output directory, so equal names in subdirectories don't
+           collide.'''
+        name = os.path.relpath(filename, root) if root else os.path.basename(filename)
+        base, extension = os.path.splitext(name)
+        extension = self.extension or extension
+        if self.remove and not export.ALPHA.get(extension.lower(), False):
+            # JPEG has no alpha channel, keep the removed background
+            extension = '.png'
+        return os.path.join(self.outputDir, base + extension)
+
+    def run(self, image):
+        '''Applies every stage except save and returns the result together
+           with the time spent in each stage.'''
+        timings = {}
+        for stage in self.stages():
+            if stage == 'save':
+                continue
+            start = time.perf_counter()
+            image = self.applyStage(stage, image)
+            timings[stage] = time.perf_counter() - start
+        return image, timings
+
+    def process(self, filename, root=None):
+        '''Loads, processes and saves a single file found below the
+           directory root (see outputPath). Returns a dictionary with the
+           per-stage timings and the number of input pixels.'''
+        timings = {}
+        start = time.perf_counter()
+        image = loadImage(filename)
+        timings['load'] = time.perf_counter() - start
+        pixels = image.shape[0] * image.shape[1]
+
+        image, stageTimings = self.run(image)
+        timings.update(stageTimings)
+
+        output = None
+        if self.outputDir is not None:
+            start = time.perf_counter()
+            output = self.outputPath(filename, root)
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+            writeImage(output, image, self.exportSettings)
+            timings['save'] = time.perf_counter() - start
+        return {'input': filename, 'output': output,
+                'pixels': pixels, 'timings': timings}
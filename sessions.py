@@ -0,0 +1,249 @@
+'''Long-lived rembg model sessions and a cache of background-removal masks.
+
+   Creating a rembg session loads the ONNX model, which takes seconds, so a
+   SessionPool keeps one session per model for the lifetime of the process.
+   MaskCache remembers the alpha masks produced for images it has already
+   seen, keyed by a hash of the pixel data, both in memory and on disk.'''
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+import matting
+import metrics
+
+DEFAULT_MODEL = 'u2net'
+MODELS = ['u2net', 'u2netp', 'u2net_human_seg', 'silueta', 'isnet-general-use']
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'image_editor', 'masks')
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+DISK_CACHE_BYTES = 1024 * 1024 * 1024
+
+
+class SessionPool(object):
+    '''Keeps one rembg session per model. Sessions are created on first use,
+       or ahead of time with preload().'''
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, model=DEFAULT_MODEL):
+        with self.lock:
+            if model not in self.sessions:
+                # rembg pulls in onnxruntime, so only import it when needed
+                from rembg import new_session
+                self.sessions[model] = new_session(model)
+            return self.sessions[model]
+
+    def preload(self, model=DEFAULT_MODEL, background=True):
+        if not background:
+            self.get(model)
+            return None
+        thread = threading.Thread(target=self.get, args=(model,), daemon=True)
+        thread.start()
+        return thread
+
+
+def imageKey(image):
+    '''Returns a hash of the pixel data, shape and type of image.'''
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((image.shape, image.dtype.str)).encode())
+    digest.update(memoryview(image).cast('B'))
+    return digest.hexdigest()
+
+
+class MaskCache(object):
+    '''A least recently used cache of alpha masks with two levels: an
+       in-memory dictionary and a directory of .npy files. Both levels are
+       bounded by a number of bytes, and the least recently used masks are
+       evicted first.'''
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 memoryBytes=MEMORY_CACHE_BYTES, diskBytes=DISK_CACHE_BYTES):
+        self.directory = directory
+        self.memoryBytes = memoryBytes
+        self.diskBytes = diskBytes
+        self.memory = OrderedDict()
+        self.memoryUsed = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.diskUsed = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        with self.lock:
+            mask = self.memory.get(key)
+            if mask is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                metrics.increment('mask_cache_hits')
+                return mask
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                mask = np.load(path)
+                os.utime(path)  # mark as recently used for eviction
+            except (OSError, ValueError):
+                mask = None
+            if mask is not None:
+                mask.flags.writeable = False
+                self._remember(key, mask)
+                self.hits += 1
+                metrics.increment('mask_cache_hits')
+                return mask
+        self.misses += 1
+        metrics.increment('mask_cache_misses')
+        return None
+
+    def put(self, key, mask):
+        mask = np.ascontiguousarray(mask)
+        mask.flags.writeable = False
+        self._remember(key, mask)
+        if self.directory is not None:
+            self._writeToDisk(key, mask)
+
+    def _remember(self, key, mask):
+        with self.lock:
+            if key in self.memory:
+                self.memoryUsed -= self.memory.pop(key).nbytes
+            self.memory[key] = mask
+            self.memoryUsed += mask.nbytes
+            while self.memoryUsed > self.memoryBytes and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memoryUsed -= evicted.nbytes
+
+    def _writeToDisk(self, key, mask):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first so other processes never see a
+        # partially written mask
+        temp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp, 'wb') as f:
+            np.save(f, mask)
+        os.replace(temp, path)
+        with self.lock:
+            if self.diskUsed is None:
+                self.diskUsed = sum(entry.stat().st_size
+                                    for entry in os.scandir(self.directory)
+                                    if entry.name.endswith('.npy'))
+            else:
+                self.diskUsed += os.path.getsize(path)
+            if self.diskUsed > self.diskBytes:
+                self._evictDisk()
+
+    def _evictDisk(self):
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.name.endswith('.npy')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        used = sum(entry.stat().st_size for entry in entries)
+        # Evict down to 90% so we don't rescan the directory on every write
+        for entry in entries:
+            if used <= 0.9 * self.diskBytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                used -= size
+            except OSError:
+                pass
+        self.diskUsed = used
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memoryUsed = 0
+
+
+def compositeMask(image, mask):
+    '''Applies mask as the alpha channel of image, clearing the colour of
+       removed pixels the same way rembg does.'''
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
+    elif image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    mask4 = cv2.merge([mask, mask, mask, mask])
+    return cv2.multiply(image, mask4, scale=1 / 255.0)
+
+
+def _toRGB(image):
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+_pool = None
+_cache = None
+
+
+def defaultPool():
+    global _pool
+    if _pool is None:
+        _pool = SessionPool()
+    return _pool
+
+
+def defaultCache():
+    global _cache
+    if _cache is None:
+        _cache = MaskCache(os.environ.get('IMAGE_EDITOR_CACHE', DEFAULT_CACHE_DIR))
+    return _cache
+
+
+def setDefaultCache(cache):
+    '''Replaces the cache used when none is given, e.g. by one without a
+       disk level for frames that won't be seen again.'''
+    global _cache
+    _cache = cache
+
+
+def _maskSuffix(model, quality):
+    side = matting.inferenceSide(quality)
+    return '-' + model if side is None else '-%s-%d' % (model, side)
+
+
+def computeMask(image, model=DEFAULT_MODEL, source=None, pool=None, cache=None,
+                quality=matting.DEFAULT_QUALITY):
+    '''Returns the foreground mask of image, from the cache when possible.
+
+       source can be given as (parentKey, x, y) when image is a region cropped
+       out of a previously seen image whose key is parentKey. If the mask of
+       the parent is cached, the matching region of it is used instead of
+       running the model again.
+
+       quality bounds the resolution the model runs at (see matting.py).'''
+    pool = pool or defaultPool()
+    cache = cache or defaultCache()
+    suffix = _maskSuffix(model, quality)
+    key = imageKey(image) + suffix
+    mask = cache.get(key)
+    if mask is not None:
+        return mask
+    if source is not None:
+        parentKey, x, y = source
+        parentMask = cache.get(parentKey + suffix)
+        if parentMask is not None:
+            height, width = image.shape[:2]
+            region = parentMask[y:y + height, x:x + width]
+            if region.shape == (height, width):
+                return region
+
+    from rembg import remove
+    session = pool.get(model)
+
+    def segment(image):
+        with metrics.span('rembg'):
+            return remove(_toRGB(image), session=session, only_mask=True)
+
+    with metrics.span('matting'):
+        mask = matting.computeMask(image, segment, quality)
+    cache.put(key, mask)
+    return mask
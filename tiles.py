@@ -0,0 +1,389 @@
+'''Tiled processing of images that are too large to hold in memory.
+
+   Large images are kept in memory-mapped raw files (np.memmap) and every
+   operation reads and writes them one tile at a time, so the memory used
+   is bounded by the tile budget rather than by the size of the image.
+   Results are written to new memory-mapped temporary files, which are
+   deleted as soon as they are no longer referenced.
+
+   Convolution reads each tile with a halo of neighbouring pixels as wide as
+   the kernel, so there are no seams and the result is identical to
+   filtering the whole image at once. (For large kernels OpenCV's floating
+   point evaluation order depends on the block it is given, so a handful of
+   pixels that round exactly at .5 can differ by one level.)'''
+import math
+import os
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import cv2
+from PIL import Image
+import convolution
+import matting
+import metrics
+import sessions
+
+# Memory used by the pixels of one tile, including its output
+TILE_BUDGET = 64 * 1024 * 1024
+# Images with more pixels than this are opened memory-mapped
+TILED_PIXELS = 100 * 1000 * 1000
+# Largest side of the in-memory proxy used for previews and for running
+# the background removal model on tiled images
+PROXY_SIDE = 4096
+# Images that have to be decoded in memory are then copied to a
+# memory-mapped file, which takes twice their size. Larger ones are refused.
+DECODE_BUDGET = 2 * 1024 * 1024 * 1024
+# PIL raw modes of the uncompressed 8-bit TIFFs that are mapped directly:
+# rawmode -> (channels, conversion to BGR)
+TIFF_RAWMODES = {'RGB': (3, cv2.COLOR_RGB2BGR), 'RGBA': (4, cv2.COLOR_RGBA2BGR),
+                 'RGBX': (4, cv2.COLOR_RGBA2BGR), 'L': (1, cv2.COLOR_GRAY2BGR)}
+
+TEMP_DIR = None
+
+
+def isTiled(image):
+    return isinstance(image, np.memmap)
+
+
+@contextmanager
+def openHeader(filename):
+    '''Opens an image with PIL to read its header, without decoding it.'''
+    limit = Image.MAX_IMAGE_PIXELS
+    # Only the header is read, so the decompression bomb check doesn't apply
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        with Image.open(filename) as image:
+            yield image
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def imageSize(filename):
+    '''Returns (width, height) from the file header without decoding it.'''
+    with openHeader(filename) as image:
+        return image.size
+
+
+def isLarge(filename):
+    try:
+        width, height = imageSize(filename)
+    except (OSError, SyntaxError, ValueError):
+        return False
+    return width * height > TILED_PIXELS
+
+
+def createArray(shape, dtype=np.uint8):
+    '''Returns a zeroed memory-mapped array backed by an anonymous temporary
+       file, which is removed when the array is garbage collected.'''
+    return np.memmap(tempfile.TemporaryFile(dir=TEMP_DIR), dtype=dtype,
+                     mode='w+', shape=tuple(shape))
+
+
+def tileSide(channels, itemsize=1, halo=0, budget=None):
+    '''Returns the side of square tiles whose input, with halo, and output
+       fit in the budget.'''
+    budget = budget or TILE_BUDGET
+    side = int(math.sqrt(budget / (2.0 * channels * itemsize))) - 2 * halo
+    return max(side, 64)
+
+
+def tileRects(height, width, side):
+    for y0 in range(0, height, side):
+        for x0 in range(0, width, side):
+            yield y0, min(y0 + side, height), x0, min(x0 + side, width)
+
+
+def _progress(items, job=None):
+    '''Yields the items, reporting the progress to job (see jobs.py) before
+       every one, which also stops the loop when the job is cancelled.'''
+    items = list(items)
+    for done, item in enumerate(items):
+        if job is not None:
+            job.progress(done / float(len(items)))
+        yield item
+
+
+def _tiles(height, width, side, job=None):
+    return _progress(tileRects(height, width, side), job)
+
+
+def _channels(image):
+    return 1 if image.ndim == 2 else image.shape[2]
+
+
+def _side(image, halo=0, budget=None):
+    return tileSide(_channels(image), image.dtype.itemsize, halo, budget)
+
+
+def _readPPMHeader(f):
+    '''Returns (width, height, maxval, offset) of a binary PPM file.'''
+    if f.read(2) != b'P6':
+        return None
+    fields = []
+    while len(fields) < 3:
+        c = f.read(1)
+        if not c:
+            return None
+        if c == b'#':
+            f.readline()
+        elif c.isspace():
+            continue
+        else:
+            token = c
+            while True:
+                c = f.read(1)
+                if not c or c.isspace():
+                    break
+                token += c
+            fields.append(int(token))
+    return fields[0], fields[1], fields[2], f.tell()
+
+
+def _tiffStrips(filename):
+    '''Returns ((width, height), strips) of an uncompressed 8-bit TIFF, with
+       strips a list of (x0, y0, x1, y1, offset, stride, rawmode) for every
+       strip or tile in the file, or None for other files.'''
+    with openHeader(filename) as image:
+        if image.format != 'TIFF':
+            return None
+        strips = []
+        for codec, extents, offset, args in image.tile:
+            # args are (rawmode, stride, orientation) for raw data
+            if codec != 'raw' or args[0] not in TIFF_RAWMODES or args[2] != 1:
+                return None
+            strips.append(tuple(extents) + (offset, args[1], args[0]))
+        return image.size, strips
+
+
+def openImage(filename, budget=None, job=None):
+    '''Opens an image as a memory-mapped BGR array.
+
+       Binary PPM files and the strips or tiles of uncompressed TIFF files
+       are mapped directly and converted to BGR tile by tile, so their size
+       is not limited by memory. Other formats have to be decoded by OpenCV
+       in one go first and are then moved to a memory-mapped file, so they
+       are refused when that doesn't fit in DECODE_BUDGET.'''
+    tiff = _tiffStrips(filename)
+    if tiff is not None:
+        (width, height), strips = tiff
+        out = createArray((height, width, 3))
+        side = _side(out, budget=budget)
+        parts = [(strip, rect) for strip in strips
+                 for rect in tileRects(strip[3] - strip[1], strip[2] - strip[0], side)]
+        for (x0, y0, x1, y1, offset, stride, rawmode), (ty0, ty1, tx0, tx1) in \
+                _progress(parts, job):
+            channels, conversion = TIFF_RAWMODES[rawmode]
+            # Rows of tiles can be padded, stride 0 means they aren't
+            rows = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                             shape=(y1 - y0, stride or (x1 - x0) * channels))
+            pixels = rows[ty0:ty1, tx0 * channels:tx1 * channels].reshape(
+                ty1 - ty0, tx1 - tx0, channels)
+            out[y0 + ty0:y0 + ty1, x0 + tx0:x0 + tx1] = \
+                cv2.cvtColor(np.ascontiguousarray(pixels), conversion)
+            del rows, pixels
+        return out
+
+    with open(filename, 'rb') as f:
+        header = _readPPMHeader(f)
+    if header is not None and header[2] < 256:
+        width, height, _, offset = header
+        rgb = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                        shape=(height, width, 3))
+        out = createArray(rgb.shape)
+        for y0, y1, x0, x1 in _tiles(height, width, _side(rgb, budget=budget), job):
+            out[y0:y1, x0:x1] = cv2.cvtColor(np.ascontiguousarray(rgb[y0:y1, x0:x1]),
+                                             cv2.COLOR_RGB2BGR)
+        return out
+
+    width, height = imageSize(filename)
+    if 2 * width * height * 3 > DECODE_BUDGET:
+        raise IOError('%s is too large to decode in memory (%dx%d); convert it to '
+                      'binary PPM or uncompressed TIFF' % (filename, width, height))
+    image = cv2.imread(filename)
+    if image is None:
+        raise IOError('Could not read image ' + filename)
+    out = createArray(image.shape, image.dtype)
+    out[:] = image
+    metrics.increment('bytes_copied', image.nbytes)
+    return out
+
+
+def writePPM(filename, image, budget=None):
+    '''Writes a 3 channel BGR image as binary PPM, tile by tile.'''
+    height, width = image.shape[:2]
+    header = b'P6\n%d %d\n255\n' % (width, height)
+    with open(filename, 'wb') as f:
+        f.write(header)
+    with open(filename, 'r+b') as f:
+        f.truncate(len(header) + height * width * 3)
+    rgb = np.memmap(filename, dtype=np.uint8, mode='r+', offset=len(header),
+                    shape=(height, width, 3))
+    for y0, y1, x0, x1 in tileRects(height, width, _side(image, budget=budget)):
+        rgb[y0:y1, x0:x1] = cv2.cvtColor(np.ascontiguousarray(image[y0:y1, x0:x1]),
+                                         cv2.COLOR_BGR2RGB)
+    rgb.flush()
+    del rgb
+
+
+def writeImage(filename, image, budget=None, params=()):
+    '''Writes PPM tile by tile, other formats with cv2.imwrite and its
+       encoder params.'''
+    if os.path.splitext(filename)[1].lower() == '.ppm' and _channels(image) == 3:
+        writePPM(filename, image, budget)
+    elif not cv2.imwrite(filename, image, list(params)):
+        raise IOError('Could not write image ' + filename)
+
+
+def convolve(image, kernel, budget=None, strategy=convolution.AUTO, job=None):
+    '''convolution.convolve computed tile by tile.'''
+    kernel = np.asarray(kernel, dtype=np.float64)
+    kernelHeight, kernelWidth = kernel.shape
+    top, left = kernelHeight // 2, kernelWidth // 2
+    bottom, right = kernelHeight - 1 - top, kernelWidth - 1 - left
+    height, width = image.shape[:2]
+    out = createArray(image.shape, image.dtype)
+    side = _side(image, max(kernel.shape), budget)
+    for y0, y1, x0, x1 in _tiles(height, width, side, job):
+        # Read the tile with a halo, clipped to the image. Where the halo is
+        # clipped, the block edge is the image edge, so filter2D's border
+        # handling is the same as for the whole image.
+        by0, by1 = max(0, y0 - top), min(height, y1 + bottom)
+        bx0, bx1 = max(0, x0 - left), min(width, x1 + right)
+        block = np.ascontiguousarray(image[by0:by1, bx0:bx1])
+        result = convolution.convolve(block, kernel, strategy)
+        out[y0:y1, x0:x1] = result[y0 - by0:y1 - by0, x0 - bx0:x1 - bx0]
+    return out
+
+
+def rotate(image, turns=1, budget=None, job=None):
+    '''Rotates clockwise by turns quarter turns, tile by tile.'''
+    turns %= 4
+    height, width = image.shape[:2]
+    if turns % 2:
+        shape = (width, height) + image.shape[2:]
+    else:
+        shape = image.shape
+    out = createArray(shape, image.dtype)
+    for y0, y1, x0, x1 in _tiles(height, width, _side(image, budget=budget), job):
+        tile = np.ascontiguousarray(image[y0:y1, x0:x1])
+        if turns == 0:
+            out[y0:y1, x0:x1] = tile
+        elif turns == 1:
+            out[x0:x1, height - y1:height - y0] = cv2.rotate(tile, cv2.ROTATE_90_CLOCKWISE)
+        elif turns == 2:
+            out[height - y1:height - y0, width - x1:width - x0] = \
+                cv2.rotate(tile, cv2.ROTATE_180)
+        else:
+            out[width - x1:width - x0, y0:y1] = \
+                cv2.rotate(tile, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return out
+
+
+def applyMask(image, mask, budget=None, job=None):
+    '''sessions.compositeMask computed tile by tile.'''
+    height, width = image.shape[:2]
+    out = createArray((height, width, 4), image.dtype)
+    for y0, y1, x0, x1 in _tiles(height, width, _side(out, budget=budget), job):
+        out[y0:y1, x0:x1] = sessions.compositeMask(
+            np.ascontiguousarray(image[y0:y1, x0:x1]),
+            np.ascontiguousarray(mask[y0:y1, x0:x1]))
+    return out
+
+
+def applyMaskRegion(image, mask, rect, budget=None, job=None):
+    '''applyMask with a mask covering only rect; the rest stays opaque.'''
+    x0, y0, x1, y1 = rect
+    height, width = image.shape[:2]
+    out = createArray((height, width, 4), image.dtype)
+    for ty0, ty1, tx0, tx1 in _tiles(height, width, _side(out, budget=budget), job):
+        tile = np.full((ty1 - ty0, tx1 - tx0), 255, np.uint8)
+        # The part of the selection inside this tile
+        ix0, iy0 = max(x0, tx0), max(y0, ty0)
+        ix1, iy1 = min(x1, tx1), min(y1, ty1)
+        if ix0 < ix1 and iy0 < iy1:
+            tile[iy0 - ty0:iy1 - ty0, ix0 - tx0:ix1 - tx0] = \
+                mask[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+        out[ty0:ty1, tx0:tx1] = sessions.compositeMask(
+            np.ascontiguousarray(image[ty0:ty1, tx0:tx1]), tile)
+    return out
+
+
+def copy(image, budget=None, job=None):
+    '''A writable copy of the image, made tile by tile.'''
+    height, width = image.shape[:2]
+    out = createArray(image.shape, image.dtype)
+    for y0, y1, x0, x1 in _tiles(height, width, _side(image, budget=budget), job):
+        out[y0:y1, x0:x1] = image[y0:y1, x0:x1]
+    return out
+
+
+def paste(out, image, x, y, budget=None):
+    '''Copies image into out with its top left corner at (x, y), tile by
+       tile.'''
+    height, width = image.shape[:2]
+    for y0, y1, x0, x1 in tileRects(height, width, _side(image, budget=budget)):
+        out[y + y0:y + y1, x + x0:x + x1] = image[y0:y1, x0:x1]
+
+
+def downscale(image, factor, budget=None):
+    '''Shrinks the image by an integer factor with area averaging. Pixels
+       left over at the right and bottom edges are dropped.'''
+    height, width = image.shape[:2]
+    outHeight, outWidth = height // factor, width // factor
+    out = np.empty((outHeight, outWidth) + image.shape[2:], image.dtype)
+    side = max(factor, _side(image, budget=budget) // factor * factor)
+    for y0, y1, x0, x1 in tileRects(outHeight * factor, outWidth * factor, side):
+        out[y0 // factor:y1 // factor, x0 // factor:x1 // factor] = cv2.resize(
+            np.ascontiguousarray(image[y0:y1, x0:x1]),
+            ((x1 - x0) // factor, (y1 - y0) // factor), interpolation=cv2.INTER_AREA)
+    return out
+
+
+def proxy(image, side=PROXY_SIDE, budget=None):
+    '''Returns an in-memory copy of the image whose largest side is at most
+       side, and the factor it was shrunk by.'''
+    factor = 1
+    while max(image.shape[:2]) // factor > side:
+        factor *= 2
+    if factor == 1:
+        return np.ascontiguousarray(image), 1
+    return downscale(image, factor, budget), factor
+
+
+def computeMask(image, model=sessions.DEFAULT_MODEL, budget=None,
+                quality=matting.DEFAULT_QUALITY, job=None):
+    '''Runs background removal on a proxy of the image and scales the mask
+       back up to full resolution tile by tile. Unless quality is full, the
+       proxy is no larger than the quality allows and the mask follows the
+       edges of the image (see matting.py).'''
+    side = matting.inferenceSide(quality)
+    small, factor = proxy(image, side or PROXY_SIDE, budget)
+    # The proxy is already as small as the quality asks for
+    smallMask = np.ascontiguousarray(sessions.computeMask(small, model,
+                                                          quality=matting.FULL))
+    if factor == 1:
+        return smallMask
+    height, width = image.shape[:2]
+    mask = createArray((height, width))
+    if side is None:
+        tile = _side(mask, budget=budget)
+    else:
+        a, b = matting.coefficients(small, smallMask)
+        # The tile of the image, the coefficients and their product
+        tile = tileSide(_channels(image) + 12, budget=budget)
+    for y0, y1, x0, x1 in _tiles(height, width, tile, job):
+        # Map full resolution pixel centres to the proxy
+        scale = 1.0 / factor
+        matrix = np.array([[scale, 0, (x0 + 0.5) * scale - 0.5],
+                           [0, scale, (y0 + 0.5) * scale - 0.5]])
+
+        def warp(lowRes):
+            return cv2.warpAffine(lowRes, matrix, (x1 - x0, y1 - y0),
+                                  flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                  borderMode=cv2.BORDER_REPLICATE)
+        if side is None:
+            mask[y0:y1, x0:x1] = warp(smallMask)
+        else:
+            mask[y0:y1, x0:x1] = matting.applyCoefficients(warp(a), warp(b),
+                                                           image[y0:y1, x0:x1])
+    return mask
@@ -0,0 +1,333 @@
+'''Streaming processing of video clips and image sequences without the GUI.
+
+   Examples:
+       python video.py clip.mp4 out.mp4 --rotate 1 --kernel "0,-1,0;-1,5,-1;0,-1,0"
+       python video.py "frames/img_%04d.png" out.avi --crop 0 0 1280 720
+       python video.py frames/ out/ --remove-background
+
+   It takes the same pipeline options as batch.py; every frame goes through
+   crop -> rotate -> convolve -> remove background. The input is anything
+   cv2.VideoCapture opens (a video file or a numbered image pattern) or a
+   directory of images, taken in name order. The output is a video file
+   (.mp4, .avi, .mov, .mkv), a numbered pattern, or a directory that gets
+   one image per frame (FRAME_NAME).
+
+   Frames stream through three stages running at the same time: a thread
+   decodes, a pool of worker threads processes several frames at once (the
+   OpenCV and onnxruntime calls release the GIL, and frames are not copied
+   between processes), and the results are encoded in frame order. Bounded
+   queues between the stages (--queue frames per worker) make a slow stage
+   hold back the ones before it, so memory use depends on the frame size
+   and the number of workers, not on the length of the clip.
+
+   Videos have no alpha channel: with --remove-background the removed
+   background is black in a video and transparent in PNG or WebP frames.'''
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import batch
+import convolution
+import export
+import metrics
+import operations
+import sessions
+import tiles
+
+# extension -> four character code of the codec written
+FOURCCS = {'.mp4': 'mp4v', '.m4v': 'mp4v', '.mov': 'mp4v', '.avi': 'MJPG', '.mkv': 'XVID'}
+# Used when the input doesn't say, e.g. a directory of images
+DEFAULT_FPS = 25.0
+# Frames written to a directory are named like this
+FRAME_NAME = 'frame_%06d'
+# Frames waiting between two stages, per worker
+QUEUE_PER_WORKER = 2
+# Masks of video frames are rarely computed twice, so the memory cache is
+# small, and they are only written to disk with --mask-cache
+MASK_CACHE_BYTES = 32 * 1024 * 1024
+# Seconds between progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+def readFrames(source):
+    '''Yields the frames of a video file, an image pattern or a directory of
+       images, in order.'''
+    if os.path.isdir(source):
+        for filename, _ in batch.findImages([source]):
+            yield operations.loadImage(filename)
+        return
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError('Could not open ' + source)
+    try:
+        while True:
+            with metrics.span('decode'):
+                ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def frameRate(source):
+    '''The frame rate of a video, or DEFAULT_FPS when it has none.'''
+    if os.path.isdir(source):
+        return DEFAULT_FPS
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS) if capture.isOpened() else 0
+    capture.release()
+    return fps if fps and fps > 0 else DEFAULT_FPS
+
+
+def prefetch(items, size):
+    '''Runs a generator on a thread of its own, at most size items ahead of
+       the consumer, and yields its items. Errors are raised in the
+       consumer.'''
+    buffer = queue.Queue(size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    thread = threading.Thread(target=produce, daemon=True, name='decode')
+    thread.start()
+    try:
+        while True:
+            ok, item = buffer.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        # The consumer stopped early, let the producer finish
+        stopped.set()
+        thread.join()
+
+
+def processFrames(pipeline, frames, executor, size):
+    '''Yields (frame, timings) from pipeline.run for every frame, in the
+       order of frames, with at most size frames in flight.'''
+    pending = deque()
+    for frame in frames:
+        if len(pending) >= size:
+            yield pending.popleft().result()
+        pending.append(executor.submit(pipeline.run, frame))
+    while pending:
+        yield pending.popleft().result()
+
+
+class FrameWriter(object):
+    '''Writes frames to a video file, a numbered image pattern or a
+       directory of images.'''
+
+    def __init__(self, output, fps=DEFAULT_FPS, extension=None, settings=None):
+        self.output = output
+        self.fps = fps
+        self.settings = settings
+        self.extension = os.path.splitext(output)[1].lower()
+        self.video = None
+        self.size = None
+        self.count = 0
+        if self.extension in FOURCCS:
+            self.pattern = None
+        elif '%' in output:
+            self.pattern = output
+        else:
+            # A directory of frames
+            os.makedirs(output, exist_ok=True)
+            self.pattern = os.path.join(output, FRAME_NAME + (extension or '.png'))
+
+    def write(self, frame):
+        if self.pattern is not None:
+            export.writeImage(self.pattern % self.count, frame, self.settings)
+        else:
+            self.writeVideo(frame)
+        self.count += 1
+
+    def writeVideo(self, frame):
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        elif frame.shape[2] == 4:
+            # The removed background is already black, see compositeMask
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        height, width = frame.shape[:2]
+        if self.video is None:
+            self.size = (width, height)
+            fourcc = cv2.VideoWriter_fourcc(*FOURCCS[self.extension])
+            self.video = cv2.VideoWriter(self.output, fourcc, self.fps, self.size)
+            if not self.video.isOpened():
+                raise IOError('Could not write video ' + self.output)
+        elif (width, height) != self.size:
+            raise ValueError('Frame %d is %dx%d but the video is %dx%d'
+                             % ((self.count, width, height) + self.size))
+        with metrics.span('encode'):
+            self.video.write(frame)
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+
+
+class FrameReport(object):
+    '''Frame rate of the whole run and time per frame of every stage.'''
+
+    def __init__(self):
+        self.frames = 0
+        self.stageSeconds = {}
+        self.peakBytes = 0
+
+    def add(self, timings):
+        self.frames += 1
+        for stage, seconds in timings.items():
+            self.addStage(stage, seconds)
+
+    def addStage(self, stage, seconds):
+        self.stageSeconds[stage] = self.stageSeconds.get(stage, 0.0) + seconds
+
+    def sampleMemory(self):
+        self.peakBytes = max(self.peakBytes, metrics.residentBytes())
+
+    def format(self, wallSeconds, workers):
+        lines = ['Processed %d frames in %.2fs with %d workers'
+                 % (self.frames, wallSeconds, workers)]
+        if wallSeconds > 0:
+            lines.append('Overall: %.1f fps' % (self.frames / wallSeconds))
+        for stage in ['decode'] + operations.STAGES + ['encode']:
+            if stage not in self.stageSeconds or not self.frames:
+                continue
+            perFrame = self.stageSeconds[stage] / self.frames
+            lines.append('  %-8s %8.1f ms/frame %8.1f fps per worker'
+                         % (stage, 1000 * perFrame,
+                            1 / perFrame if perFrame > 0 else float('inf')))
+        if self.peakBytes:
+            lines.append('Peak memory: %.0f MB' % (self.peakBytes / 1e6))
+        return '\n'.join(lines)
+
+
+def _timed(items, report, stage):
+    '''Yields the items, adding the time spent getting each to stage.'''
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        report.addStage(stage, time.perf_counter() - start)
+        yield item
+
+
+def _setUp(pipeline, workers):
+    if workers > 1:
+        # The frames are already processed in parallel
+        cv2.setNumThreads(1)
+        convolution.WORKERS = 1
+        export.WORKERS = 1
+    if pipeline.tileBudget:
+        tiles.TILE_BUDGET = pipeline.tileBudget
+    if pipeline.remove:
+        sessions.setDefaultCache(sessions.MaskCache(directory=pipeline.maskCache,
+                                                    memoryBytes=MASK_CACHE_BYTES))
+        sessions.defaultPool().preload(pipeline.model, background=False)
+
+
+def run(pipeline, source, output, workers=None, queuePerWorker=QUEUE_PER_WORKER,
+        fps=None, onFrame=None, progress=None):
+    '''Streams every frame of source through the pipeline into output.
+       Returns the report, the wall time and the number of workers.'''
+    workers = workers or os.cpu_count() or 1
+    size = workers * queuePerWorker
+    _setUp(pipeline, workers)
+    report = FrameReport()
+    writer = FrameWriter(output, fps or frameRate(source), pipeline.extension,
+                         pipeline.exportSettings)
+    start = time.perf_counter()
+    lastProgress = start
+    try:
+        with ThreadPoolExecutor(workers, thread_name_prefix='frame') as executor:
+            frames = prefetch(_timed(readFrames(source), report, 'decode'), size)
+            for frame, timings in processFrames(pipeline, frames, executor, size):
+                encodeStart = time.perf_counter()
+                writer.write(frame)
+                timings['encode'] = time.perf_counter() - encodeStart
+                report.add(timings)
+                if onFrame is not None:
+                    onFrame(report.frames - 1, timings)
+                now = time.perf_counter()
+                if progress is not None and now - lastProgress >= PROGRESS_INTERVAL:
+                    lastProgress = now
+                    report.sampleMemory()
+                    progress(report, now - start)
+    finally:
+        writer.close()
+    report.sampleMemory()
+    return report, time.perf_counter() - start, workers
+
+
+def showProgress(report, seconds):
+    sys.stderr.write('\r%d frames, %.1f fps' % (report.frames, report.frames / seconds))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply an editing pipeline to '
+                                     'every frame of a video or image sequence.')
+    parser.add_argument('input', help='video file, image pattern such as '
+                        'frames/img_%%04d.png, or directory of images')
+    parser.add_argument('output', help='video file (%s), image pattern or directory'
+                        % ', '.join(sorted(FOURCCS)))
+    batch.addPipelineArguments(parser)
+    parser.add_argument('--fps', type=float, default=None,
+                        help='frame rate of the output video (default: the input\'s)')
+    parser.add_argument('--queue', type=int, default=QUEUE_PER_WORKER,
+                        help='frames waiting between stages per worker')
+    args = parser.parse_args(argv)
+
+    try:
+        pipeline = batch.buildPipeline(args)
+    except ValueError as e:
+        parser.error(str(e))
+    metricsExport = batch.MetricsExport(args.metrics_jsonl, args.metrics_prom)
+
+    def onFrame(index, timings):
+        metricsExport.add({'input': args.input, 'frame': index, 'timings': timings})
+
+    try:
+        report, wallSeconds, workers = run(pipeline, args.input, args.output, args.jobs,
+                                           args.queue, args.fps, onFrame, showProgress)
+    except (IOError, ValueError) as e:
+        sys.stderr.write('\n')
+        print('Error: %s' % e)
+        return 1
+    sys.stderr.write('\n')
+    metricsExport.finish(wallSeconds)
+    print(report.format(wallSeconds, workers))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,355 @@
+'''Hot folder mode: keeps watching directories and runs the batch pipeline
+   on every image that appears or changes in them.
+
+   Example:
+       python watch.py incoming/ out/ --rotate 1 --remove-background --jobs 4
+
+   It takes the same pipeline options as batch.py. The progress is kept in
+   a SQLite manifest (out/.manifest.sqlite unless --manifest is given):
+   - files: the size, modification time and content hash of every input
+     already handled by this pipeline, so unchanged files are recognised
+     from a directory scan alone and only new or modified ones are read,
+   - results: the (content hash, pipeline) pairs that were processed and
+     where their output went, so a file that was touched but not changed,
+     or processed before under the same name, is not processed again.
+   A restart therefore only scans the directories and compares, however
+   many files were processed before. Changing any pipeline parameter that
+   affects the output processes everything again (see Pipeline.key).
+
+   Files are hashed and processed by the worker processes. At most --queue
+   images per worker are in flight; the scan waits for results when that
+   many are queued, so memory use stays flat however many files arrive at
+   once. Files modified in the last --settle seconds are left for the next
+   scan, as they may still be being written. Files that fail are retried
+   when they change, and deleted files are dropped from the manifest.
+
+   As in batch.py, subdirectories of a watched directory are recreated in
+   the output. An input whose output already belongs to another one (the
+   same name in two watched directories) is skipped with a warning.'''
+import argparse
+import hashlib
+import os
+import pathlib
+import sqlite3
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+import batch
+
+MANIFEST_NAME = '.manifest.sqlite'
+# Seconds between scans
+POLL_INTERVAL = 2.0
+# Files modified more recently than this are scanned again later
+SETTLE_SECONDS = 2.0
+# Images in flight per worker process
+QUEUE_PER_WORKER = 2
+# Results are committed to the manifest in batches of this many
+COMMIT_INTERVAL = 100
+HASH_CHUNK = 1024 * 1024
+
+
+def fileKey(filename):
+    '''Hash of the contents of a file.'''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    '''The inputs seen and results written, in a SQLite database. Only the
+       main process writes to it; the workers open it read only.'''
+
+    def __init__(self, filename, readOnly=False):
+        self.filename = filename
+        if readOnly:
+            # as_uri quotes the characters that mean something in a URI
+            uri = pathlib.Path(os.path.abspath(filename)).as_uri() + '?mode=ro'
+            self.connection = sqlite3.connect(uri, uri=True)
+            return
+        self.connection = sqlite3.connect(filename)
+        # Readers don't block the writer and commits are cheap
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT, pipeline TEXT, '
+                                'size INTEGER, mtime INTEGER, hash TEXT, '
+                                'PRIMARY KEY (path, pipeline))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (hash TEXT, pipeline TEXT, '
+                                'output TEXT, error TEXT, finished REAL, '
+                                'PRIMARY KEY (hash, pipeline))')
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def files(self, pipeline):
+        '''Returns {path: (size, mtime)} of the files handled by pipeline.'''
+        rows = self.connection.execute('SELECT path, size, mtime FROM files '
+                                       'WHERE pipeline = ?', (pipeline,))
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def result(self, digest, pipeline):
+        '''Returns (output, error) of the content with this hash, or None if
+           it was never processed.'''
+        return self.connection.execute('SELECT output, error FROM results '
+                                       'WHERE hash = ? AND pipeline = ?',
+                                       (digest, pipeline)).fetchone()
+
+    def record(self, path, pipeline, size, mtime, digest, output=None, error=None,
+               processed=True):
+        '''Records that path was handled, and the result if it was processed
+           rather than skipped.'''
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                (path, pipeline, size, mtime, digest))
+        if processed and digest is not None:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                    (digest, pipeline, output, error, time.time()))
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_INTERVAL:
+            self.commit()
+
+    def forget(self, paths, pipeline):
+        '''Removes inputs that were deleted. Their results stay, for copies
+           of the same content.'''
+        self.connection.executemany('DELETE FROM files WHERE path = ? AND pipeline = ?',
+                                    [(path, pipeline) for path in paths])
+        self.uncommitted += len(paths)
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+_manifest = None
+_pipelineKey = None
+
+
+def _initWorker(pipeline, manifestFilename):
+    global _manifest, _pipelineKey
+    batch._initWorker(pipeline)
+    _manifest = Manifest(manifestFilename, readOnly=True)
+    _pipelineKey = pipeline.key()
+
+
+def _handleFile(filename, root):
+    '''Hashes a file and processes it unless the same content was already
+       processed to the same output.'''
+    try:
+        digest = fileKey(filename)
+    except OSError as e:
+        return {'input': filename, 'hash': None, 'error': str(e)}
+    done = _manifest.result(digest, _pipelineKey)
+    output = batch._pipeline.outputPath(filename, root)
+    if done is not None and done[1] is None and done[0] == output and \
+       os.path.exists(output):
+        return {'input': filename, 'hash': digest, 'skipped': True}
+    result = batch._processFile((filename, root))
+    result['hash'] = digest
+    return result
+
+
+class Watcher(object):
+    '''Scans the input paths and keeps the worker processes fed.'''
+
+    def __init__(self, pipeline, paths, manifest, workers=None,
+                 queuePerWorker=QUEUE_PER_WORKER, settle=SETTLE_SECONDS, onResult=None):
+        self.pipeline = pipeline
+        self.pipelineKey = pipeline.key()
+        self.paths = paths
+        self.manifest = manifest
+        self.workers = workers or os.cpu_count() or 1
+        self.maxInFlight = self.workers * queuePerWorker
+        self.settle = settle
+        self.onResult = onResult
+        self.seen = manifest.files(self.pipelineKey)
+        # output -> the input written to it, so two inputs with the same
+        # output are noticed instead of overwriting each other
+        self.owners = {}
+        self.collisions = set()
+        # future -> (path, size, mtime)
+        self.inFlight = {}
+        self.queued = set()
+        self.report = batch.ThroughputReport()
+        self.skipped = 0
+        # The outputs and the manifest must not be taken for inputs
+        self.ignored = [os.path.abspath(pipeline.outputDir)] if pipeline.outputDir else []
+
+    def isIgnored(self, path):
+        return any(path == ignored or path.startswith(ignored + os.sep)
+                   for ignored in self.ignored)
+
+    def _walk(self, directory):
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
+            # Nothing below it is known to be deleted
+            self.walkFailed = True
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not self.isIgnored(entry.path):
+                    yield from self._walk(entry.path)
+            elif entry.name.lower().endswith(batch.IMAGE_EXTENSIONS):
+                yield entry
+
+    def scan(self):
+        '''Yields (path, root, size, mtime) of the files that are new or
+           changed since they were last handled, and forgets the ones that
+           were deleted.'''
+        settled = time.time() - self.settle
+        self.walkFailed = False
+        present = set()
+        owners = {}
+        for root in self.paths:
+            root = os.path.abspath(root)
+            for entry in self._walk(root):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                path = entry.path
+                present.add(path)
+                output = self.pipeline.outputPath(path, root)
+                # The input that had the output first keeps it while it exists
+                owner = owners.get(output) or self.owners.get(output)
+                if owner is not None and owner != path and \
+                   (owner in present or os.path.exists(owner)):
+                    if path not in self.collisions:
+                        self.collisions.add(path)
+                        sys.stderr.write('Skipping %s: %s is the output of %s\n'
+                                         % (path, output, owner))
+                    continue
+                owners[output] = path
+                state = (stat.st_size, stat.st_mtime_ns)
+                if self.seen.get(path) == state or path in self.queued:
+                    continue
+                if stat.st_mtime > settled:
+                    # Probably still being written
+                    continue
+                yield (path, root) + state
+        self.owners = owners
+        if not self.walkFailed:
+            deleted = [path for path in self.seen if path not in present]
+            if deleted:
+                self.manifest.forget(deleted, self.pipelineKey)
+                for path in deleted:
+                    del self.seen[path]
+            self.collisions &= present
+
+    def poll(self, executor):
+        '''Submits every new or changed file. Returns how many there were.'''
+        count = 0
+        for path, root, size, mtime in self.scan():
+            while len(self.inFlight) >= self.maxInFlight:
+                self.collect(FIRST_COMPLETED)
+            future = executor.submit(_handleFile, path, root)
+            self.inFlight[future] = (path, size, mtime)
+            self.queued.add(path)
+            count += 1
+        return count
+
+    def collect(self, returnWhen=FIRST_COMPLETED, timeout=None):
+        if not self.inFlight:
+            return
+        done, _ = wait(list(self.inFlight), timeout=timeout, return_when=returnWhen)
+        for future in done:
+            path, size, mtime = self.inFlight.pop(future)
+            self.queued.discard(path)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'input': path, 'hash': None, 'error': str(e)}
+            self.finished(path, size, mtime, result)
+
+    def finished(self, path, size, mtime, result):
+        if result.get('skipped'):
+            self.skipped += 1
+            self.manifest.record(path, self.pipelineKey, size, mtime, result['hash'],
+                                 processed=False)
+        else:
+            self.report.add(result)
+            self.manifest.record(path, self.pipelineKey, size, mtime, result['hash'],
+                                 result.get('output'), result.get('error'))
+            if self.onResult is not None:
+                self.onResult(result)
+        self.seen[path] = (size, mtime)
+
+    def status(self):
+        return 'processed %d, skipped %d, failed %d, colliding %d, in flight %d' % (
+            self.report.images, self.skipped, len(self.report.failed),
+            len(self.collisions), len(self.inFlight))
+
+    def run(self, interval=POLL_INTERVAL, once=False, out=sys.stdout):
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_initWorker,
+                                 initargs=(self.pipeline, self.manifest.filename)) as executor:
+            try:
+                while True:
+                    started = time.time()
+                    found = self.poll(executor)
+                    if once:
+                        self.collect(returnWhen=ALL_COMPLETED)
+                        break
+                    # Results keep coming in while waiting for the next scan
+                    while True:
+                        remaining = interval - (time.time() - started)
+                        if remaining <= 0:
+                            break
+                        if self.inFlight:
+                            self.collect(FIRST_COMPLETED, timeout=remaining)
+                        else:
+                            time.sleep(remaining)
+                    self.manifest.commit()
+                    if found or self.inFlight:
+                        out.write(self.status() + '\n')
+                        out.flush()
+            except KeyboardInterrupt:
+                out.write('Stopping, waiting for %d image(s) in flight\n' % len(self.inFlight))
+                self.collect(returnWhen=ALL_COMPLETED)
+            finally:
+                self.manifest.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch directories and apply an '
+                                     'editing pipeline to new and changed images.')
+    parser.add_argument('input', nargs='+', help='directories to watch')
+    parser.add_argument('output', help='directory to write the results to')
+    batch.addPipelineArguments(parser)
+    parser.add_argument('--manifest', help='SQLite file recording what was processed '
+                        '(default: %s in the output directory)' % MANIFEST_NAME)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between scans')
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help='leave files modified in the last SETTLE seconds for later')
+    parser.add_argument('--queue', type=int, default=QUEUE_PER_WORKER,
+                        help='images in flight per worker')
+    parser.add_argument('--once', action='store_true',
+                        help='process what is there and exit instead of watching')
+    args = parser.parse_args(argv)
+
+    try:
+        pipeline = batch.buildPipeline(args)
+    except ValueError as e:
+        parser.error(str(e))
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output, MANIFEST_NAME))
+    metricsExport = batch.MetricsExport(args.metrics_jsonl, args.metrics_prom)
+    watcher = Watcher(pipeline, args.input, manifest, args.jobs,
+                      args.queue, args.settle, onResult=metricsExport.add)
+    start = time.perf_counter()
+    try:
+        watcher.run(args.interval, args.once)
+    finally:
+        manifest.close()
+    wallSeconds = time.perf_counter() - start
+    metricsExport.finish(wallSeconds)
+    print(watcher.report.format(wallSeconds, watcher.workers))
+    print('Skipped %d unchanged image(s)' % watcher.skipped)
+    return 1 if watcher.report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())